@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#
+# Color relief for the dynamic tile generator script (the equivalent of
+# gdaldem color-relief -alpha), applied to a whole tile at once with numpy.
+# .clr files are parsed once and cached, so coloring a tile is only a lookup.
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import numpy
+import re
+import threading
+from file_cache import FileCache
+
+# Color selection modes (same as gdaldem: interpolate by default, or -exact_color_entry / -nearest_color_entry)
+INTERPOLATE = 'interpolate'
+EXACT_ENTRY = 'exact'
+NEAREST_ENTRY = 'nearest'
+
+# Colors that can be given by name instead of by value in a .clr file (as in gdaldem)
+NAMED_COLORS = {
+    'white':   (1.00, 1.00, 1.00),
+    'black':   (0.00, 0.00, 0.00),
+    'red':     (1.00, 0.00, 0.00),
+    'green':   (0.00, 1.00, 0.00),
+    'blue':    (0.00, 0.00, 1.00),
+    'yellow':  (1.00, 1.00, 0.00),
+    'magenta': (1.00, 0.00, 1.00),
+    'cyan':    (0.00, 1.00, 1.00),
+    'aqua':    (0.00, 0.75, 0.75),
+    'grey':    (0.75, 0.75, 0.75),
+    'gray':    (0.75, 0.75, 0.75),
+    'orange':  (1.00, 0.50, 0.00),
+    'brown':   (0.75, 0.50, 0.25),
+    'purple':  (0.50, 0.00, 1.00),
+    'violet':  (0.50, 0.00, 1.00),
+    'indigo':  (0.00, 0.50, 1.00),
+}
+
+###############################################################################
+
+def _atoi(token):
+    """Integer value of a token, parsed like C's atoi (leading digits only, 0 if none)"""
+
+    m = re.match(r'\s*[-+]?\d+', token)
+    if m:
+        return int(m.group(0))
+    return 0
+
+###############################################################################
+
+class ColorRelief(object):
+    """
+    Color table read from a gdaldem .clr file.  Each line holds an elevation (or "nv" for
+    nodata, or a percentage of the range of the data, e.g. 50%) followed by R G B [A]
+    values or a color name.  Fields can be separated by spaces, tabs, commas or colons
+    """
+
+    def __init__(self, filename, mode=INTERPOLATE):
+        self.filename = filename
+        self.mode = mode
+        # Entries as (value token, (r, g, b, a)), in the order of the file
+        self.entries = []
+        self.has_percent = False
+        self.has_nodata_entry = False
+        # Tables without percentages, for each nodata value (shared by the threads that color tiles)
+        self.tables = {}
+        self.lock = threading.Lock()
+
+        with open(filename, 'r') as clr:
+            for line in clr:
+                fields = [f for f in re.split(r'[ ,\t:]+', line.strip()) if f != '']
+                if len(fields) < 2 or fields[0][0] in '#/':
+                    continue
+                if len(fields) >= 4:
+                    color = (_atoi(fields[1]), _atoi(fields[2]), _atoi(fields[3]),
+                             _atoi(fields[4]) if len(fields) >= 5 else 255)
+                elif fields[1].lower() in NAMED_COLORS:
+                    r, g, b = NAMED_COLORS[fields[1].lower()]
+                    color = (int(r * 255), int(g * 255), int(b * 255), 255)
+                else:
+                    raise ValueError('Unknown color %s in %s' % (fields[1], filename))
+                if len(fields[0]) > 1 and fields[0].endswith('%'):
+                    pct = float(fields[0][:-1]) / 100.0
+                    if pct < 0.0 or pct > 1.0:
+                        raise ValueError('Wrong value for a percentage (%s) in %s' % (fields[0], filename))
+                    self.has_percent = True
+                if fields[0].lower() == 'nv':
+                    self.has_nodata_entry = True
+                self.entries.append((fields[0], color))
+
+        if not self.entries:
+            raise ValueError('No color entries in ' + filename)
+
+    # -------------------------------------------------------------------------
+    def table(self, nodata, minmax):
+        """
+        Sorted entry values and their colors, with "nv" and percentages resolved against the
+        nodata value and (min, max) of the band.  As in gdaldem, nodata is transparent if there
+        is no "nv" entry
+        """
+        entries = self.entries
+        if nodata is not None and not self.has_nodata_entry:
+            entries = entries + [('nv', (0, 0, 0, 0))]
+        values = []
+        for token, color in entries:
+            if token.lower() == 'nv' and nodata is not None:
+                values.append(nodata)
+            elif len(token) > 1 and token.endswith('%'):
+                values.append(float(token[:-1]) / 100.0 * (minmax[1] - minmax[0]) + minmax[0])
+            else:
+                try:
+                    values.append(float(token))
+                except ValueError:
+                    values.append(0.0)  # as atof
+        values = numpy.array(values, dtype=numpy.float64)
+        colors = numpy.array([color for token, color in entries], dtype=numpy.float64)
+
+        # Stable sort by value, with a nan (nodata) entry first
+        nan_first = numpy.where(numpy.isnan(values), -numpy.inf, values)
+        order = numpy.argsort(nan_first, kind='mergesort')
+        return values[order], colors[order]
+
+    # -------------------------------------------------------------------------
+    def colorize(self, data, nodata=None):
+        """
+        Color a band (2D array) and return the R, G, B and alpha bands as byte arrays,
+        identical to the output of gdaldem color-relief -alpha
+        """
+        # gdaldem reads the source band as float32
+        values = numpy.asarray(data).astype(numpy.float32).astype(numpy.float64)
+        if nodata is not None:
+            nodata = float(numpy.float32(nodata))
+
+        if self.has_percent:
+            valid = values[~numpy.isnan(values)]
+            if nodata is not None:
+                valid = valid[valid != nodata]
+            if valid.size:
+                minmax = (valid.min(), valid.max())
+            else:
+                minmax = (0.0, 0.0)
+            entry_values, colors = self.table(nodata, minmax)
+        else:
+            # (keyed by repr, as a nan nodata value is not equal to itself)
+            key = repr(nodata)
+            with self.lock:
+                table = self.tables.get(key)
+            if table is None:
+                # Made without holding the lock (a table made by another thread in the meantime is used instead)
+                table = self.table(nodata, None)
+                with self.lock:
+                    table = self.tables.setdefault(key, table)
+            entry_values, colors = table
+
+        flat = values.ravel()
+        rgba = numpy.zeros((flat.size, 4), dtype=numpy.float64)
+        todo = numpy.ones(flat.size, dtype=bool)
+
+        # A nan entry only matches nan values, and is skipped by the search for the others
+        first = 0
+        if numpy.isnan(entry_values[0]):
+            isnan = numpy.isnan(flat)
+            rgba[isnan] = colors[0]
+            todo &= ~isnan
+            first = 1
+        n = len(entry_values)
+
+        # Index of the first entry that is not smaller than each value
+        i = numpy.searchsorted(entry_values[first:], flat, side='left') + first
+        i[numpy.isnan(flat)] = n
+
+        below = todo & (i == first)
+        above = todo & (i == n)
+        inside = todo & ~below & ~above
+        # (with a nan entry, gdaldem interpolates the values below the first entry between the nan entry and it, which
+        # comes out as 0, unless a color is picked rather than interpolated)
+        if self.mode == EXACT_ENTRY or (first == 1 and self.mode != NEAREST_ENTRY):
+            below &= (entry_values[first] == flat)
+        if self.mode == EXACT_ENTRY:
+            above &= (entry_values[n-1] == flat)
+        rgba[below] = colors[first]
+        rgba[above] = colors[n-1]
+
+        ii = i[inside]
+        v = flat[inside]
+        lower_val = entry_values[ii-1]
+        upper_val = entry_values[ii]
+        lower_col = colors[ii-1]
+        upper_col = colors[ii]
+        on_lower = (lower_val == v)
+        on_upper = ~on_lower & (upper_val == v)
+        between = ~on_lower & ~on_upper
+
+        out = numpy.zeros((v.size, 4), dtype=numpy.float64)
+        out[on_lower] = lower_col[on_lower]
+        out[on_upper] = upper_col[on_upper]
+        if self.mode == NEAREST_ENTRY:
+            nearer_lower = (v - lower_val) < (upper_val - v)
+            out[between & nearer_lower] = lower_col[between & nearer_lower]
+            out[between & ~nearer_lower] = upper_col[between & ~nearer_lower]
+        elif self.mode != EXACT_ENTRY:
+            ratio = ((v - lower_val) / (upper_val - lower_val))[between][:, numpy.newaxis]
+            lc = lower_col[between]
+            uc = upper_col[between]
+            # Truncated and clamped the same way as gdaldem
+            out[between] = numpy.clip(numpy.trunc(0.45 + lc + ratio * (uc - lc)), 0, 255)
+        rgba[inside] = out
+
+        rgba = rgba.astype(numpy.uint8).reshape(values.shape + (4,))
+        return [rgba[..., b] for b in range(4)]
+
+###############################################################################
+
+_color_reliefs = FileCache(ColorRelief)
+
+def get_color_relief(filename, mode=INTERPOLATE):
+    """The ColorRelief of a .clr file, with a color selection mode"""
+
+    return _color_reliefs.get(filename, mode)
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+#
+# Coverage indexes, which record the tiles of a layer that have any data (so that
+# the KML generator can leave out the network links to empty tiles, e.g. over the
+# ocean or outside of the footprint of a DEM).  An index holds a bitmap of the
+# tiles at one zoom level (within their bounding box), and a bitmap for each of
+# the lower zoom levels, in which a tile is set if any of its children are.  A
+# tile at a higher zoom level has data if its ancestor at the zoom level of the
+# index does.
+#
+# Indexes are made from the footprint of the raster data source (and shapefile
+# mask), by running this script:
+#
+#   python coverage_index.py --url <dataset or .pyr file> [--shpfile <shapefile> [--outsideMask]] [--zoom <zoom>] <index file>
+#
+# or from the tiles rendered by seed_tiles.py (its --coverage option), and are
+# used by adding coverage=<index file> to the network link.  The files are read
+# once and cached (until they change).
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from optparse import OptionParser
+import cStringIO
+import tempfile
+import json
+import zlib
+import os, sys
+from file_cache import FileCache
+
+# First line of an index file
+MAGIC = 'COVERAGE 1\n'
+# Default zoom level of the indexes made from a footprint
+DEFAULT_ZOOM = 12
+# Size (in pixels) of the shapefile mask that is checked for each tile
+MASK_SIZE = 16
+
+###############################################################################
+
+class CoverageLevel(object):
+    """The bitmap of the tiles with data at one zoom level (row by row, from tminy to tmaxy)"""
+
+    def __init__(self, tz, tminx, tminy, tmaxx, tmaxy, bits=None):
+        self.tz = tz
+        self.tminx, self.tminy, self.tmaxx, self.tmaxy = tminx, tminy, tmaxx, tmaxy
+        self.width = tmaxx - tminx + 1
+        if bits is None:
+            bits = bytearray((self.width * (tmaxy - tminy + 1) + 7) // 8)
+        self.bits = bits
+
+    def __contains__(self, tile):
+        tx, ty = tile
+        if not (self.tminx <= tx <= self.tmaxx and self.tminy <= ty <= self.tmaxy):
+            return False
+        i = (ty - self.tminy) * self.width + (tx - self.tminx)
+        return (self.bits[i >> 3] >> (7 - (i & 7))) & 1 == 1
+
+    def add(self, tx, ty):
+        i = (ty - self.tminy) * self.width + (tx - self.tminx)
+        self.bits[i >> 3] |= 1 << (7 - (i & 7))
+
+###############################################################################
+
+class CoverageIndex(object):
+    """The tiles with data of a layer (see the top of this file)"""
+
+    def __init__(self, maxzoom, levels):
+        self.maxzoom = maxzoom
+        self.levels = levels
+
+    # -------------------------------------------------------------------------
+    def covers(self, tx, ty, tz):
+        """Whether the tile (TMS coordinates) has any data"""
+
+        if tz > self.maxzoom:
+            shift = tz - self.maxzoom
+            tx, ty, tz = tx >> shift, ty >> shift, self.maxzoom
+        level = self.levels.get(tz)
+        return level is not None and (tx, ty) in level
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def from_tiles(cls, tz, tiles):
+        """Make the index of the tiles (tx, ty) with data at zoom level tz"""
+
+        tiles = set(tiles)
+        levels = {}
+        for z in range(tz, -1, -1):
+            if tiles:
+                xs = [tx for tx, ty in tiles]
+                ys = [ty for tx, ty in tiles]
+                level = CoverageLevel(z, min(xs), min(ys), max(xs), max(ys))
+            else:
+                level = CoverageLevel(z, 0, 0, -1, -1)
+            for tx, ty in tiles:
+                level.add(tx, ty)
+            levels[z] = level
+            tiles = set((tx >> 1, ty >> 1) for tx, ty in tiles)
+        return cls(tz, levels)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def read(cls, filename):
+        with open(filename, 'rb') as indexfile:
+            if indexfile.readline() != MAGIC:
+                raise ValueError(filename + ' is not a coverage index')
+            header = json.loads(indexfile.readline())
+            data = zlib.decompress(indexfile.read())
+        levels = {}
+        offset = 0
+        for tz, tminx, tminy, tmaxx, tmaxy, nbytes in header['levels']:
+            levels[tz] = CoverageLevel(tz, tminx, tminy, tmaxx, tmaxy, bytearray(data[offset:offset+nbytes]))
+            offset += nbytes
+        return cls(header['maxzoom'], levels)
+
+    # -------------------------------------------------------------------------
+    def write(self, filename):
+        header = {'maxzoom': self.maxzoom, 'levels': []}
+        data = cStringIO.StringIO()
+        for tz in sorted(self.levels):
+            level = self.levels[tz]
+            header['levels'].append([tz, level.tminx, level.tminy, level.tmaxx, level.tmaxy, len(level.bits)])
+            data.write(str(level.bits))
+        # Write to a temporary file and rename it, so that the KML generator never reads a partly written index
+        folder = os.path.dirname(os.path.abspath(filename))
+        fd, tempfilename = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', dir=folder)
+        with os.fdopen(fd, 'wb') as indexfile:
+            indexfile.write(MAGIC)
+            indexfile.write(json.dumps(header) + '\n')
+            indexfile.write(zlib.compress(data.getvalue(), 9))
+        os.chmod(tempfilename, 0644)
+        if os.path.exists(filename) and sys.platform == 'win32':
+            os.unlink(filename)
+        os.rename(tempfilename, filename)
+
+###############################################################################
+
+_indexes = FileCache(CoverageIndex.read)
+
+def get_index(filename):
+    """The CoverageIndex of an index file"""
+
+    return _indexes.get(filename)
+
+# -------------------------------------------------------------------------
+def tile_has_data(png):
+    """Whether a (PNG) tile has any pixel that isn't transparent"""
+
+    from PIL import Image
+    image = Image.open(cStringIO.StringIO(png))
+    if image.mode not in ('RGBA', 'LA') and 'transparency' not in image.info:
+        return True
+    alpha = image.convert('RGBA').split()[-1]
+    return alpha.getextrema()[1] > 0
+
+# -------------------------------------------------------------------------
+def footprint_tiles(url, tz, shpfile=None, outsideMask=False):
+    """
+    The tiles (tx, ty) at zoom level tz that the valid pixels of a raster (or of any of the
+    datasets of a .pyr file) fall in, and that aren't masked away by the shapefile
+    """
+    from osgeo import gdal, osr
+    import raster_sources
+    import pyramid_files
+    import shape_mask
+    from kml_for_tiles import RegionTiles
+
+    if url.find('.pyr') >= 0:
+        paths = pyramid_files.get_pyramid(url).paths()
+    else:
+        paths = [url]
+
+    tiles = set()
+    for path in paths:
+        # The tiles within the extent of the dataset
+        ulx, uly, lrx, lry = raster_sources.get_source(path).extent('+proj=latlong +datum=wgs84 +nodefs')[:4]
+        region = RegionTiles(max(ulx, -180), min(uly, 85.05112878), min(lrx, 180), max(lry, -85.05112878))
+        tminx, tminy, tmaxx, tmaxy = region[tz].bounds
+        mercator = region.mercator
+        west, south = mercator.TileBounds(tminx, tminy, tz)[:2]
+        east, north = mercator.TileBounds(tmaxx, tmaxy, tz)[2:]
+
+        # Warp the dataset to one pixel per tile, a tile has data if any of the pixels in it are valid
+        # (the largest value of the alpha band)
+        ds = gdal.Warp('', path, format='MEM', dstSRS='EPSG:3857', outputBounds=(west, south, east, north),
+                       width=tmaxx - tminx + 1, height=tmaxy - tminy + 1, resampleAlg='max', dstAlpha=True,
+                       warpOptions=['SKIP_NOSOURCE=YES'])
+        alpha = ds.GetRasterBand(ds.RasterCount).ReadAsArray()
+        for row, col in zip(*alpha.nonzero()):
+            # (the first row is the northernmost)
+            tiles.add((tminx + int(col), tmaxy - int(row)))
+
+    if shpfile:
+        srs = osr.SpatialReference()
+        srs.ImportFromProj4('+proj=latlong +datum=wgs84 +nodefs')
+        tiles = mask_tiles(tiles, tz, shape_mask.get_shape_mask(shpfile, srs.ExportToWkt()), outsideMask)
+    return tiles
+
+# -------------------------------------------------------------------------
+def mask_tiles(tiles, tz, mask, outsideMask=False):
+    """
+    The tiles (tx, ty) at zoom level tz that the shapefile mask (a ShapeMask in degrees) leaves any
+    data in: the areas inside the polygons are transparent, or with outsideMask, the areas outside them
+    """
+    from global_mercator import GlobalMercator
+
+    mercator = GlobalMercator()
+    kept = set()
+    for tx, ty in tiles:
+        south, west, north, east = mercator.TileLatLonBounds(tx, ty, tz)
+        inside = mask.tile_mask(west, south, east, north, MASK_SIZE, MASK_SIZE)
+        # Empty if the tile is inside the polygons, or with outsideMask, if no polygon overlaps it
+        if (inside is True and not outsideMask) or (inside is None and outsideMask):
+            continue
+        kept.add((tx, ty))
+    return kept
+
+###############################################################################
+
+if __name__=='__main__':
+
+    parser = OptionParser(usage="usage: %prog --url URL [options] indexfile",
+        description="Make the coverage index of a local data source, from its footprint (the tiles that its valid "
+                    "pixels fall in).  Add coverage=<indexfile> to the network link to use it")
+    parser.add_option("--url", dest="url", help="local gdal-supported dataset (or .pyr file)")
+    parser.add_option("--shpfile", dest="shpfile", help="shapefile that the tiles are masked with")
+    parser.add_option("--outsideMask", dest="outsideMask", action="store_true", help="the outside of the shapefile polygons is masked instead")
+    parser.add_option("--zoom", dest="zoom", type="int", default=DEFAULT_ZOOM, help="zoom level of the index (default %d)" % DEFAULT_ZOOM)
+    (options, args) = parser.parse_args()
+    if not options.url or len(args) != 1:
+        parser.error("--url and an index file are required")
+
+    tiles = footprint_tiles(options.url, options.zoom, options.shpfile, options.outsideMask)
+    CoverageIndex.from_tiles(options.zoom, tiles).write(args[0])
+    print "%d tiles with data at zoom level %d" % (len(tiles), options.zoom)
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Cache of the objects that the scripts read from files (color tables, shapefile
+# masks, .pyr files and coverage indexes).  Each object is made once per process,
+# and made again when the modification time of its file changes.
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import threading
+import os
+
+###############################################################################
+
+class FileCache(object):
+    """
+    Objects made by load(filename, *args), cached by the filename and the other arguments
+    (thread safe, a file that is requested by several threads at once is only read once)
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.objects = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def get(self, filename, *args):
+        """The (cached) object for a file, made again if the file changed"""
+
+        key = (filename,) + args
+        mtime = os.path.getmtime(filename)
+        with self.lock:
+            cached = self.objects.get(key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            loading = self.loading.setdefault(key, threading.Lock())
+        with loading:
+            # (made by another thread while this one waited)
+            with self.lock:
+                cached = self.objects.get(key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            obj = self.load(filename, *args)
+            with self.lock:
+                self.objects[key] = (mtime, obj)
+            return obj
@@ -29,7 +29,6 @@ from osgeo import gdal, gdalnumeric, ogr
 from gdalconst import *
 import osr
 import math
-import subprocess
 from PIL import Image
 import cStringIO
 import cgi
@@ -37,255 +36,65 @@ import os, sys
 import urllib
 import time
 import re
+import email.utils
+import threading
+import numpy
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import raster_sources
+import color_relief
+import shape_mask
+import tile_fetch
+import tile_cache
+import pyramid_files
+from global_mercator import GlobalMercator
 
 ###############################################################################
 
-__doc__globalmaptiles = """
-globalmaptiles.py
-
-Global Map Tiles as defined in Tile Map Service (TMS) Profiles
-==============================================================
-
-Functions necessary for generation of global tiles used on the web.
-It contains classes implementing coordinate conversions for:
-
-  - GlobalMercator (based on EPSG:900913 = EPSG:3785)
-       for Google Maps, Yahoo Maps, Bing Maps compatible tiles
-  - GlobalGeodetic (based on EPSG:4326)
-       for OpenLayers Base Map and Google Earth compatible tiles
-
-More info at:
-
-http://wiki.osgeo.org/wiki/Tile_Map_Service_Specification
-http://wiki.osgeo.org/wiki/WMS_Tiling_Client_Recommendation
-http://msdn.microsoft.com/en-us/library/bb259689.aspx
-http://code.google.com/apis/maps/documentation/overlays.html#Google_Maps_Coordinates
-
-Created by Klokan Petr Pridal on 2008-07-03.
-Google Summer of Code 2008, project KMLForTiles for OSGEO.
-
-In case you use this class in your product, translate it to another language
-or find it usefull for your project please let me know.
-My email: klokan at klokan dot cz.
-I would like to know where it was used.
-
-Class is available under the open-source GDAL license (www.gdal.org).
-"""
-
-MAXZOOMLEVEL = 32
-
-class GlobalMercator(object):
+# Number of threads used to acquire the background (bgurl) sources while the foreground is generated
+SOURCE_THREADS = 8
+_source_pool = None
+_source_pool_lock = threading.Lock()
+
+def source_pool():
+    """Thread pool shared by all tiles (only created when a tile with a bgurl is first generated)"""
+
+    global _source_pool
+    with _source_pool_lock:
+        if _source_pool is None:
+            _source_pool = ThreadPool(SOURCE_THREADS)
+        return _source_pool
+
+# Projection of the dynamic tiles (the tiles are warped to this projection, and
+# then displayed as ground overlays in Google Earth)
+TILE_SRS = '+proj=latlong +datum=wgs84 +nodefs'
+_tile_srs = osr.SpatialReference()
+_tile_srs.ImportFromProj4(TILE_SRS)
+TILE_SRS_WKT = _tile_srs.ExportToWkt()
+
+# Color of the tiles without data
+TRANSPARENT = (0, 0, 0, 0)
+# Number of single color tiles whose PNG is kept (see uniform_png)
+MAX_UNIFORM_PNGS = 256
+_uniform_pngs = OrderedDict()
+_uniform_pngs_lock = threading.Lock()
+
+def uniform_png(color, tilesize):
     """
-    TMS Global Mercator Profile
-    ---------------------------
-
-  Functions necessary for generation of tiles in Spherical Mercator projection,
-  EPSG:900913 (EPSG:gOOglE, Google Maps Global Mercator), EPSG:3785, OSGEO:41001.
-
-  Such tiles are compatible with Google Maps, Bing Maps, Yahoo Maps,
-  UK Ordnance Survey OpenSpace API, ...
-  and you can overlay them on top of base maps of those web mapping applications.
-
-    Pixel and tile coordinates are in TMS notation (origin [0,0] in bottom-left).
-
-    What coordinate conversions do we need for TMS Global Mercator tiles::
-
-         LatLon      <->       Meters      <->     Pixels    <->       Tile
-
-     WGS84 coordinates   Spherical Mercator  Pixels in pyramid  Tiles in pyramid
-         lat/lon            XY in metres     XY pixels Z zoom      XYZ from TMS
-        EPSG:4326           EPSG:900913
-         .----.              ---------               --                TMS
-        /      \     <->     |       |     <->     /----/    <->      Google
-        \      /             |       |           /--------/          QuadTree
-         -----               ---------         /------------/
-       KML, public         WebMapService         Web Clients      TileMapService
-
-    What is the coordinate extent of Earth in EPSG:900913?
-
-      [-20037508.342789244, -20037508.342789244, 20037508.342789244, 20037508.342789244]
-      Constant 20037508.342789244 comes from the circumference of the Earth in meters,
-      which is 40 thousand kilometers, the coordinate origin is in the middle of extent.
-      In fact you can calculate the constant as: 2 * math.pi * 6378137 / 2.0
-      $ echo 180 85 | gdaltransform -s_srs EPSG:4326 -t_srs EPSG:900913
-      Polar areas with abs(latitude) bigger then 85.05112878 are clipped off.
-
-    What are zoom level constants (pixels/meter) for pyramid with EPSG:900913?
-
-      whole region is on top of pyramid (zoom=0) covered by 256x256 pixels tile,
-      every lower zoom level resolution is always divided by two
-      initialResolution = 20037508.342789244 * 2 / 256 = 156543.03392804062
-
-    What is the difference between TMS and Google Maps/QuadTree tile name convention?
-
-      The tile raster itself is the same (equal extent, projection, pixel size),
-      there is just different identification of the same raster tile.
-      Tiles in TMS are counted from [0,0] in the bottom-left corner, id is XYZ.
-      Google placed the origin [0,0] to the top-left corner, reference is XYZ.
-      Microsoft is referencing tiles by a QuadTree name, defined on the website:
-      http://msdn2.microsoft.com/en-us/library/bb259689.aspx
-
-    The lat/lon coordinates are using WGS84 datum, yeh?
-
-      Yes, all lat/lon we are mentioning should use WGS84 Geodetic Datum.
-      Well, the web clients like Google Maps are projecting those coordinates by
-      Spherical Mercator, so in fact lat/lon coordinates on sphere are treated as if
-      the were on the WGS84 ellipsoid.
-
-      From MSDN documentation:
-      To simplify the calculations, we use the spherical form of projection, not
-      the ellipsoidal form. Since the projection is used only for map display,
-      and not for displaying numeric coordinates, we don't need the extra precision
-      of an ellipsoidal projection. The spherical projection causes approximately
-      0.33 percent scale distortion in the Y direction, which is not visually noticable.
-
-    How do I create a raster in EPSG:900913 and convert coordinates with PROJ.4?
-
-      You can use standard GIS tools like gdalwarp, cs2cs or gdaltransform.
-      All of the tools supports -t_srs 'epsg:900913'.
-
-      For other GIS programs check the exact definition of the projection:
-      More info at http://spatialreference.org/ref/user/google-projection/
-      The same projection is degined as EPSG:3785. WKT definition is in the official
-      EPSG database.
-
-      Proj4 Text:
-        +proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0
-        +k=1.0 +units=m +nadgrids=@null +no_defs
-
-      Human readable WKT format of EPGS:900913:
-         PROJCS["Google Maps Global Mercator",
-             GEOGCS["WGS 84",
-                 DATUM["WGS_1984",
-                     SPHEROID["WGS 84",6378137,298.257223563,
-                         AUTHORITY["EPSG","7030"]],
-                     AUTHORITY["EPSG","6326"]],
-                 PRIMEM["Greenwich",0],
-                 UNIT["degree",0.0174532925199433],
-                 AUTHORITY["EPSG","4326"]],
-             PROJECTION["Mercator_1SP"],
-             PARAMETER["central_meridian",0],
-             PARAMETER["scale_factor",1],
-             PARAMETER["false_easting",0],
-             PARAMETER["false_northing",0],
-             UNIT["metre",1,
-                 AUTHORITY["EPSG","9001"]]]
+    PNG of a tile of a single (RGBA) color, encoded once and shared by all of the tiles of that
+    color (e.g. all of the tiles without data, which are transparent)
     """
-
-    def __init__(self, tileSize=256):
-        "Initialize the TMS Global Mercator pyramid"
-        self.tileSize = tileSize
-        self.initialResolution = 2 * math.pi * 6378137 / self.tileSize
-        # 156543.03392804062 for tileSize 256 pixels
-        self.originShift = 2 * math.pi * 6378137 / 2.0
-        # 20037508.342789244
-
-    def LatLonToMeters(self, lat, lon ):
-        "Converts given lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:900913"
-
-        mx = lon * self.originShift / 180.0
-        my = math.log( math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
-
-        my = my * self.originShift / 180.0
-        return mx, my
-
-    def MetersToLatLon(self, mx, my ):
-        "Converts XY point from Spherical Mercator EPSG:900913 to lat/lon in WGS84 Datum"
-
-        lon = (mx / self.originShift) * 180.0
-        lat = (my / self.originShift) * 180.0
-
-        lat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
-        return lat, lon
-
-    def PixelsToMeters(self, px, py, zoom):
-        "Converts pixel coordinates in given zoom level of pyramid to EPSG:900913"
-
-        res = self.Resolution( zoom )
-        mx = px * res - self.originShift
-        my = py * res - self.originShift
-        return mx, my
-
-    def MetersToPixels(self, mx, my, zoom):
-        "Converts EPSG:900913 to pyramid pixel coordinates in given zoom level"
-
-        res = self.Resolution( zoom )
-        px = (mx + self.originShift) / res
-        py = (my + self.originShift) / res
-        return px, py
-
-    def PixelsToTile(self, px, py):
-        "Returns a tile covering region in given pixel coordinates"
-
-        tx = int( math.ceil( px / float(self.tileSize) ) - 1 )
-        ty = int( math.ceil( py / float(self.tileSize) ) - 1 )
-        return tx, ty
-
-    def PixelsToRaster(self, px, py, zoom):
-        "Move the origin of pixel coordinates to top-left corner"
-
-        mapSize = self.tileSize << zoom
-        return px, mapSize - py
-
-    def MetersToTile(self, mx, my, zoom):
-        "Returns tile for given mercator coordinates"
-
-        px, py = self.MetersToPixels( mx, my, zoom)
-        return self.PixelsToTile( px, py)
-
-    def TileBounds(self, tx, ty, zoom):
-        "Returns bounds of the given tile in EPSG:900913 coordinates"
-
-        minx, miny = self.PixelsToMeters( tx*self.tileSize, ty*self.tileSize, zoom )
-        maxx, maxy = self.PixelsToMeters( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
-        return ( minx, miny, maxx, maxy )
-
-    def TileLatLonBounds(self, tx, ty, zoom ):
-        "Returns bounds of the given tile in latutude/longitude using WGS84 datum"
-
-        bounds = self.TileBounds( tx, ty, zoom)
-        minLat, minLon = self.MetersToLatLon(bounds[0], bounds[1])
-        maxLat, maxLon = self.MetersToLatLon(bounds[2], bounds[3])
-
-        return ( minLat, minLon, maxLat, maxLon )
-
-    def Resolution(self, zoom ):
-        "Resolution (meters/pixel) for given zoom level (measured at Equator)"
-
-        # return (2 * math.pi * 6378137) / (self.tileSize * 2**zoom)
-        return self.initialResolution / (2**zoom)
-
-    def ZoomForPixelSize(self, pixelSize ):
-        "Maximal scaledown zoom of the pyramid closest to the pixelSize."
-
-        for i in range(MAXZOOMLEVEL):
-            if pixelSize > self.Resolution(i):
-                if i!=0:
-                    return i-1
-                else:
-                    return 0 # We don't want to scale up
-
-    def GoogleTile(self, tx, ty, zoom):
-        "Converts TMS tile coordinates to Google Tile coordinates"
-
-        # coordinate origin is moved from bottom-left to top-left corner of the extent
-        return tx, (2**zoom - 1) - ty
-
-    def QuadTree(self, tx, ty, zoom ):
-        "Converts TMS tile coordinates to Microsoft QuadTree"
-
-        quadKey = ""
-        ty = (2**zoom - 1) - ty
-        for i in range(zoom, 0, -1):
-            digit = 0
-            mask = 1 << (i-1)
-            if (tx & mask) != 0:
-                digit += 1
-            if (ty & mask) != 0:
-                digit += 2
-            quadKey += str(digit)
-
-        return quadKey
+    key = (color, tilesize)
+    with _uniform_pngs_lock:
+        png = _uniform_pngs.pop(key, None)
+        if png is None:
+            f = cStringIO.StringIO()
+            Image.new('RGBA', (tilesize, tilesize), color).save(f, "PNG")
+            png = f.getvalue()
+        _uniform_pngs[key] = png
+        while len(_uniform_pngs) > MAX_UNIFORM_PNGS:
+            _uniform_pngs.popitem(last=False)
+    return png
 
 ###############################################################################
 
@@ -320,6 +129,179 @@ class GenerateDynamicTiles(object):
             (a.astype('b')).tostring())
         return i
 
+    # -------------------------------------------------------------------------
+    def datasetToImage(self,ds):
+        """
+        Converts a gdal dataset (with byte bands) to a 
+        Python Imaging Library Image.
+        """
+        bands = [self.arrayToImage(ds.GetRasterBand(i).ReadAsArray()) for i in range(1, ds.RasterCount+1)]
+        mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[len(bands)]
+        return Image.merge(mode, bands)
+
+    # -------------------------------------------------------------------------
+    def imageToDataset(self, im, west, south, east, north):
+        """
+        Converts a Python Imaging Library Image to a (in memory)
+        gdal dataset georeferenced to the extent of a tile.
+        """
+        xsize, ysize = im.size
+        bands = im.split()
+        ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, len(bands), GDT_Byte)
+        ds.SetGeoTransform((west, (east - west) / xsize, 0, north, 0, (south - north) / ysize))
+        ds.SetProjection(TILE_SRS_WKT)
+        for i, band in enumerate(bands):
+            ds.GetRasterBand(i+1).WriteRaster(0, 0, xsize, ysize, band.tostring())
+        return ds
+
+    # -------------------------------------------------------------------------
+    def arraysToDataset(self, arrays, like_ds):
+        """
+        Converts a list of byte arrays (one per band) to a (in memory)
+        gdal dataset with the same georeferencing as like_ds.
+        """
+        ysize, xsize = arrays[0].shape
+        ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, len(arrays), GDT_Byte)
+        ds.SetGeoTransform(like_ds.GetGeoTransform())
+        ds.SetProjection(like_ds.GetProjection())
+        for i, a in enumerate(arrays):
+            ds.GetRasterBand(i+1).WriteArray(a)
+        return ds
+
+    # -------------------------------------------------------------------------
+    def stackDatasets(self, datasets):
+        """
+        Stacks (in memory) gdal datasets of the same width and bands on top of
+        each other, the first one at the top.
+        """
+        if len(datasets) == 1:
+            return datasets[0]
+        first, last = datasets[0], datasets[-1]
+        xsize = first.RasterXSize
+        ysize = sum(part.RasterYSize for part in datasets)
+        ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, first.RasterCount, first.GetRasterBand(1).DataType)
+        transform = list(first.GetGeoTransform())
+        bottom = last.GetGeoTransform()[3] + last.GetGeoTransform()[5] * last.RasterYSize
+        transform[5] = (bottom - transform[3]) / ysize
+        ds.SetGeoTransform(transform)
+        ds.SetProjection(first.GetProjection())
+        for i in range(1, first.RasterCount+1):
+            nodata = first.GetRasterBand(i).GetNoDataValue()
+            if nodata is not None:
+                ds.GetRasterBand(i).SetNoDataValue(nodata)
+        yoff = 0
+        for part in datasets:
+            for i in range(1, part.RasterCount+1):
+                band = part.GetRasterBand(i)
+                ds.GetRasterBand(i).WriteRaster(0, yoff, xsize, part.RasterYSize,
+                    band.ReadRaster(0, 0, xsize, part.RasterYSize), buf_type=band.DataType)
+            yoff += part.RasterYSize
+        return ds
+
+    # -------------------------------------------------------------------------
+    def stackImages(self, images):
+        """
+        Stacks Python Imaging Library Images of the same width on top of
+        each other, the first one at the top.
+        """
+        if len(images) == 1:
+            return images[0]
+        im = Image.new(images[0].mode, (images[0].size[0], sum(i.size[1] for i in images)))
+        yoff = 0
+        for part in images:
+            im.paste(part, (0, yoff))
+            yoff += part.size[1]
+        return im
+
+    # -------------------------------------------------------------------------
+    def download_tile(self, tile_url):
+        """Download a web tile into memory (over a pooled connection) and return it as an RGBA image"""
+
+        data = self.account_memory(tile_fetch.fetcher.get(tile_url))
+        return Image.open(cStringIO.StringIO(data)).convert('RGBA')
+
+    # -------------------------------------------------------------------------
+    def account_memory(self, obj):
+        """
+        Add the size of an intermediate result of the tile pipeline (downloaded data, an image
+        or a dataset) to self.tile_memory.  All of the intermediates are held until the tile is
+        encoded, so the total is the peak memory used by the tile
+        """
+        if isinstance(obj, str):
+            nbytes = len(obj)
+        elif isinstance(obj, gdal.Dataset):
+            nbytes = 0
+            for i in range(1, obj.RasterCount+1):
+                nbytes += obj.RasterXSize * obj.RasterYSize * gdal.GetDataTypeSize(obj.GetRasterBand(i).DataType) // 8
+        else:
+            nbytes = obj.size[0] * obj.size[1] * len(obj.getbands())
+        with self.tile_memory_lock:
+            self.tile_memory += nbytes
+        return obj
+
+    # -------------------------------------------------------------------------
+    def background_image(self, tz, tx0, nx, strip):
+        """
+        Acquire the background (bgurl) image of a row of nx tiles (see render_block), either
+        by warping a local data source or by downloading the web tiles
+        """
+        ty, west, south, east, north = strip
+        bgurl_url = self.bgurl
+        
+        if bgurl_url.find('{$z}') <= -1:
+            bgurl_url = self.local_dataset(bgurl_url, tz, (west, south, east, north))
+            if bgurl_url is None:
+                return self.account_memory(Image.new('RGBA', (nx*self.tilesize, self.tilesize)))
+            
+            bg_ds = self.account_memory(self.warp_tile(bgurl_url, west, south, east, north, False, nx*self.tilesize))
+            return self.account_memory(self.datasetToImage(bg_ds).convert('RGBA'))
+        else:
+            images = []
+            for tx in range(tx0, tx0+nx):
+                tile_url = bgurl_url.replace('{$x}', str(tx))
+                tile_url = tile_url.replace('{$y}', str(self.tile_y2(tz, ty)))
+                tile_url = tile_url.replace('{$invY}', str(self.tile_y2(tz, ty)))
+                tile_url = tile_url.replace('{$z}', str(tz))
+                images.append(self.account_memory(self.download_tile(tile_url)))
+            if len(images) == 1:
+                return images[0]
+            im = self.account_memory(Image.new('RGBA', (nx*self.tilesize, self.tilesize)))
+            for i, tile_im in enumerate(images):
+                im.paste(tile_im, (i*self.tilesize, 0))
+            return im
+
+    # -------------------------------------------------------------------------
+    def local_dataset(self, url, tz, bounds):
+        """
+        The local dataset to warp for tiles at zoom level tz within bounds (west, south, east, north): the
+        url itself, or for a multi-resolution (.pyr) file, the dataset that it lists for the zoom level
+        (None if none of them covers the bounds)
+        """
+        if url.find('.pyr') >= 0:
+            return pyramid_files.get_pyramid(url).dataset_for_tile(tz, bounds)
+        return url
+
+    # -------------------------------------------------------------------------
+    def warp_tile(self, raster_url, west, south, east, north, dstalpha, xsize=None):
+        """
+        Warp a local raster data source to the extent of a tile (or a row of xsize / tilesize tiles), in memory,
+        using the same options as gdalwarp -r <resample> [-dstalpha] -ovr AUTO -t_srs <TILE_SRS> -ts <xsize> <tilesize>
+        -te <west> <south> <east> <north> (-ovr AUTO selects the overview level closest to the tile resolution)
+        """
+        if xsize is None:
+            xsize = self.tilesize
+        options = ['-r', self.resample, '-ovr', 'AUTO', '-t_srs', TILE_SRS,
+                   '-ts', str(xsize), str(self.tilesize),
+                   '-te', str(west), str(south), str(east), str(north)]
+        if dstalpha:
+            options.append('-dstalpha')
+        source = raster_sources.get_source(raster_url)
+        with source.dataset() as src_ds:
+            ds = gdal.Warp('', src_ds, options=gdal.WarpOptions(options=options, format='MEM'))
+        if ds is None:
+            raise IOError('Could not warp ' + raster_url)
+        return ds
+
     # -------------------------------------------------------------------------
     def parse_custom_querystring(self, querystring, key_str, default_val ):
         """
@@ -362,15 +344,27 @@ class GenerateDynamicTiles(object):
 
     # -------------------------------------------------------------------------
 
-    def __init__(self,querystring,fs):
+    def __init__(self,querystring,fs,environ=None):
         """Constructor function - initialization"""
 
+        # CGI environment of the request (for the request headers)
+        if environ is None:
+            environ = os.environ
+        self.environ = environ
+
         self.tilesize = 256
         self.tileext = 'png'
+        # Memory used by the intermediate results of the last generated tile (see account_memory)
+        self.tile_memory = 0
+        self.tile_memory_lock = threading.Lock()
         
         # Get the arguments from the query string
         self.url = self.parse_custom_querystring(querystring,'url','')
         self.clrfile = self.parse_custom_querystring(querystring,'clrfile','')
+        if 'clrmode' in querystring:
+            self.clrmode = fs['clrmode'].value
+        else:
+            self.clrmode = color_relief.INTERPOLATE
         self.bgurl = self.parse_custom_querystring(querystring,'bgurl','')
         self.shpfile = self.parse_custom_querystring(querystring,'shpfile','')
             
@@ -384,6 +378,12 @@ class GenerateDynamicTiles(object):
         else:
             self.cachedir = ''
             
+        # Cache layout (dir: one PNG file per tile, mbtiles: a single SQLite file)
+        if 'cachetype' in querystring:
+            self.cachetype = fs['cachetype'].value
+        else:
+            self.cachetype = 'dir'
+            
         if 'resample' in querystring:
             self.resample = fs['resample'].value
         else:
@@ -398,6 +398,18 @@ class GenerateDynamicTiles(object):
             self.outsideMask = True
         else:
             self.outsideMask = False
+            
+        # Render local data sources in blocks of metatile x metatile tiles (see render_block)
+        if 'metatile' in querystring:
+            self.metatile = max(1, int(fs['metatile'].value))
+        else:
+            self.metatile = 1
+            
+        # Make tiles from their four cached child tiles when they exist, with this GDAL resampling method (see downsample_tiles)
+        if 'downsample' in querystring:
+            self.downsample = fs['downsample'].value
+        else:
+            self.downsample = ''
         
         self.profile = 'mercator'
         
@@ -417,10 +429,98 @@ class GenerateDynamicTiles(object):
             self.tileswne = self.mercator.TileLatLonBounds
             
     # -------------------------------------------------------------------------
-    def generate_tiles(self):
+    def layer_params(self):
+        """
+        The parameters that determine how the tiles of this layer are rendered, as a list of
+        (name, value) pairs: the query string options that are in effect, plus the modification
+        time and size of every local file that is read (including the files listed in a .pyr file)
+        """
+        params = [('url', self.url), ('resample', self.resample)]
+        if self.clrfile != '':
+            params += [('clrfile', self.clrfile), ('clrmode', self.clrmode)]
+        if self.bgurl != '':
+            params += [('bgurl', self.bgurl), ('blend', self.blend)]
+        if self.shpfile != '':
+            params += [('shpfile', self.shpfile)]
+        params += [('outsideMask', self.outsideMask), ('tilesize', self.tilesize)]
+        if self.downsample != '':
+            params += [('downsample', self.downsample)]
+
+        files = [self.clrfile, self.shpfile]
+        for url in (self.url, self.bgurl):
+            if url != '' and url.find('{$z}') <= -1:
+                files.append(url)
+                if url.find('.pyr') >= 0 and os.path.exists(url):
+                    files.extend(pyramid_files.get_pyramid(url).paths())
+        for filename in files:
+            if filename != '' and os.path.exists(filename):
+                st = os.stat(filename)
+                params.append(('file:' + filename, '%d-%d' % (st.st_mtime, st.st_size)))
+        return params
+
+    # -------------------------------------------------------------------------
+    def tile_y2(self, tz, ty):
+        """The y coordinate of a (TMS) tile in the web tile urls"""
+
+        # In case of inverted y coordinate
+        if self.invert_y:
+            return ty
+        else:
+            return (2**tz)-ty-1
+
+    # -------------------------------------------------------------------------
+    def metatile_block(self, tz, tx, ty):
+        """
+        The block of tiles (tx0, ty0, nx, ny) that a tile is rendered with: its metatile for
+        local data sources (when the tiles are cached), or only the tile itself
+        """
+        if self.metatile > 1 and self.url.find('{$z}') <= -1 and self.cachedir != '':
+            n = min(self.metatile, 2**tz)
+            tx0, ty0 = tx - tx % n, ty - ty % n
+            return tx0, ty0, min(n, 2**tz - tx0), min(n, 2**tz - ty0)
+        return tx, ty, 1, 1
+
+    # -------------------------------------------------------------------------
+    def not_modified(self, etag, mtime):
+        """Whether the client's copy of a cached tile (from a conditional request) is still current"""
+
+        # Python's CGIHTTPServer (threading_server8090.py) sends its own status line, so it can't send a 304
+        if self.environ.get('SERVER_SOFTWARE', '').startswith('SimpleHTTP'):
+            return False
+        if_none_match = self.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [e.strip() for e in if_none_match.split(',')]
+        if_modified_since = self.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            return since is not None and mtime <= email.utils.mktime_tz(since)
+        return False
+
+    # -------------------------------------------------------------------------
+    def send_cached_tile(self, tile, out):
+        """
+        Write a cached tile as it is stored (without decoding it), or only a 304 status
+        if the client already has the current version of the tile
+        """
+        if self.not_modified(tile.etag, tile.mtime):
+            print >>out, "Status: 304 Not Modified"
+            print >>out, "ETag: %s" % tile.etag
+            print >>out, "Last-Modified: %s\n" % email.utils.formatdate(tile.mtime, usegmt=True)
+            return
+        png = tile.read()
+        print >>out, "Content-type: image/png"
+        print >>out, "Content-Length: %d" % len(png)
+        print >>out, "ETag: %s" % tile.etag
+        print >>out, "Last-Modified: %s" % email.utils.formatdate(tile.mtime, usegmt=True)
+        print >>out, "X-Cache: HIT\n"
+        out.write(png)
+
+    # -------------------------------------------------------------------------
+    def generate_tiles(self, out=sys.stdout):
         """
         Function to generate the dynamic tiles (either merging multiple web tile 
-        sources and/or extracting data from a local GIS data source
+        sources and/or extracting data from a local GIS data source.  The tile is
+        written to out (stdout when run as a CGI script)
         """ 
         tz = int(self.tz)
         tx = int(self.tx)
@@ -428,156 +528,250 @@ class GenerateDynamicTiles(object):
         
         # For Debugging Purposes (enter the text in the Link field of the network link into a web browser)
         #print 'Content-Type: text/html\n'
-        
-        # In case of inverted y coordinate
-        if self.invert_y:
-            ty2 = ty
-        else:
-            if type(ty) is int:
-                ty2 = (2**tz)-ty-1
-            else:
-                ty2 = ty
  
-        # Tile name used if tile is cached
-        tilefilename = os.path.join('dynamic_tiles',self.cachedir, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
+        # Look for the tile in the cache (if specified)
+        params = self.layer_params()
+        cache = None
+        cached_tile = None
+        if self.cachedir != '':
+            # Each combination of rendering parameters and source files is cached as a separate layer
+            cache = tile_cache.get_cache(self.cachedir, self.cachetype, tile_cache.layer_key(params), params)
+            cached_tile = cache.get(tz, tx, ty)
         
-        if not os.path.exists(tilefilename):
-            south, west, north, east = self.tileswne(tx, ty, tz)
-
-            # Generate the temp file names (only required temporary files for the requested configuration will be created)
-            import tempfile
-            tempfilename_web = tempfile.mktemp('-generate_dynamic_tiles_web.tif')
-            tempfilename_shp = tempfile.mktemp('-generate_dynamic_tiles.shp')
-            tempfilename = tempfile.mktemp('-generate_dynamic_tiles.tif')
-            tempfilename2 = tempfile.mktemp('-generate_dynamic_tiles2.tif')
-            tempfilename3 = tempfile.mktemp('-generate_dynamic_tiles3.tif')
+        if cached_tile is None:
+            # Concurrent requests for the same tile, or for tiles of the same metatile (e.g. from several
+            # network links), wait for a single render
+            block = self.metatile_block(tz, tx, ty)
+            key = (tile_cache.layer_key(params), self.cachedir, self.cachetype, tz) + block
+            (tiles, tile_memory), shared = tile_cache.renders.do(key, self.render_block, tz, block, cache)
+            png, cached_tile = tiles[(tx, ty)]
             
-            raster_url = self.url
+            # and return the image (along with the peak memory used to generate it)
+            print >>out, "Content-type: image/png"
+            print >>out, "Content-Length: %d" % len(png)
+            if cached_tile is not None:
+                print >>out, "ETag: %s" % cached_tile.etag
+                print >>out, "Last-Modified: %s" % email.utils.formatdate(cached_tile.mtime, usegmt=True)
+                print >>out, "X-Cache: %s" % ('COALESCED' if shared else 'MISS')
+            print >>out, "X-Tile-Memory: %d\n" % tile_memory
+            out.write(png)
+        else:
+        # else return the cached tile
+            self.send_cached_tile(cached_tile, out)
             
-            if raster_url.find('{$z}') <= -1:
-                if raster_url.find('.pyr') >= 0:
-                    file = open(raster_url,'r')
-                    done = False
-                    while done == False:
-                        zoom, fname = file.readline().split(' ')
-                        if tz <= int(zoom):
-                            done = True
-                    
-                    raster_url = raster_url.replace(os.path.basename(raster_url),fname.strip())
-                    file.close()
-                
-                command = 'gdalwarp -r ' + self.resample + ' -dstalpha -ovr AUTO -overwrite -t_srs "+proj=latlong +datum=wgs84 +nodefs" -ts ' + str(self.tilesize) + ' ' + str(self.tilesize) + ' -te ' + str(west) + ' ' + str(south) + ' ' + str(east) + ' ' + str(north) + ' "' + raster_url + '" ' + tempfilename
-                subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'))
-            else:
-                raster_url = raster_url.replace('{$x}', str(tx))
-                raster_url = raster_url.replace('{$y}', str(ty2))
-                raster_url = raster_url.replace('{$invY}', str(ty2))
-                raster_url = raster_url.replace('{$z}', str(tz))
-                urllib.urlretrieve(raster_url,tempfilename_web)
-                im = Image.open(tempfilename_web).convert('RGBA')
-                im.save(tempfilename_web, "PNG")
-                command = 'gdal_translate -a_srs "+proj=latlong +datum=wgs84 +nodefs" -a_ullr ' + str(west) + ' ' + str(north) + ' ' + str(east) + ' ' + str(south) + ' "' + tempfilename_web + '" ' + tempfilename
-                subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb')) 
-               
-            if self.clrfile != '':
-                mask_i = gdalnumeric.LoadFile(tempfilename)
-                mask_i = (mask_i[1,:,:] != 0)
-                command = 'gdaldem color-relief -alpha ' + tempfilename + ' "' + self.clrfile + '" ' + tempfilename2
-                subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'))
+    # -------------------------------------------------------------------------
+    def uniform_tile(self, tz, tx, ty, color, cache):
+        """
+        A tile of a single color (with the shared PNG of the color, see uniform_png), which is stored
+        in the cache (if specified) as a reference to the PNG, where the cache supports it.  Returns
+        the PNG data and the CachedTile (or None)
+        """
+        png = uniform_png(color, self.tilesize)
+        cached_tile = None
+        if cache is not None:
+            cached_tile = cache.put_shared(tz, tx, ty, png, 'rgba-%02x%02x%02x%02x' % color)
+        return png, cached_tile
+
+    # -------------------------------------------------------------------------
+    def render_block(self, tz, block, cache, refresh=False):
+        """
+        Render a block of nx by ny tiles starting at tile (tx0, ty0) (a metatile, or a single tile) and save
+        them in the cache (if specified).  Returns {(tx, ty): (PNG data, CachedTile or None)} and the memory used.
+        Unless refresh is set, the tiles aren't rendered again if they are all in the cache already
+        """
+        tx0, ty0, nx, ny = block
+        members = [(tx, ty) for ty in range(ty0, ty0+ny) for tx in range(tx0, tx0+nx)]
+        if cache is not None and not refresh:
+            # Rendered by another request since this one looked in the cache
+            cached_tiles = [cache.lookup(tz, tx, ty) for tx, ty in members]
+            if None not in cached_tiles:
+                return dict((member, (tile.read(), tile)) for member, tile in zip(members, cached_tiles)), 0
+
+        # All intermediate results are kept in memory (as images or MEM datasets), no temporary files are created
+        self.tile_memory = 0
+        
+        if self.downsample != '' and cache is not None:
+            tiles = self.downsample_tiles(tz, members, cache)
+            if tiles is not None:
+                return tiles, self.tile_memory
+        
+        # The rows of tiles, from north to south, with their extents.  The rows of pixels of a tile are evenly
+        # spaced in latitude, but the tiles (in mercator) are not, so each row of tiles is warped separately
+        # (and then stacked), and all of the other steps are done once for the whole block
+        strips = []
+        for ty in range(ty0+ny-1, ty0-1, -1):
+            south, west, north, east = self.tileswne(tx0, ty, tz)
+            east = self.tileswne(tx0+nx-1, ty, tz)[3]
+            strips.append((ty, west, south, east, north))
+        
+        # Start acquiring the background image right away, so that it is fetched (or warped)
+        # at the same time as the foreground
+        if self.bgurl != '':
+            backgrounds = [source_pool().apply_async(self.background_image, (tz, tx0, nx, strip)) for strip in strips]
+        
+        raster_url = self.url
+        
+        if raster_url.find('{$z}') <= -1:
+            raster_url = self.local_dataset(raster_url, tz, (strips[0][1], strips[-1][2], strips[0][3], strips[0][4]))
+            
+            if raster_url is not None:
+                parts = [self.account_memory(self.warp_tile(raster_url, west, south, east, north, True, nx*self.tilesize))
+                         for ty, west, south, east, north in strips]
+                ds = self.stackDatasets(parts)
+                if len(parts) > 1:
+                    self.account_memory(ds)
             else:
-                tempfilename2 = tempfilename
-                mask_i = gdalnumeric.LoadFile(tempfilename2)
-                mask_i = (mask_i[3,:,:] != 0)
-                
-            if self.shpfile != '':
-                shapefilename = self.shpfile
-                path, file = os.path.split(shapefilename)
-                layername = file.replace('.shp','')
-                command = 'gdal_rasterize -b 4 -burn 0 -l ' + layername + ' "' + shapefilename + '" ' + tempfilename2
-                subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'))
-                
-            if self.bgurl != '':
+                # No dataset covers the tiles (the same as warping a dataset outside of its extent)
+                ds = gdal.GetDriverByName('MEM').Create('', nx*self.tilesize, ny*self.tilesize, 2 if self.clrfile != '' else 4, GDT_Byte)
+                ds = self.account_memory(ds)
+        else:
+            ty, west, south, east, north = strips[0]
+            raster_url = raster_url.replace('{$x}', str(tx0))
+            raster_url = raster_url.replace('{$y}', str(self.tile_y2(tz, ty)))
+            raster_url = raster_url.replace('{$invY}', str(self.tile_y2(tz, ty)))
+            raster_url = raster_url.replace('{$z}', str(tz))
+            im = self.account_memory(self.download_tile(raster_url))
+            ds = self.account_memory(self.imageToDataset(im, west, south, east, north))
+           
+        # The warped dataset stays in memory, so the following steps work on it directly rather than using the gdal utility programs
+        if self.clrfile != '':
+            mask_i = (ds.GetRasterBand(2).ReadAsArray() != 0)
+        else:
+            mask_i = (ds.GetRasterBand(4).ReadAsArray() != 0)
+
+        # If there is no data at all (e.g. outside of the dataset, or only nodata), the tiles are transparent,
+        # and nothing else needs to be done
+        if not mask_i.any():
+            return dict(((tx, ty), self.uniform_tile(tz, tx, ty, TRANSPARENT, cache)) for tx, ty in members), self.tile_memory
+
+        if self.clrfile != '':
+            # Color the elevation band with numpy (the .clr file is only parsed once)
+            band = ds.GetRasterBand(1)
+            relief = color_relief.get_color_relief(self.clrfile, self.clrmode)
+            rgba = relief.colorize(band.ReadAsArray(), band.GetNoDataValue())
+            ds2 = self.account_memory(self.arraysToDataset(rgba, ds))
+        else:
+            ds2 = ds
             
-                bgurl_url = self.bgurl
-                
-                if bgurl_url.find('{$z}') <= -1:
-                    if bgurl_url.find('.pyr') >= 0:
-                        file = open(bgurl_url,'r')
-                        done = False
-                        while done == False:
-                            zoom, fname = file.readline().split(' ')
-                            if tz <= int(zoom):
-                                done = True
-                            
-                        bgurl_url = bgurl_url.replace(os.path.basename(bgurl_url),fname.strip())
-                        file.close()
-                    
-                    command = 'gdalwarp  -r ' + self.resample + ' -ovr AUTO -overwrite -t_srs "+proj=latlong +datum=wgs84 +nodefs" -ts ' + str(self.tilesize) + ' ' + str(self.tilesize) + ' -te ' + str(west) + ' ' + str(south) + ' ' + str(east) + ' ' + str(north) + ' "' + bgurl_url + '" ' + tempfilename3
-                    subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'))
+        if self.shpfile != '':
+            # Burn 0 into the alpha band where the tile is inside the polygons of the shapefile (only the
+            # polygons that overlap the tile are rasterized, and not at all if the tile is entirely inside or outside)
+            shapes = shape_mask.get_shape_mask(self.shpfile, TILE_SRS_WKT)
+            alpha = None
+            for i, (ty, west, south, east, north) in enumerate(strips):
+                inside = shapes.tile_mask(west, south, east, north, ds2.RasterXSize, self.tilesize)
+                if inside is None:
+                    continue
+                if alpha is None:
+                    alpha = ds2.GetRasterBand(4).ReadAsArray()
+                if inside is True:
+                    alpha[i*self.tilesize:(i+1)*self.tilesize] = 0
                 else:
-                    bgurl_url = bgurl_url.replace('{$x}', str(tx))
-                    bgurl_url = bgurl_url.replace('{$y}', str(ty2))
-                    bgurl_url = bgurl_url.replace('{$invY}', str(ty2))
-                    bgurl_url = bgurl_url.replace('{$z}', str(tz))
-                        
-                    urllib.urlretrieve(bgurl_url,tempfilename_web)
-                    im = Image.open(tempfilename_web).convert('RGBA')
-                    im.save(tempfilename_web, "PNG")
-                    command = 'gdal_translate -a_srs "+proj=latlong +datum=wgs84 +nodefs" -a_ullr ' + str(west) + ' ' + str(north) + ' ' + str(east) + ' ' + str(south) + ' "' + tempfilename_web + '" ' + tempfilename3
-                    subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb')) 
+                    alpha[i*self.tilesize:(i+1)*self.tilesize][inside] = 0
+            if alpha is not None:
+                ds2.GetRasterBand(4).WriteArray(alpha)
+
+        # The alpha band of the tiles (before blending, so that the tiles that the mask leaves nothing
+        # of don't need to be blended or encoded either)
+        mask = ds2.GetRasterBand(4).ReadAsArray()
+        if self.outsideMask == True:
+            mask = mask_i * (mask == 0) * 255
+        else:
+            mask = mask_i * (mask != 0) * 255
+        if not mask.any():
+            return dict(((tx, ty), self.uniform_tile(tz, tx, ty, TRANSPARENT, cache)) for tx, ty in members), self.tile_memory
             
-                dem_image = Image.open(tempfilename2).convert('RGBA')
-                shaded_relief = Image.open(tempfilename3).convert('RGBA')
-                
-                im = Image.blend(dem_image, shaded_relief, float(self.blend))
-            else:
-                im = Image.open(tempfilename2)
+        if self.bgurl != '':
+        
+            # Wait for the background image
+            shaded_relief = self.stackImages([background.get() for background in backgrounds])
+            if len(backgrounds) > 1:
+                self.account_memory(shaded_relief)
+        
+            dem_image = self.account_memory(self.datasetToImage(ds2).convert('RGBA'))
             
-            r,g,b,a2 = im.split()
-            mask = gdalnumeric.LoadFile(tempfilename2)
-            mask = mask[3,:,:]
-            if self.outsideMask == True:
-                mask = mask_i * (mask == 0) * 255
+            im = self.account_memory(Image.blend(dem_image, shaded_relief, float(self.blend)))
+        else:
+            im = self.account_memory(self.datasetToImage(ds2))
+        
+        r,g,b,a2 = im.split()
+        a = self.arrayToImage(mask)
+        im = self.account_memory(Image.merge("RGBA", (r,g,b,a)))
+
+        #print "%.8f" % (time.time()-start)            
+
+        # Encode each tile once (for both the cache and the response), and if specified, save a copy of it in the cache.
+        # Tiles without data, or of a single color, share one PNG for each color instead
+        tiles = {}
+        for tx, ty in members:
+            left = (tx - tx0) * self.tilesize
+            top = (ty0 + ny - 1 - ty) * self.tilesize
+            if not mask[top:top + self.tilesize, left:left + self.tilesize].any():
+                tiles[(tx, ty)] = self.uniform_tile(tz, tx, ty, TRANSPARENT, cache)
+                continue
+            if len(members) > 1:
+                tile_im = im.crop((left, top, left + self.tilesize, top + self.tilesize))
             else:
-                mask = mask_i * (mask != 0) * 255
-            a = self.arrayToImage(mask)
-            im = Image.merge("RGBA", (r,g,b,a))
-
-            #print "%.8f" % (time.time()-start)            
-
-            # If specified, save a copy of the cached image
-            if self.cachedir != '':
-                if not os.path.exists(os.path.dirname(tilefilename)):
-                   os.makedirs(os.path.dirname(tilefilename))
-                im.save(tilefilename, "PNG")
-            
-            # and return the image
+                tile_im = im
+            pixels = numpy.asarray(tile_im)
+            if (pixels == pixels[0, 0]).all():
+                tiles[(tx, ty)] = self.uniform_tile(tz, tx, ty, tuple(int(v) for v in pixels[0, 0]), cache)
+                continue
             f = cStringIO.StringIO()
-            im.save(f, "PNG")
-            f.seek(0)
-            print "Content-type: image/png\n"
-            print f.read()
+            tile_im.save(f, "PNG")
+            png = self.account_memory(f.getvalue())
+            cached_tile = None
+            if cache is not None:
+                cached_tile = cache.put(tz, tx, ty, png)
+            tiles[(tx, ty)] = (png, cached_tile)
+        return tiles, self.tile_memory
+            
+    # -------------------------------------------------------------------------
+    def downsample_tiles(self, tz, members, cache):
+        """
+        Make tiles from their four child tiles (at zoom tz+1) in the cache, which is much cheaper than
+        reading the data sources at low zoom levels.  The children are georeferenced to their extents
+        and warped to the extent of the parent tile (rather than only halved, as the rows of pixels of a
+        tile are evenly spaced in latitude, but the tiles are not).  Returns the tiles as render_block
+        does, or None if any of the children isn't cached
+        """
+        children = {}
+        for tx, ty in members:
+            for cx, cy in [(2*tx, 2*ty), (2*tx+1, 2*ty), (2*tx, 2*ty+1), (2*tx+1, 2*ty+1)]:
+                children[(cx, cy)] = cache.lookup(tz+1, cx, cy)
+                if children[(cx, cy)] is None:
+                    return None
+
+        transparent = uniform_png(TRANSPARENT, self.tilesize)
+        tiles = {}
+        for tx, ty in members:
+            quad = [(2*tx, 2*ty), (2*tx+1, 2*ty), (2*tx, 2*ty+1), (2*tx+1, 2*ty+1)]
+            # The parent of four tiles without data has no data either
+            if all(children[child].read() == transparent for child in quad):
+                tiles[(tx, ty)] = self.uniform_tile(tz, tx, ty, TRANSPARENT, cache)
+                continue
+            child_datasets = []
+            for cx, cy in [(2*tx, 2*ty), (2*tx+1, 2*ty), (2*tx, 2*ty+1), (2*tx+1, 2*ty+1)]:
+                data = self.account_memory(children[(cx, cy)].read())
+                im = self.account_memory(Image.open(cStringIO.StringIO(data)).convert('RGBA'))
+                south, west, north, east = self.tileswne(cx, cy, tz+1)
+                child_ds = self.account_memory(self.imageToDataset(im, west, south, east, north))
+                child_ds.GetRasterBand(4).SetColorInterpretation(GCI_AlphaBand)
+                child_datasets.append(child_ds)
+            south, west, north, east = self.tileswne(tx, ty, tz)
+            options = ['-r', self.downsample, '-t_srs', TILE_SRS, '-srcalpha', '-dstalpha',
+                       '-ts', str(self.tilesize), str(self.tilesize),
+                       '-te', str(west), str(south), str(east), str(north)]
+            ds = gdal.Warp('', child_datasets, options=gdal.WarpOptions(options=options, format='MEM'))
+            if ds is None:
+                raise IOError('Could not downsample the children of tile %d/%d/%d' % (tz, tx, ty))
+            im = self.account_memory(self.datasetToImage(self.account_memory(ds)))
             
-            # Remove temporary files
-            if os.path.isfile(tempfilename):
-                os.unlink(tempfilename)
-            if os.path.isfile(tempfilename2):
-                os.unlink(tempfilename2)
-            if os.path.isfile(tempfilename3):
-                os.unlink(tempfilename3)
-            if os.path.isfile(tempfilename_web):
-                os.unlink(tempfilename_web) 
-            if os.path.isfile(tempfilename_shp):
-                os.unlink(tempfilename_shp)  
-            #print "%.8f" % (time.time()-start)
-        else:
-        # else return the cached file
-            im = Image.open(tilefilename)
             f = cStringIO.StringIO()
             im.save(f, "PNG")
-            f.seek(0)
-            print "Content-type: image/png\n"
-            print f.read()
+            png = self.account_memory(f.getvalue())
+            tiles[(tx, ty)] = (png, cache.put(tz, tx, ty, png))
+        return tiles
             
 ###############################################################################
 
@@ -27,10 +27,12 @@
 
 import os, sys
 import cgi
-import subprocess
 from random import randint
 import re
 import urllib
+import zlib
+import zipfile
+import cStringIO
 import kml_for_tiles
  
 ################################ MODIFY THESE ################################
@@ -44,10 +46,75 @@ transparentpng = 'http://localhost:8080/static/transparent.png'
 
 ##############################################################################
 
-# For Debugging Purposes (enter the text in the Link field of the network link into a web browser)
-#print 'Content-Type: text/html\n'
-print 'Content-Type: text/xml\n'
-#print 'Content-Type: application/vnd.google-earth.kml+xml\n'
+# Compression level of gzip encoded KML (1-9, the same as in KMZ files by default)
+GZIP_LEVEL = 6
+
+###############################################################################
+
+class GzipWriter(object):
+    """
+    File-like object that gzip compresses what is written to it, and writes it to out
+    (so that a KML document is still written out as it is made)
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        data = self.compressor.compress(data)
+        if data:
+            self.out.write(data)
+
+    def close(self):
+        self.out.write(self.compressor.flush())
+
+###############################################################################
+
+class KMZWriter(object):
+    """
+    File-like object that collects a KML document, and writes it to out as a KMZ file
+    (a zip file containing doc.kml) when closed
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.kml = cStringIO.StringIO()
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        self.kml.write(data)
+
+    def close(self):
+        kmz = cStringIO.StringIO()
+        zf = zipfile.ZipFile(kmz, 'w', zipfile.ZIP_DEFLATED)
+        zf.writestr('doc.kml', self.kml.getvalue())
+        zf.close()
+        self.out.write(kmz.getvalue())
+
+###############################################################################
+
+# -------------------------------------------------------------------------
+def accepts_gzip(environ):
+    """Whether the client accepts gzip encoded responses (from the Accept-Encoding request header)"""
+
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.strip().split(';')
+        if params[0].strip().lower() in ('gzip', 'x-gzip'):
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
 
 # -------------------------------------------------------------------------
 def parse_custom_querystring(querystring, key_str, default_val ):
@@ -92,155 +159,156 @@ def parse_custom_querystring(querystring, key_str, default_val ):
     return key_val
 
 # -------------------------------------------------------------------------
+def write_kml(out, pieces):
+    """
+    Write a KML document to out as it is made (pieces from KMLForTiles.iter_kml), instead of
+    making the whole document first
+    """
+    for piece in pieces:
+        out.write(piece)
+    out.write('\n')
+
+# -------------------------------------------------------------------------
+def generate_kml(querystring, fs, out=sys.stdout, environ=None):
+    """
+    Write the KML for the request described by querystring (and its parsed version, fs) to out
+    (stdout when run as a CGI script, or the response of the in-process tile server).  With the kmz
+    option, a KMZ file is returned instead, otherwise the KML is gzip compressed if the client accepts it
+    (environ is the CGI environment of the request, for the request headers)
+    """
+    if environ is None:
+        environ = os.environ
 
-# Get the entire query string as well as the parsed version, as in some cases, cgi fieldstorage is fine, but in others, we need a custom function (above) to read a key string (if it may contain ampersands) 
-fs = cgi.FieldStorage()  
-querystring = os.environ.get("QUERY_STRING", "No Query String")
-
-# Get the URL and zoom (the profile just refers to how coordinates are handled within the script)
-url = parse_custom_querystring(querystring,'url','')
-
-if 'zoom=' in querystring:
-    zoom = fs['zoom'].value
-else:
-    zoom = '1-16';
-
-if 'ullr=' in querystring:
-    ullr = fs['ullr'].value
-else:
-    ullr = '-180_90_180_-89.9'; 
-
-profile = 'mercator'
-
-# If already a web tile format ({$z},{$x},{$y} are defined), generate kml for the top level tiles for the region defined by ullr in the querystring (if applicable)
-if ('{$z}' in url):
-    webTiles = 1
-        
-    # Bypass and enter the kml generation script if being called recursively
-    if 'zxy=' in querystring:
-        zxy = fs['zxy'].value
-        tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,zxy,webTiles)
-        print tile_kml.generate_tiles()
+    # (the option is kept in the links to the children, so they are KMZ files as well)
+    if re.search(r'(^|[&;])kmz([&;]|$)', querystring):
+        print >>out, 'Content-Type: application/vnd.google-earth.kmz\n'
+        body = KMZWriter(out)
+    elif accepts_gzip(environ):
+        print >>out, 'Content-Type: text/xml\nContent-Encoding: gzip\nVary: Accept-Encoding\n'
+        body = GzipWriter(out)
     else:
-    # Else if called for the first time, append all children to root kml, and return the result
-        tminz, tmaxz = zoom.split('-')
-        ulx, uly, lrx, lry = ullr.split('_')
-        tminz = int(tminz)
-            
-        if profile == 'mercator':
-            tile_math = kml_for_tiles.GlobalMercator()
-            ominx, omaxy = tile_math.LatLonToMeters(float(uly),float(ulx))
-            omaxx, ominy = tile_math.LatLonToMeters(float(lry),float(lrx))
-            
-            # Generate table with min max tile coordinates for all zoomlevels
-            tminmax = list(range(0,32))
-            for tz in range(0, 32):
-                tminx, tminy = tile_math.MetersToTile( ominx, ominy, tz )
-                tmaxx, tmaxy = tile_math.MetersToTile( omaxx, omaxy, tz )
-                # crop tiles extending world limits (+-180,+-90)
-                tminx, tminy = max(0, tminx), max(0, tminy)
-                tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
-                tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
-            
-        children = []
-        xmin, ymin, xmax, ymax = tminmax[tminz]
-        for x in range(xmin, xmax+1):
-            for y in range(ymin, ymax+1):
-                children.append( [ x, y, tminz ] ) 
-                
-        tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,'0/0/0',webTiles)
-        # Generate Root KML
-        print tile_kml.generate_kml( None, None, None, children)
-
-else:
-# Else, open the raster data source, and figure out its extents and appropriate top level zoom
-    from osgeo import gdal
-    from gdalconst import *
-
-    webTiles = 0
-    checkStatus = False
-
-    # Bypass and enter the kml generation script if being called recursively
-    if 'zxy=' in querystring:
-        zxy = fs['zxy'].value
-        tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,zxy,webTiles)
-        print tile_kml.generate_tiles()
+        # For Debugging Purposes (enter the text in the Link field of the network link into a web browser)
+        #print >>out, 'Content-Type: text/html\n'
+        print >>out, 'Content-Type: text/xml\nVary: Accept-Encoding\n'
+        #print >>out, 'Content-Type: application/vnd.google-earth.kml+xml\n'
+        body = None
+
+    if body is None:
+        generate_kml_document(querystring, fs, out)
     else:
-        # Else if called for the first time, get the raster extents (warping if necessary), and then generate root kml structure as above
-        gdal.AllRegister()
-        
-        import tempfile
-        tempfilename = tempfile.mktemp('-TileOverlay.vrt')
-        
-        # In some cases, a special file should be used to open different maps with different zoom levels.  Here, only open the file for the largest zoom levels
-        if url.find('.pyr') >= 0:
-            file = open(url,'r')
-            zoom, raster_url = file.readline().split(' ')
-            raster_url = url.replace(os.path.basename(url),raster_url.strip())
-            file.close()
+        generate_kml_document(querystring, fs, body)
+        body.close()
+
+# -------------------------------------------------------------------------
+def generate_kml_document(querystring, fs, out):
+    """
+    Write the KML document (without the response headers) to out
+    """
+    # Get the URL and zoom (the profile just refers to how coordinates are handled within the script)
+    url = parse_custom_querystring(querystring,'url','')
+
+    if 'zoom=' in querystring:
+        zoom = fs['zoom'].value
+    else:
+        zoom = '1-16';
+
+    if 'ullr=' in querystring:
+        ullr = fs['ullr'].value
+    else:
+        ullr = '-180_90_180_-89.9'; 
+
+    profile = 'mercator'
+
+    # If already a web tile format ({$z},{$x},{$y} are defined), generate kml for the top level tiles for the region defined by ullr in the querystring (if applicable)
+    if ('{$z}' in url):
+        webTiles = 1
+
+        # Bypass and enter the kml generation script if being called recursively
+        if 'zxy=' in querystring:
+            zxy = fs['zxy'].value
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,zxy,webTiles)
+            write_kml(out, tile_kml.iter_tiles())
         else:
-            raster_url = url
-        
-        # Warp to WGS84 to ensure that dataset bounds are read correctly
-        command = 'gdalwarp -t_srs "+proj=latlong +datum=wgs84 +nodefs" -of vrt "' + raster_url + '" ' + tempfilename
-        subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'))
-        
-        ds = gdal.Open(tempfilename, GA_ReadOnly)
-        if ds is None:
-            print 'Content-Type: text/html\n'
-            print 'Could not open raster'
-            sys.exit(1)
-            
-        tilesize = 256
-        rows = ds.RasterYSize
-        cols = ds.RasterXSize
-        transform = ds.GetGeoTransform()
-        ulx = transform[0]
-        uly = transform[3]
-        pixelWidth = transform[1]
-        pixelHeight = transform[5]
-        lrx = ulx + (cols * pixelWidth)
-        lry = uly + (rows * pixelHeight)
-        
-        del ds
-        os.unlink(tempfilename)
-
-        uly = min(uly,89.9)
-        lry = max(lry,-89.9)
-        ulx = max(ulx,-180)
-        lrx - min(lrx,180)
-
-        ullr = str(ulx) + '_' + str(uly) + '_' + str(lrx) + '_' + str(lry)
-            
-        if profile == 'mercator':
-            tile_math = kml_for_tiles.GlobalMercator()
-            ominx, omaxy = tile_math.LatLonToMeters(float(uly),float(ulx))
-            omaxx, ominy = tile_math.LatLonToMeters(float(lry),float(lrx))
-            pixelWidth = (omaxx - ominx) / cols
-            
-            # Generate table with min max tile coordinates for all zoomlevels
-            tminmax = list(range(0,32))
-            for tz in range(0, 32):
-                tminx, tminy = tile_math.MetersToTile( ominx, ominy, tz )
-                tmaxx, tmaxy = tile_math.MetersToTile( omaxx, omaxy, tz )
-                # crop tiles extending world limits (+-180,+-90)
-                tminx, tminy = max(0, tminx), max(0, tminy)
-                tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
-                tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
-            
-        tminz = tile_math.ZoomForPixelSize( pixelWidth * max( cols, rows) / float(tilesize) )
-        
-        if 'zoom=' in querystring:
-            zoom = fs['zoom'].value
+        # Else if called for the first time, append all children to root kml, and return the result
+            tminz, tmaxz = zoom.split('-')
+            ulx, uly, lrx, lry = ullr.split('_')
+            tminz = int(tminz)
+
+            if profile == 'mercator':
+                # Min max tile coordinates for all zoomlevels (computed when needed, and shared between requests)
+                tminmax = kml_for_tiles.region_tiles(ullr)
+
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,'0/0/0',webTiles)
+            # (the children are made as they are written out, there can be many of them, and those without data are left out)
+            children = ( [ x, y, tminz ] for x, y in tminmax[tminz] if tile_kml.covers(x, y, tminz) )
+
+            # Generate Root KML
+            write_kml(out, tile_kml.iter_kml( None, None, None, children))
+
+    else:
+    # Else, open the raster data source, and figure out its extents and appropriate top level zoom
+
+        webTiles = 0
+        checkStatus = False
+
+        # Bypass and enter the kml generation script if being called recursively
+        if 'zxy=' in querystring:
+            zxy = fs['zxy'].value
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,zxy,webTiles)
+            write_kml(out, tile_kml.iter_tiles())
         else:
-            zoom = str(tminz) + '-32'
-        
-        children = []
-        xmin, ymin, xmax, ymax = tminmax[tminz]
-        for x in range(xmin, xmax+1):
-            for y in range(ymin, ymax+1):
-                children.append( [ x, y, tminz ] ) 
-                
-        tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,'0/0/0',webTiles)
-        # Generate Root KML
-        print tile_kml.generate_kml( None, None, None, children)
+            # Else if called for the first time, get the raster extents (in WGS84), and then generate root kml structure as above
+            import raster_sources
+
+            # In some cases, a special file should be used to open different maps with different zoom levels.  Here, only open the file for the largest zoom levels
+            if url.find('.pyr') >= 0:
+                import pyramid_files
+                raster_url = pyramid_files.get_pyramid(url).entries[0].path
+            else:
+                raster_url = url
+
+            # The bounds of the dataset in WGS84 (as if warped with gdalwarp -t_srs "+proj=latlong +datum=wgs84 +nodefs"),
+            # computed once per dataset (and again when the file changes)
+            try:
+                source = raster_sources.get_source(raster_url)
+                ulx, uly, lrx, lry, cols, rows = source.extent('+proj=latlong +datum=wgs84 +nodefs')
+            except IOError:
+                print >>out, 'Could not open raster'
+                return
+
+            tilesize = 256
+
+            uly = min(uly,89.9)
+            lry = max(lry,-89.9)
+            ulx = max(ulx,-180)
+            lrx - min(lrx,180)
+
+            if profile == 'mercator':
+                tile_math = kml_for_tiles.GlobalMercator()
+                # Min max tile coordinates for all zoomlevels (computed when needed, and shared between requests)
+                tminmax = kml_for_tiles.region_tiles((ulx, uly, lrx, lry))
+                pixelWidth = (tminmax.omaxx - tminmax.ominx) / cols
+
+            tminz = tile_math.ZoomForPixelSize( pixelWidth * max( cols, rows) / float(tilesize) )
+
+            if 'zoom=' in querystring:
+                zoom = fs['zoom'].value
+            else:
+                zoom = str(tminz) + '-32'
+
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,'0/0/0',webTiles)
+            # (the children are made as they are written out, there can be many of them, and those without data are left out)
+            children = ( [ x, y, tminz ] for x, y in tminmax[tminz] if tile_kml.covers(x, y, tminz) )
+
+            # Generate Root KML
+            write_kml(out, tile_kml.iter_kml( None, None, None, children))
+
+# -------------------------------------------------------------------------
+
+if __name__=='__main__':
+
+    # Get the entire query string as well as the parsed version, as in some cases, cgi fieldstorage is fine, but in others, we need a custom function (above) to read a key string (if it may contain ampersands) 
+    fs = cgi.FieldStorage()  
+    querystring = os.environ.get("QUERY_STRING", "No Query String")
+
+    generate_kml(querystring, fs)
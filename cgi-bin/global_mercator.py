@@ -0,0 +1,457 @@
+#!/usr/bin/python
+#
+# Coordinate conversions of the TMS Global Mercator tile pyramid (GlobalMercator,
+# from globalmaptiles.py), shared by the KML generator and the dynamic tile
+# generator.  Besides the original methods, which convert one coordinate at a
+# time, there are batch versions (e.g. TileLatLonBoundsArray) which convert numpy
+# arrays of coordinates at once, with the same results.
+#
+# Run directly for a benchmark of the batch methods against the original ones:
+# python global_mercator.py [-n number_of_tiles]
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Portions of this script are modified from Klokan Petr Pridal's gdal2tiles.py
+# script
+#
+from optparse import OptionParser
+import math
+import random
+import time
+
+try:
+    import numpy
+except ImportError:
+    # Only the batch methods need numpy
+    numpy = None
+
+###############################################################################
+
+__doc__globalmaptiles = """
+globalmaptiles.py
+
+Global Map Tiles as defined in Tile Map Service (TMS) Profiles
+==============================================================
+
+Functions necessary for generation of global tiles used on the web.
+It contains classes implementing coordinate conversions for:
+
+  - GlobalMercator (based on EPSG:900913 = EPSG:3785)
+       for Google Maps, Yahoo Maps, Bing Maps compatible tiles
+  - GlobalGeodetic (based on EPSG:4326)
+       for OpenLayers Base Map and Google Earth compatible tiles
+
+More info at:
+
+http://wiki.osgeo.org/wiki/Tile_Map_Service_Specification
+http://wiki.osgeo.org/wiki/WMS_Tiling_Client_Recommendation
+http://msdn.microsoft.com/en-us/library/bb259689.aspx
+http://code.google.com/apis/maps/documentation/overlays.html#Google_Maps_Coordinates
+
+Created by Klokan Petr Pridal on 2008-07-03.
+Google Summer of Code 2008, project KMLForTiles for OSGEO.
+
+In case you use this class in your product, translate it to another language
+or find it usefull for your project please let me know.
+My email: klokan at klokan dot cz.
+I would like to know where it was used.
+
+Class is available under the open-source GDAL license (www.gdal.org).
+"""
+
+MAXZOOMLEVEL = 32
+
+class GlobalMercator(object):
+    """
+    TMS Global Mercator Profile
+    ---------------------------
+
+  Functions necessary for generation of tiles in Spherical Mercator projection,
+  EPSG:900913 (EPSG:gOOglE, Google Maps Global Mercator), EPSG:3785, OSGEO:41001.
+
+  Such tiles are compatible with Google Maps, Bing Maps, Yahoo Maps,
+  UK Ordnance Survey OpenSpace API, ...
+  and you can overlay them on top of base maps of those web mapping applications.
+
+    Pixel and tile coordinates are in TMS notation (origin [0,0] in bottom-left).
+
+    What coordinate conversions do we need for TMS Global Mercator tiles::
+
+         LatLon      <->       Meters      <->     Pixels    <->       Tile
+
+     WGS84 coordinates   Spherical Mercator  Pixels in pyramid  Tiles in pyramid
+         lat/lon            XY in metres     XY pixels Z zoom      XYZ from TMS
+        EPSG:4326           EPSG:900913
+         .----.              ---------               --                TMS
+        /      \     <->     |       |     <->     /----/    <->      Google
+        \      /             |       |           /--------/          QuadTree
+         -----               ---------         /------------/
+       KML, public         WebMapService         Web Clients      TileMapService
+
+    What is the coordinate extent of Earth in EPSG:900913?
+
+      [-20037508.342789244, -20037508.342789244, 20037508.342789244, 20037508.342789244]
+      Constant 20037508.342789244 comes from the circumference of the Earth in meters,
+      which is 40 thousand kilometers, the coordinate origin is in the middle of extent.
+      In fact you can calculate the constant as: 2 * math.pi * 6378137 / 2.0
+      $ echo 180 85 | gdaltransform -s_srs EPSG:4326 -t_srs EPSG:900913
+      Polar areas with abs(latitude) bigger then 85.05112878 are clipped off.
+
+    What are zoom level constants (pixels/meter) for pyramid with EPSG:900913?
+
+      whole region is on top of pyramid (zoom=0) covered by 256x256 pixels tile,
+      every lower zoom level resolution is always divided by two
+      initialResolution = 20037508.342789244 * 2 / 256 = 156543.03392804062
+
+    What is the difference between TMS and Google Maps/QuadTree tile name convention?
+
+      The tile raster itself is the same (equal extent, projection, pixel size),
+      there is just different identification of the same raster tile.
+      Tiles in TMS are counted from [0,0] in the bottom-left corner, id is XYZ.
+      Google placed the origin [0,0] to the top-left corner, reference is XYZ.
+      Microsoft is referencing tiles by a QuadTree name, defined on the website:
+      http://msdn2.microsoft.com/en-us/library/bb259689.aspx
+
+    The lat/lon coordinates are using WGS84 datum, yeh?
+
+      Yes, all lat/lon we are mentioning should use WGS84 Geodetic Datum.
+      Well, the web clients like Google Maps are projecting those coordinates by
+      Spherical Mercator, so in fact lat/lon coordinates on sphere are treated as if
+      the were on the WGS84 ellipsoid.
+
+      From MSDN documentation:
+      To simplify the calculations, we use the spherical form of projection, not
+      the ellipsoidal form. Since the projection is used only for map display,
+      and not for displaying numeric coordinates, we don't need the extra precision
+      of an ellipsoidal projection. The spherical projection causes approximately
+      0.33 percent scale distortion in the Y direction, which is not visually noticable.
+
+    How do I create a raster in EPSG:900913 and convert coordinates with PROJ.4?
+
+      You can use standard GIS tools like gdalwarp, cs2cs or gdaltransform.
+      All of the tools supports -t_srs 'epsg:900913'.
+
+      For other GIS programs check the exact definition of the projection:
+      More info at http://spatialreference.org/ref/user/google-projection/
+      The same projection is degined as EPSG:3785. WKT definition is in the official
+      EPSG database.
+
+      Proj4 Text:
+        +proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0
+        +k=1.0 +units=m +nadgrids=@null +no_defs
+
+      Human readable WKT format of EPGS:900913:
+         PROJCS["Google Maps Global Mercator",
+             GEOGCS["WGS 84",
+                 DATUM["WGS_1984",
+                     SPHEROID["WGS 84",6378137,298.257223563,
+                         AUTHORITY["EPSG","7030"]],
+                     AUTHORITY["EPSG","6326"]],
+                 PRIMEM["Greenwich",0],
+                 UNIT["degree",0.0174532925199433],
+                 AUTHORITY["EPSG","4326"]],
+             PROJECTION["Mercator_1SP"],
+             PARAMETER["central_meridian",0],
+             PARAMETER["scale_factor",1],
+             PARAMETER["false_easting",0],
+             PARAMETER["false_northing",0],
+             UNIT["metre",1,
+                 AUTHORITY["EPSG","9001"]]]
+    """
+
+    def __init__(self, tileSize=256):
+        "Initialize the TMS Global Mercator pyramid"
+        self.tileSize = tileSize
+        self.initialResolution = 2 * math.pi * 6378137 / self.tileSize
+        # 156543.03392804062 for tileSize 256 pixels
+        self.originShift = 2 * math.pi * 6378137 / 2.0
+        # 20037508.342789244
+
+    def LatLonToMeters(self, lat, lon ):
+        "Converts given lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:900913"
+
+        mx = lon * self.originShift / 180.0
+        my = math.log( math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+
+        my = my * self.originShift / 180.0
+        return mx, my
+
+    def MetersToLatLon(self, mx, my ):
+        "Converts XY point from Spherical Mercator EPSG:900913 to lat/lon in WGS84 Datum"
+
+        lon = (mx / self.originShift) * 180.0
+        lat = (my / self.originShift) * 180.0
+
+        lat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
+        return lat, lon
+
+    def PixelsToMeters(self, px, py, zoom):
+        "Converts pixel coordinates in given zoom level of pyramid to EPSG:900913"
+
+        res = self.Resolution( zoom )
+        mx = px * res - self.originShift
+        my = py * res - self.originShift
+        return mx, my
+
+    def MetersToPixels(self, mx, my, zoom):
+        "Converts EPSG:900913 to pyramid pixel coordinates in given zoom level"
+
+        res = self.Resolution( zoom )
+        px = (mx + self.originShift) / res
+        py = (my + self.originShift) / res
+        return px, py
+
+    def PixelsToTile(self, px, py):
+        "Returns a tile covering region in given pixel coordinates"
+
+        tx = int( math.ceil( px / float(self.tileSize) ) - 1 )
+        ty = int( math.ceil( py / float(self.tileSize) ) - 1 )
+        return tx, ty
+
+    def PixelsToRaster(self, px, py, zoom):
+        "Move the origin of pixel coordinates to top-left corner"
+
+        mapSize = self.tileSize << zoom
+        return px, mapSize - py
+
+    def MetersToTile(self, mx, my, zoom):
+        "Returns tile for given mercator coordinates"
+
+        px, py = self.MetersToPixels( mx, my, zoom)
+        return self.PixelsToTile( px, py)
+
+    def TileBounds(self, tx, ty, zoom):
+        "Returns bounds of the given tile in EPSG:900913 coordinates"
+
+        minx, miny = self.PixelsToMeters( tx*self.tileSize, ty*self.tileSize, zoom )
+        maxx, maxy = self.PixelsToMeters( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
+        return ( minx, miny, maxx, maxy )
+
+    def TileLatLonBounds(self, tx, ty, zoom ):
+        "Returns bounds of the given tile in latutude/longitude using WGS84 datum"
+
+        bounds = self.TileBounds( tx, ty, zoom)
+        minLat, minLon = self.MetersToLatLon(bounds[0], bounds[1])
+        maxLat, maxLon = self.MetersToLatLon(bounds[2], bounds[3])
+
+        return ( minLat, minLon, maxLat, maxLon )
+
+    def Resolution(self, zoom ):
+        "Resolution (meters/pixel) for given zoom level (measured at Equator)"
+
+        # return (2 * math.pi * 6378137) / (self.tileSize * 2**zoom)
+        return self.initialResolution / (2**zoom)
+
+    def ZoomForPixelSize(self, pixelSize ):
+        "Maximal scaledown zoom of the pyramid closest to the pixelSize."
+
+        for i in range(MAXZOOMLEVEL):
+            if pixelSize > self.Resolution(i):
+                if i!=0:
+                    return i-1
+                else:
+                    return 0 # We don't want to scale up
+
+    def GoogleTile(self, tx, ty, zoom):
+        "Converts TMS tile coordinates to Google Tile coordinates"
+
+        # coordinate origin is moved from bottom-left to top-left corner of the extent
+        return tx, (2**zoom - 1) - ty
+
+    def QuadTree(self, tx, ty, zoom ):
+        "Converts TMS tile coordinates to Microsoft QuadTree"
+
+        quadKey = ""
+        ty = (2**zoom - 1) - ty
+        for i in range(zoom, 0, -1):
+            digit = 0
+            mask = 1 << (i-1)
+            if (tx & mask) != 0:
+                digit += 1
+            if (ty & mask) != 0:
+                digit += 2
+            quadKey += str(digit)
+
+        return quadKey
+
+    # -------------------------------------------------------------------------
+    # Batch versions of the methods above, for numpy arrays of coordinates (zoom can be a
+    # single zoom level or an array).  The calculations are done in the same order as in
+    # the methods above, so the results are the same (see the benchmark at the bottom)
+
+    def LatLonToMetersArray(self, lat, lon ):
+        "Converts arrays of lat/lon in WGS84 Datum to arrays of XY in Spherical Mercator EPSG:900913"
+
+        lat, lon = _float_array(lat), _float_array(lon)
+        mx = lon * self.originShift / 180.0
+        my = numpy.log( numpy.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+
+        my = my * self.originShift / 180.0
+        return mx, my
+
+    def MetersToLatLonArray(self, mx, my ):
+        "Converts arrays of XY points from Spherical Mercator EPSG:900913 to arrays of lat/lon in WGS84 Datum"
+
+        mx, my = _float_array(mx), _float_array(my)
+        lon = (mx / self.originShift) * 180.0
+        lat = (my / self.originShift) * 180.0
+
+        lat = 180 / math.pi * (2 * numpy.arctan( numpy.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
+        return lat, lon
+
+    def PixelsToMetersArray(self, px, py, zoom):
+        "Converts arrays of pixel coordinates in given zoom level(s) of pyramid to EPSG:900913"
+
+        res = self.ResolutionArray( zoom )
+        mx = px * res - self.originShift
+        my = py * res - self.originShift
+        return mx, my
+
+    def MetersToPixelsArray(self, mx, my, zoom):
+        "Converts arrays of EPSG:900913 coordinates to pyramid pixel coordinates in given zoom level(s)"
+
+        res = self.ResolutionArray( zoom )
+        px = (_float_array(mx) + self.originShift) / res
+        py = (_float_array(my) + self.originShift) / res
+        return px, py
+
+    def PixelsToTileArray(self, px, py):
+        "Returns arrays of the tiles covering the given arrays of pixel coordinates"
+
+        tx = (numpy.ceil( px / float(self.tileSize) ) - 1).astype(numpy.int64)
+        ty = (numpy.ceil( py / float(self.tileSize) ) - 1).astype(numpy.int64)
+        return tx, ty
+
+    def MetersToTileArray(self, mx, my, zoom):
+        "Returns arrays of the tiles for given arrays of mercator coordinates"
+
+        px, py = self.MetersToPixelsArray( mx, my, zoom)
+        return self.PixelsToTileArray( px, py)
+
+    def TileBoundsArray(self, tx, ty, zoom):
+        "Returns arrays of the bounds of the given tiles in EPSG:900913 coordinates"
+
+        tx, ty = _int_array(tx), _int_array(ty)
+        minx, miny = self.PixelsToMetersArray( tx*self.tileSize, ty*self.tileSize, zoom )
+        maxx, maxy = self.PixelsToMetersArray( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
+        return ( minx, miny, maxx, maxy )
+
+    def TileLatLonBoundsArray(self, tx, ty, zoom ):
+        "Returns arrays of the bounds of the given tiles in latitude/longitude using WGS84 datum"
+
+        bounds = self.TileBoundsArray( tx, ty, zoom)
+        minLat, minLon = self.MetersToLatLonArray(bounds[0], bounds[1])
+        maxLat, maxLon = self.MetersToLatLonArray(bounds[2], bounds[3])
+
+        return ( minLat, minLon, maxLat, maxLon )
+
+    def ResolutionArray(self, zoom ):
+        "Resolution (meters/pixel) for given zoom level(s) (measured at Equator)"
+
+        return self.initialResolution / (2**_int_array(zoom))
+
+    def GoogleTileArray(self, tx, ty, zoom):
+        "Converts arrays of TMS tile coordinates to Google Tile coordinates"
+
+        tx, ty, zoom = _int_array(tx), _int_array(ty), _int_array(zoom)
+        return tx, (2**zoom - 1) - ty
+
+    def QuadTreeArray(self, tx, ty, zoom ):
+        "Converts arrays of TMS tile coordinates to an array of Microsoft QuadTree keys"
+
+        tx, ty, zoom = numpy.broadcast_arrays(_int_array(tx), _int_array(ty), _int_array(zoom))
+        shape = tx.shape
+        tx, ty, zoom = tx.ravel(), ty.ravel(), zoom.ravel()
+        ty = (2**zoom - 1) - ty
+        quadKeys = numpy.empty(tx.shape, dtype=object)
+        quadKeys[:] = ''
+        # The keys of each zoom level have the same length, make their digits as one array of characters
+        for z in numpy.unique(zoom[zoom > 0]):
+            level = zoom == z
+            digits = numpy.empty((level.sum(), z), dtype=numpy.uint8)
+            for i in range(z, 0, -1):
+                mask = 1 << (i-1)
+                digits[:, z-i] = ord('0') + ((tx[level] & mask) != 0) + 2 * ((ty[level] & mask) != 0)
+            quadKeys[level] = digits.view('S%d' % z).ravel().astype(str)
+
+        return quadKeys.reshape(shape)
+
+# -------------------------------------------------------------------------
+def _float_array(values):
+    return numpy.asarray(values, dtype=numpy.float64)
+
+def _int_array(values):
+    return numpy.asarray(values, dtype=numpy.int64)
+
+###############################################################################
+
+if __name__=='__main__':
+
+    parser = OptionParser(usage="usage: %prog [options]",
+        description="Benchmark the batch (numpy) methods of GlobalMercator against the original ones, "
+                    "for random tiles (and points), and check that the results are the same")
+    parser.add_option("-n", dest="n", type="int", default=100000, help="number of tiles (default 100000)")
+    parser.add_option("-z", "--zoom", dest="zoom", default="0-20", help="zoom levels of the tiles (default 0-20)")
+    (options, args) = parser.parse_args()
+    if numpy is None:
+        parser.error("numpy is required for the batch methods")
+
+    mercator = GlobalMercator()
+    tminz, tmaxz = [int(z) for z in options.zoom.split('-')]
+    random.seed(0)
+    zooms = [random.randint(tminz, tmaxz) for i in range(options.n)]
+    txs = [random.randint(0, 2**z - 1) for z in zooms]
+    tys = [random.randint(0, 2**z - 1) for z in zooms]
+    lats = [random.uniform(-85, 85) for i in range(options.n)]
+    lons = [random.uniform(-180, 180) for i in range(options.n)]
+    tx, ty, zoom = numpy.array(txs), numpy.array(tys), numpy.array(zooms)
+    lat, lon = numpy.array(lats), numpy.array(lons)
+    mx, my = mercator.LatLonToMetersArray(lat, lon)
+    mxs, mys = mx.tolist(), my.tolist()
+
+    benchmarks = [
+        ('LatLonToMeters', lambda: [mercator.LatLonToMeters(a, o) for a, o in zip(lats, lons)],
+                           lambda: mercator.LatLonToMetersArray(lat, lon)),
+        ('MetersToTile', lambda: [mercator.MetersToTile(x, y, z) for x, y, z in zip(mxs, mys, zooms)],
+                         lambda: mercator.MetersToTileArray(mx, my, zoom)),
+        ('TileLatLonBounds', lambda: [mercator.TileLatLonBounds(x, y, z) for x, y, z in zip(txs, tys, zooms)],
+                             lambda: mercator.TileLatLonBoundsArray(tx, ty, zoom)),
+        ('GoogleTile', lambda: [mercator.GoogleTile(x, y, z) for x, y, z in zip(txs, tys, zooms)],
+                       lambda: mercator.GoogleTileArray(tx, ty, zoom)),
+        ('QuadTree', lambda: [mercator.QuadTree(x, y, z) for x, y, z in zip(txs, tys, zooms)],
+                     lambda: (mercator.QuadTreeArray(tx, ty, zoom),)),
+    ]
+    print "%d tiles, zoom levels %s" % (options.n, options.zoom)
+    print "%-18s %12s %12s %8s  %s" % ('method', 'scalar (s)', 'batch (s)', 'speedup', 'results')
+    for name, scalar, batch in benchmarks:
+        start = time.time()
+        expected = scalar()
+        scalar_time = time.time() - start
+        start = time.time()
+        result = batch()
+        batch_time = time.time() - start
+        # Compare value by value (the batch results are columns, the scalar results are rows)
+        same = [tuple(row) for row in expected] == zip(*[column.tolist() for column in result]) if name != 'QuadTree' \
+            else expected == result[0].tolist()
+        print "%-18s %12.4f %12.4f %7.1fx  %s" % (name, scalar_time, batch_time, scalar_time / max(batch_time, 1e-9),
+                                                  'same' if same else 'DIFFERENT')
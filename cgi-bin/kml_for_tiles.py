@@ -29,259 +29,203 @@
 #
 import math
 import urllib
-import urllib2
 from urlparse import urlparse
+from collections import OrderedDict
+from itertools import islice, chain
+import threading
 import time
 import re
+import tile_fetch
+import global_mercator
+import coverage_index
+from global_mercator import GlobalMercator
+
+# Number of regions (ullr) whose tile ranges are kept (see region_tiles)
+MAX_REGIONS = 256
+# Number of children from which their bounds are computed all at once (with numpy, if it is installed)
+BATCH_CHILDREN = 32
+# Number of children that are written out at a time
+CHILDREN_CHUNK = 256
+# Largest number of zoom levels in one KML document (the depth option)
+MAX_DEPTH = 4
 
 ###############################################################################
 
-__doc__globalmaptiles = """
-globalmaptiles.py
-
-Global Map Tiles as defined in Tile Map Service (TMS) Profiles
-==============================================================
-
-Functions necessary for generation of global tiles used on the web.
-It contains classes implementing coordinate conversions for:
-
-  - GlobalMercator (based on EPSG:900913 = EPSG:3785)
-       for Google Maps, Yahoo Maps, Bing Maps compatible tiles
-  - GlobalGeodetic (based on EPSG:4326)
-       for OpenLayers Base Map and Google Earth compatible tiles
-
-More info at:
-
-http://wiki.osgeo.org/wiki/Tile_Map_Service_Specification
-http://wiki.osgeo.org/wiki/WMS_Tiling_Client_Recommendation
-http://msdn.microsoft.com/en-us/library/bb259689.aspx
-http://code.google.com/apis/maps/documentation/overlays.html#Google_Maps_Coordinates
-
-Created by Klokan Petr Pridal on 2008-07-03.
-Google Summer of Code 2008, project KMLForTiles for OSGEO.
-
-In case you use this class in your product, translate it to another language
-or find it usefull for your project please let me know.
-My email: klokan at klokan dot cz.
-I would like to know where it was used.
-
-Class is available under the open-source GDAL license (www.gdal.org).
-"""
-
-MAXZOOMLEVEL = 32
-
-class GlobalMercator(object):
+class TileRange(object):
     """
-    TMS Global Mercator Profile
-    ---------------------------
-
-  Functions necessary for generation of tiles in Spherical Mercator projection,
-  EPSG:900913 (EPSG:gOOglE, Google Maps Global Mercator), EPSG:3785, OSGEO:41001.
-
-  Such tiles are compatible with Google Maps, Bing Maps, Yahoo Maps,
-  UK Ordnance Survey OpenSpace API, ...
-  and you can overlay them on top of base maps of those web mapping applications.
-
-    Pixel and tile coordinates are in TMS notation (origin [0,0] in bottom-left).
-
-    What coordinate conversions do we need for TMS Global Mercator tiles::
-
-         LatLon      <->       Meters      <->     Pixels    <->       Tile
-
-     WGS84 coordinates   Spherical Mercator  Pixels in pyramid  Tiles in pyramid
-         lat/lon            XY in metres     XY pixels Z zoom      XYZ from TMS
-        EPSG:4326           EPSG:900913
-         .----.              ---------               --                TMS
-        /      \     <->     |       |     <->     /----/    <->      Google
-        \      /             |       |           /--------/          QuadTree
-         -----               ---------         /------------/
-       KML, public         WebMapService         Web Clients      TileMapService
-
-    What is the coordinate extent of Earth in EPSG:900913?
-
-      [-20037508.342789244, -20037508.342789244, 20037508.342789244, 20037508.342789244]
-      Constant 20037508.342789244 comes from the circumference of the Earth in meters,
-      which is 40 thousand kilometers, the coordinate origin is in the middle of extent.
-      In fact you can calculate the constant as: 2 * math.pi * 6378137 / 2.0
-      $ echo 180 85 | gdaltransform -s_srs EPSG:4326 -t_srs EPSG:900913
-      Polar areas with abs(latitude) bigger then 85.05112878 are clipped off.
-
-    What are zoom level constants (pixels/meter) for pyramid with EPSG:900913?
-
-      whole region is on top of pyramid (zoom=0) covered by 256x256 pixels tile,
-      every lower zoom level resolution is always divided by two
-      initialResolution = 20037508.342789244 * 2 / 256 = 156543.03392804062
-
-    What is the difference between TMS and Google Maps/QuadTree tile name convention?
-
-      The tile raster itself is the same (equal extent, projection, pixel size),
-      there is just different identification of the same raster tile.
-      Tiles in TMS are counted from [0,0] in the bottom-left corner, id is XYZ.
-      Google placed the origin [0,0] to the top-left corner, reference is XYZ.
-      Microsoft is referencing tiles by a QuadTree name, defined on the website:
-      http://msdn2.microsoft.com/en-us/library/bb259689.aspx
-
-    The lat/lon coordinates are using WGS84 datum, yeh?
-
-      Yes, all lat/lon we are mentioning should use WGS84 Geodetic Datum.
-      Well, the web clients like Google Maps are projecting those coordinates by
-      Spherical Mercator, so in fact lat/lon coordinates on sphere are treated as if
-      the were on the WGS84 ellipsoid.
-
-      From MSDN documentation:
-      To simplify the calculations, we use the spherical form of projection, not
-      the ellipsoidal form. Since the projection is used only for map display,
-      and not for displaying numeric coordinates, we don't need the extra precision
-      of an ellipsoidal projection. The spherical projection causes approximately
-      0.33 percent scale distortion in the Y direction, which is not visually noticable.
-
-    How do I create a raster in EPSG:900913 and convert coordinates with PROJ.4?
-
-      You can use standard GIS tools like gdalwarp, cs2cs or gdaltransform.
-      All of the tools supports -t_srs 'epsg:900913'.
-
-      For other GIS programs check the exact definition of the projection:
-      More info at http://spatialreference.org/ref/user/google-projection/
-      The same projection is degined as EPSG:3785. WKT definition is in the official
-      EPSG database.
-
-      Proj4 Text:
-        +proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0
-        +k=1.0 +units=m +nadgrids=@null +no_defs
-
-      Human readable WKT format of EPGS:900913:
-         PROJCS["Google Maps Global Mercator",
-             GEOGCS["WGS 84",
-                 DATUM["WGS_1984",
-                     SPHEROID["WGS 84",6378137,298.257223563,
-                         AUTHORITY["EPSG","7030"]],
-                     AUTHORITY["EPSG","6326"]],
-                 PRIMEM["Greenwich",0],
-                 UNIT["degree",0.0174532925199433],
-                 AUTHORITY["EPSG","4326"]],
-             PROJECTION["Mercator_1SP"],
-             PARAMETER["central_meridian",0],
-             PARAMETER["scale_factor",1],
-             PARAMETER["false_easting",0],
-             PARAMETER["false_northing",0],
-             UNIT["metre",1,
-                 AUTHORITY["EPSG","9001"]]]
+    The tiles of a region at one zoom level (from tminx, tminy to tmaxx, tmaxy, inclusive).
+    Supports (tx, ty) in range, iteration over the (tx, ty) of the tiles (column by column)
+    and len
     """
 
-    def __init__(self, tileSize=256):
-        "Initialize the TMS Global Mercator pyramid"
-        self.tileSize = tileSize
-        self.initialResolution = 2 * math.pi * 6378137 / self.tileSize
-        # 156543.03392804062 for tileSize 256 pixels
-        self.originShift = 2 * math.pi * 6378137 / 2.0
-        # 20037508.342789244
-
-    def LatLonToMeters(self, lat, lon ):
-        "Converts given lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:900913"
-
-        mx = lon * self.originShift / 180.0
-        my = math.log( math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
-
-        my = my * self.originShift / 180.0
-        return mx, my
-
-    def MetersToLatLon(self, mx, my ):
-        "Converts XY point from Spherical Mercator EPSG:900913 to lat/lon in WGS84 Datum"
+    def __init__(self, tz, tminx, tminy, tmaxx, tmaxy):
+        self.tz = tz
+        self.tminx, self.tminy, self.tmaxx, self.tmaxy = tminx, tminy, tmaxx, tmaxy
+        self.bounds = (tminx, tminy, tmaxx, tmaxy)
 
-        lon = (mx / self.originShift) * 180.0
-        lat = (my / self.originShift) * 180.0
+    def __contains__(self, tile):
+        tx, ty = tile
+        return self.tminx <= tx <= self.tmaxx and self.tminy <= ty <= self.tmaxy
 
-        lat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
-        return lat, lon
+    def __iter__(self):
+        for tx in range(self.tminx, self.tmaxx+1):
+            for ty in range(self.tminy, self.tmaxy+1):
+                yield tx, ty
 
-    def PixelsToMeters(self, px, py, zoom):
-        "Converts pixel coordinates in given zoom level of pyramid to EPSG:900913"
+    def __len__(self):
+        return max(0, self.tmaxx - self.tminx + 1) * max(0, self.tmaxy - self.tminy + 1)
 
-        res = self.Resolution( zoom )
-        mx = px * res - self.originShift
-        my = py * res - self.originShift
-        return mx, my
-
-    def MetersToPixels(self, mx, my, zoom):
-        "Converts EPSG:900913 to pyramid pixel coordinates in given zoom level"
-
-        res = self.Resolution( zoom )
-        px = (mx + self.originShift) / res
-        py = (my + self.originShift) / res
-        return px, py
-
-    def PixelsToTile(self, px, py):
-        "Returns a tile covering region in given pixel coordinates"
-
-        tx = int( math.ceil( px / float(self.tileSize) ) - 1 )
-        ty = int( math.ceil( py / float(self.tileSize) ) - 1 )
-        return tx, ty
-
-    def PixelsToRaster(self, px, py, zoom):
-        "Move the origin of pixel coordinates to top-left corner"
-
-        mapSize = self.tileSize << zoom
-        return px, mapSize - py
-
-    def MetersToTile(self, mx, my, zoom):
-        "Returns tile for given mercator coordinates"
-
-        px, py = self.MetersToPixels( mx, my, zoom)
-        return self.PixelsToTile( px, py)
-
-    def TileBounds(self, tx, ty, zoom):
-        "Returns bounds of the given tile in EPSG:900913 coordinates"
-
-        minx, miny = self.PixelsToMeters( tx*self.tileSize, ty*self.tileSize, zoom )
-        maxx, maxy = self.PixelsToMeters( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
-        return ( minx, miny, maxx, maxy )
-
-    def TileLatLonBounds(self, tx, ty, zoom ):
-        "Returns bounds of the given tile in latutude/longitude using WGS84 datum"
-
-        bounds = self.TileBounds( tx, ty, zoom)
-        minLat, minLon = self.MetersToLatLon(bounds[0], bounds[1])
-        maxLat, maxLon = self.MetersToLatLon(bounds[2], bounds[3])
-
-        return ( minLat, minLon, maxLat, maxLon )
+###############################################################################
 
-    def Resolution(self, zoom ):
-        "Resolution (meters/pixel) for given zoom level (measured at Equator)"
+class RegionTiles(object):
+    """
+    The tile ranges of a region (given in degrees) at all zoom levels, region_tiles[tz] is a
+    TileRange.  Each zoom level is only computed when it is first needed
+    """
 
-        # return (2 * math.pi * 6378137) / (self.tileSize * 2**zoom)
-        return self.initialResolution / (2**zoom)
+    def __init__(self, ulx, uly, lrx, lry):
+        self.mercator = GlobalMercator()
+        self.ominx, self.omaxy = self.mercator.LatLonToMeters(uly, ulx)
+        self.omaxx, self.ominy = self.mercator.LatLonToMeters(lry, lrx)
+        self.ranges = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, tz):
+        with self.lock:
+            tile_range = self.ranges.get(tz)
+        if tile_range is None:
+            tminx, tminy = self.mercator.MetersToTile( self.ominx, self.ominy, tz )
+            tmaxx, tmaxy = self.mercator.MetersToTile( self.omaxx, self.omaxy, tz )
+            # crop tiles extending world limits (+-180,+-90)
+            tminx, tminy = max(0, tminx), max(0, tminy)
+            tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
+            tile_range = TileRange(tz, tminx, tminy, tmaxx, tmaxy)
+            with self.lock:
+                self.ranges[tz] = tile_range
+        return tile_range
+
+_regions = OrderedDict()
+_regions_lock = threading.Lock()
+
+def region_tiles(ullr):
+    """
+    The (cached) RegionTiles of a region given as ulx_uly_lrx_lry (as in the ullr option), or as
+    a (ulx, uly, lrx, lry) tuple of degrees, shared by all of the requests for the region
+    """
+    if isinstance(ullr, basestring):
+        ullr = tuple(float(v) for v in ullr.split('_'))
+    with _regions_lock:
+        region = _regions.pop(ullr, None)
+        if region is None:
+            region = RegionTiles(*ullr)
+        _regions[ullr] = region
+        while len(_regions) > MAX_REGIONS:
+            _regions.popitem(last=False)
+    return region
 
-    def ZoomForPixelSize(self, pixelSize ):
-        "Maximal scaledown zoom of the pyramid closest to the pixelSize."
+###############################################################################
 
-        for i in range(MAXZOOMLEVEL):
-            if pixelSize > self.Resolution(i):
-                if i!=0:
-                    return i-1
-                else:
-                    return 0 # We don't want to scale up
+# Templates of the pieces of a KML document: the header, the region and ground overlay
+# of the tile itself (not in the root KML), a network link for each child, and the end.
+# With the depth option, the children (and their children ...) are folders with their own
+# region and ground overlay instead, and the network links are to the tiles below those
 
-    def GoogleTile(self, tx, ty, zoom):
-        "Converts TMS tile coordinates to Google Tile coordinates"
+KML_HEADER = """<?xml version="1.0" encoding="utf-8"?>
+    <kml xmlns="http://www.opengis.net/kml/2.2">
+      <Document>
+        <name>%(title)s</name>
+        <description></description>
+        <Style>
+          <ListStyle id="hideChildren">
+            <listItemType>checkHideChildren</listItemType>
+          </ListStyle>
+        </Style>"""
 
-        # coordinate origin is moved from bottom-left to top-left corner of the extent
-        return tx, (2**zoom - 1) - ty
+KML_TILE = """
+        <Region>
+          <LatLonAltBox>
+            <north>%(north).14f</north>
+            <south>%(south).14f</south>
+            <east>%(east).14f</east>
+            <west>%(west).14f</west>
+          </LatLonAltBox>
+          <Lod>
+            <minLodPixels>%(minlodpixels)d</minLodPixels>
+            <maxLodPixels>%(maxlodpixels)d</maxLodPixels>
+          </Lod>
+        </Region>
+        <GroundOverlay>
+          <drawOrder>%(drawOrder)d</drawOrder>
+          <Icon>
+            <href>%(icon_url)s</href>
+          </Icon>
+          <LatLonBox>
+            <north>%(north).14f</north>
+            <south>%(south).14f</south>
+            <east>%(east).14f</east>
+            <west>%(west).14f</west>
+          </LatLonBox>
+        </GroundOverlay>
+    """
 
-    def QuadTree(self, tx, ty, zoom ):
-        "Converts TMS tile coordinates to Microsoft QuadTree"
+KML_NETWORK_LINK = """
+        <NetworkLink>
+          <name>%d/%d/%d</name>
+          <Region>
+            <LatLonAltBox>
+              <north>%.14f</north>
+              <south>%.14f</south>
+              <east>%.14f</east>
+              <west>%.14f</west>
+            </LatLonAltBox>
+            <Lod>
+              <minLodPixels>%d</minLodPixels>
+              <maxLodPixels>-1</maxLodPixels>
+            </Lod>
+          </Region>
+          <Link>
+            <href>%s?%s&amp;zxy=%d/%d/%d</href>
+            <viewRefreshMode>onRegion</viewRefreshMode>
+            <viewFormat/>
+          </Link>
+        </NetworkLink>
+    """
 
-        quadKey = ""
-        ty = (2**zoom - 1) - ty
-        for i in range(zoom, 0, -1):
-            digit = 0
-            mask = 1 << (i-1)
-            if (tx & mask) != 0:
-                digit += 1
-            if (ty & mask) != 0:
-                digit += 2
-            quadKey += str(digit)
+KML_FOLDER = """
+        <Folder>
+          <name>%(title)s</name>
+          <Region>
+            <LatLonAltBox>
+              <north>%(north).14f</north>
+              <south>%(south).14f</south>
+              <east>%(east).14f</east>
+              <west>%(west).14f</west>
+            </LatLonAltBox>
+            <Lod>
+              <minLodPixels>%(minlodpixels)d</minLodPixels>
+              <maxLodPixels>-1</maxLodPixels>
+            </Lod>
+          </Region>
+          <GroundOverlay>
+            <drawOrder>%(drawOrder)d</drawOrder>
+            <Icon>
+              <href>%(icon_url)s</href>
+            </Icon>
+            <LatLonBox>
+              <north>%(north).14f</north>
+              <south>%(south).14f</south>
+              <east>%(east).14f</east>
+              <west>%(west).14f</west>
+            </LatLonBox>
+          </GroundOverlay>"""
+
+KML_FOLDER_END = """
+        </Folder>
+    """
 
-        return quadKey
+KML_FOOTER = """      </Document>
+    </kml>
+    """
 
 ###############################################################################
 
@@ -366,6 +310,12 @@ class KMLForTiles(object):
             self.ullr = fs['ullr'].value
         else:
             self.ullr = '-180_90_180_-89.9';
+
+        # Number of zoom levels of tiles in each KML document (those below the first are included as folders)
+        if 'depth=' in querystring:
+            self.depth = min(max(int(fs['depth'].value), 1), MAX_DEPTH)
+        else:
+            self.depth = 1
             
         self.profile = 'mercator';
             
@@ -382,6 +332,15 @@ class KMLForTiles(object):
             self.shpfile = self.shpfile.replace('%5C','/')
         else:
             self.shpfile = '';
+
+        # Index of the tiles with data (see coverage_index.py), the other tiles are left out
+        if 'coverage=' in querystring:
+            coveragefile = fs['coverage'].value
+            coveragefile = coveragefile.replace('%20',' ')
+            coveragefile = coveragefile.replace('%5C','/')
+            self.coverage = coverage_index.get_index(coveragefile)
+        else:
+            self.coverage = None
         
         # In case of inverted y coordinate
         url = urllib.unquote(self.url).decode('utf8')
@@ -404,53 +363,85 @@ class KMLForTiles(object):
 
             self.mercator = GlobalMercator() # from globalmaptiles.py
 
-            self.ominx, self.omaxy = self.mercator.LatLonToMeters(float(uly),float(ulx))
-            self.omaxx, self.ominy = self.mercator.LatLonToMeters(float(lry),float(lrx))
-
             # Function which generates SWNE in LatLong for given tile
             self.tileswne = self.mercator.TileLatLonBounds
 
-            # Generate table with min max tile coordinates for all zoomlevels
-            self.tminmax = list(range(0,32))
-            for tz in range(0, 32):
-                tminx, tminy = self.mercator.MetersToTile( self.ominx, self.ominy, tz )
-                tmaxx, tmaxy = self.mercator.MetersToTile( self.omaxx, self.omaxy, tz )
-                # crop tiles extending world limits (+-180,+-90)
-                tminx, tminy = max(0, tminx), max(0, tminy)
-                tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
-                self.tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
+            # Min max tile coordinates for all zoomlevels (computed when needed, and shared between requests)
+            self.tminmax = region_tiles(self.ullr)
 
     # -------------------------------------------------------------------------
     def generate_tiles(self):
         """
         Figure out which tiles are underneath the current tile
         """
+        return ''.join(self.iter_tiles())
+
+    # -------------------------------------------------------------------------
+    def iter_tiles(self):
+        """
+        As generate_tiles, but the KML is returned in pieces (see iter_kml)
+        """
         tz = int(self.tz)
         tx = int(self.tx)
         ty = int(self.ty)
-        maxzoom = int(self.maxzoom)
 
-        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+        # Create a KML file for this tile.
+        return self.iter_kml( tx, ty, tz, self.tile_children(tx, ty, tz) )
+
+    # -------------------------------------------------------------------------
+    def tile_children(self, tx, ty, tz):
+        """
+        The tiles underneath a tile (within the map bounds and zoom levels), as [x, y, z]
+        """
+        maxzoom = int(self.maxzoom)
 
         children = []
         # Read the tiles and write them to query window
-        for y in range(2*ty,2*ty+2):
-            for x in range(2*tx,2*tx+2):
-                if tz < maxzoom:
-                    minx, miny, maxx, maxy = self.tminmax[tz+1]
-                    if x >= minx and x <= maxx and y >= miny and y <= maxy:
+        if tz < maxzoom:
+            tile_range = self.tminmax[tz+1]
+            for y in range(2*ty,2*ty+2):
+                for x in range(2*tx,2*tx+2):
+                    if (x, y) in tile_range and self.covers(x, y, tz+1):
                         children.append( [x, y, tz+1] )
-                        
-        # Create a KML file for this tile.
-        return self.generate_kml( tx, ty, tz, children )
-        
+        return children
+
+    # -------------------------------------------------------------------------
+    def covers(self, tx, ty, tz):
+        """
+        Whether a tile has any data (according to the coverage index, if there is one)
+        """
+        return self.coverage is None or self.coverage.covers(tx, ty, tz)
+
+    # -------------------------------------------------------------------------
+    def web_tile_url(self, tx, ty, tz):
+        """
+        Address of a web tile (with the x, y, and z coordinates filled in)
+        """
+        if self.invert_y or type(ty) is not int:
+            ty2 = ty
+        else:
+            ty2 = (2**tz)-ty-1
 
+        tile_url = urllib.unquote(self.url).decode('utf8')
+        tile_url = tile_url.replace('{$x}', str(tx))
+        tile_url = tile_url.replace('{$y}', str(ty2))
+        tile_url = tile_url.replace('{$invY}', str(ty2))
+        tile_url = tile_url.replace('{$z}', str(tz))
+        return tile_url
 
     # -------------------------------------------------------------------------
     def generate_kml(self, tx, ty, tz, children = [], **args ):
         """
         Template for the KML. Returns filled string.
         """
+        return ''.join(self.iter_kml(tx, ty, tz, children, **args))
+
+    # -------------------------------------------------------------------------
+    def iter_kml(self, tx, ty, tz, children = [], **args ):
+        """
+        Fill the KML templates, the document is returned in pieces (so it can be written out as it is made).
+        The children can be any iterable of [x, y, z] (e.g. a generator, for a root KML with many children)
+        """
 
         if self.invert_y:
             ty2 = ty
@@ -460,10 +451,15 @@ class KMLForTiles(object):
             else:
                 ty2 = ty
         
-        href_str = self.kmlscriptloc
         querystring = self.querystring.replace('&', '&amp;')
         minzoom = int(self.minzoom)
         dynamictilescript = False
+        # Web tiles that were found to exist or not (with checkStatus)
+        exists = {}
+
+        # The first children are needed before anything is written (the tile's own KML depends on them)
+        children = iter(children)
+        first_children = list(islice(children, CHILDREN_CHUNK))
         
         if self.webTiles == 1:
             if self.bgurl != '' or self.shpfile != '':
@@ -472,22 +468,21 @@ class KMLForTiles(object):
                 dynamictilescript = True
             else:
                 # else, link to the address of the web tile (can also be from a local data source)
-                icon_url = urllib.unquote(self.url).decode('utf8')
-                icon_url = icon_url.replace('{$x}', str(tx))
-                icon_url = icon_url.replace('{$y}', str(ty2))
-                icon_url = icon_url.replace('{$invY}', str(ty2))
-                icon_url = icon_url.replace('{$z}', str(tz))
-        
-                icon_url = icon_url.replace('&', '&amp;')
-                # If specified, check if a tile exists, otherwise show a transparent png
-                if self.checkStatus == True:
-                    try:
-                        f = urllib2.urlopen(urllib2.Request(icon_url.replace('&amp;', '&')))
-                        args['icon_url'] = icon_url
-                    except:
+                icon_url = self.web_tile_url(tx, ty, tz)
+                # If specified, check if a tile exists, otherwise show a transparent png.  The tiles of the
+                # children are checked at the same time (they will be requested next, and the results are cached).
+                # The root KML has no tile of its own, so nothing is checked
+                if self.checkStatus == True and tx is not None:
+                    check_urls = [icon_url] + [self.web_tile_url(cx, cy, cz) for cx, cy, cz in first_children]
+                    # (with the depth option, the tiles of the folders are needed now, and are all checked)
+                    check_urls += [self.web_tile_url(cx, cy, cz) for cx, cy, cz in self.folder_tiles(first_children, self.depth - 2)]
+                    exists = tile_fetch.fetcher.tiles_exist(check_urls)
+                    if exists[icon_url]:
+                        args['icon_url'] = icon_url.replace('&', '&amp;')
+                    else:
                         args['icon_url'] = self.transparentpng
                 else:
-                    args['icon_url'] = icon_url
+                    args['icon_url'] = icon_url.replace('&', '&amp;')
         else:
             # If instead a local GIS data source, link to dynamic tile script
             args['icon_url'] = self.tilescriptloc + '?' + querystring + '&amp;zxy=' + self.zxy    
@@ -502,7 +497,7 @@ class KMLForTiles(object):
         if 'maxlodpixels' not in args:
             #args['maxlodpixels'] = int( args['tilesize'] * 8 ) # 1.7) # default 2048 (used to be -1)
             args['maxlodpixels'] = -1
-        if children == []:
+        if first_children == []:
             args['maxlodpixels'] = -1
         if tz == minzoom:
             args['minlodpixels'] = -1
@@ -520,79 +515,106 @@ class KMLForTiles(object):
         else:
             args['drawOrder'] = 0
 
-        s = """<?xml version="1.0" encoding="utf-8"?>
-    <kml xmlns="http://www.opengis.net/kml/2.2">
-      <Document>
-        <name>%(title)s</name>
-        <description></description>
-        <Style>
-          <ListStyle id="hideChildren">
-            <listItemType>checkHideChildren</listItemType>
-          </ListStyle>
-        </Style>""" % args
+        # A tile without data (according to the coverage index) is not even requested
+        if tilekml and not self.covers(tx, ty, tz):
+            args['icon_url'] = self.transparentpng
+
+        # If the dynamic tiles script is not used, replace x,y,z by the required values (in the
+        # link to the tile, the only place they can be).  Otherwise the script will figure out the necessary values
+        if dynamictilescript == False and 'icon_url' in args:
+            icon_url = args['icon_url']
+            icon_url = icon_url.replace('{$x}', str(tx))
+            icon_url = icon_url.replace('{$y}', str(ty2))
+            icon_url = icon_url.replace('{$inv_y}', str(ty2))
+            icon_url = icon_url.replace('{$z}', str(tz))
+            args['icon_url'] = icon_url
+
+        yield KML_HEADER % args
         if tilekml:
-            s += """
-        <Region>
-          <LatLonAltBox>
-            <north>%(north).14f</north>
-            <south>%(south).14f</south>
-            <east>%(east).14f</east>
-            <west>%(west).14f</west>
-          </LatLonAltBox>
-          <Lod>
-            <minLodPixels>%(minlodpixels)d</minLodPixels>
-            <maxLodPixels>%(maxlodpixels)d</maxLodPixels>
-          </Lod>
-        </Region>
-        <GroundOverlay>
-          <drawOrder>%(drawOrder)d</drawOrder>
-          <Icon>
-            <href>%(icon_url)s</href>
-          </Icon>
-          <LatLonBox>
-            <north>%(north).14f</north>
-            <south>%(south).14f</south>
-            <east>%(east).14f</east>
-            <west>%(west).14f</west>
-          </LatLonBox>
-        </GroundOverlay>
-    """ % args
-
-        # If the dynamic tiles script is not used, replace x,y,z by the required values
-        # Otherwise the script will figure out the necessary values
-        if dynamictilescript == False:
-            s = s.replace('{$x}', str(tx))
-            s = s.replace('{$y}', str(ty2))
-            s = s.replace('{$inv_y}', str(ty2))
-            s = s.replace('{$z}', str(tz))
-        
-        for cx, cy, cz in children:
-            csouth, cwest, cnorth, ceast = self.tileswne(cx, cy, cz)
-            s += """
-        <NetworkLink>
-          <name>%d/%d/%d</name>
-          <Region>
-            <LatLonAltBox>
-              <north>%.14f</north>
-              <south>%.14f</south>
-              <east>%.14f</east>
-              <west>%.14f</west>
-            </LatLonAltBox>
-            <Lod>
-              <minLodPixels>%d</minLodPixels>
-              <maxLodPixels>-1</maxLodPixels>
-            </Lod>
-          </Region>
-          <Link>
-            <href>%s?%s&amp;zxy=%d/%d/%d</href>
-            <viewRefreshMode>onRegion</viewRefreshMode>
-            <viewFormat/>
-          </Link>
-        </NetworkLink>
-    """ % (cz, cx, cy, cnorth, csouth, ceast, cwest, args['minlodpixels'], href_str, querystring, cz, cx, cy)
+            yield KML_TILE % args
 
-        s += """      </Document>
-    </kml>
-    """
-        return s
-        
\ No newline at end of file
+        if tilekml and self.depth > 1:
+            for piece in self.iter_folders(first_children, self.depth - 1, exists):
+                yield piece
+        else:
+            for piece in self.iter_links(chain(first_children, children), args['minlodpixels']):
+                yield piece
+
+        yield KML_FOOTER
+
+    # -------------------------------------------------------------------------
+    def iter_links(self, children, minlodpixels):
+        """
+        Network links to the KML of the children, returned in pieces (of CHILDREN_CHUNK children)
+        """
+        href_str = self.kmlscriptloc
+        querystring = self.querystring.replace('&', '&amp;')
+
+        # (with numpy) the bounds of each chunk of children are computed all at once
+        children = iter(children)
+        chunk = list(islice(children, CHILDREN_CHUNK))
+        while chunk:
+            if self.profile == 'mercator' and global_mercator.numpy is not None and len(chunk) >= BATCH_CHILDREN:
+                cxs, cys, czs = zip(*chunk)
+                cbounds = zip(*[bounds.tolist() for bounds in self.mercator.TileLatLonBoundsArray(cxs, cys, czs)])
+            else:
+                cbounds = [self.tileswne(cx, cy, cz) for cx, cy, cz in chunk]
+
+            yield ''.join([KML_NETWORK_LINK % (cz, cx, cy, cnorth, csouth, ceast, cwest, minlodpixels, href_str, querystring, cz, cx, cy)
+                           for (cx, cy, cz), (csouth, cwest, cnorth, ceast) in zip(chunk, cbounds)])
+            chunk = list(islice(children, CHILDREN_CHUNK))
+
+    # -------------------------------------------------------------------------
+    def folder_tiles(self, tiles, depth):
+        """
+        The tiles, and the tiles underneath them for depth more zoom levels (the tiles of the folders of iter_folders)
+        """
+        for cx, cy, cz in tiles:
+            yield [cx, cy, cz]
+            if depth > 0:
+                for tile in self.folder_tiles(self.tile_children(cx, cy, cz), depth - 1):
+                    yield tile
+
+    # -------------------------------------------------------------------------
+    def iter_folders(self, tiles, depth, exists):
+        """
+        Folders with the region and ground overlay of each of the tiles, containing the folders of their children
+        (for depth - 1 more zoom levels), and then the network links to the tiles below.  This way, Google Earth gets
+        several zoom levels with each request, instead of one.  exists tells which web tiles exist (see checkStatus)
+        """
+        minzoom = int(self.minzoom)
+
+        for cx, cy, cz in tiles:
+            args = {}
+            args['title'] = "%d/%d/%d.kml" % (cz, cx, cy)
+            args['south'], args['west'], args['north'], args['east'] = self.tileswne(cx, cy, cz)
+            args['minlodpixels'] = -1 if cz == minzoom else int( self.tilesize / 2 )
+            args['drawOrder'] = 2 * cz + 1 if cx == 0 else 2 * cz
+            args['icon_url'] = self.tile_icon_url(cx, cy, cz, exists)
+            yield KML_FOLDER % args
+
+            grandchildren = self.tile_children(cx, cy, cz)
+            if depth > 1:
+                for piece in self.iter_folders(grandchildren, depth - 1, exists):
+                    yield piece
+            else:
+                for piece in self.iter_links(grandchildren, args['minlodpixels']):
+                    yield piece
+            yield KML_FOLDER_END
+
+    # -------------------------------------------------------------------------
+    def tile_icon_url(self, tx, ty, tz, exists):
+        """
+        Address of the image of a tile in a folder (as for the tile of the KML itself in iter_kml)
+        """
+        if self.webTiles == 1 and self.bgurl == '' and self.shpfile == '':
+            icon_url = self.web_tile_url(tx, ty, tz)
+            if not exists.get(icon_url, True):
+                return self.transparentpng
+            if self.invert_y:
+                ty2 = ty
+            else:
+                ty2 = (2**tz)-ty-1
+            return icon_url.replace('&', '&amp;').replace('{$inv_y}', str(ty2))
+        else:
+            return self.tilescriptloc + '?' + self.querystring.replace('&', '&amp;') + '&amp;zxy=%d/%d/%d' % (tz, tx, ty)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Multi-resolution (.pyr) files, which list the datasets to display at different
+# zoom levels, one per line from the lowest zoom level to the highest:
+#
+#   <zoom> <file> [<west> <south> <east> <north>]
+#
+# A dataset is used for the tiles up to (and including) its zoom level, and the
+# dataset of the last line for all of the higher zoom levels.  Files are relative
+# to the folder of the .pyr file.  The optional bounds (in degrees) are the
+# extent of the dataset, so tiles outside of it use the next dataset that covers
+# them (or none) without opening it.  Lines that are empty or start with # are
+# skipped.  The files are parsed once and cached (until they change).
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from bisect import bisect_left
+import os
+from file_cache import FileCache
+
+###############################################################################
+
+class PyramidEntry(object):
+    """A line of a .pyr file"""
+
+    def __init__(self, zoom, path, bounds=None):
+        self.zoom = zoom
+        self.path = path
+        self.bounds = bounds
+
+    def covers(self, west, south, east, north):
+        """Whether the dataset (may) overlap the given bounds"""
+
+        if self.bounds is None:
+            return True
+        bwest, bsouth, beast, bnorth = self.bounds
+        return bwest < east and beast > west and bsouth < north and bnorth > south
+
+###############################################################################
+
+class PyramidFile(object):
+    """The (validated) entries of a .pyr file, indexed by zoom level"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = []
+        folder = os.path.dirname(filename)
+        with open(filename, 'r') as pyrfile:
+            for lineno, line in enumerate(pyrfile, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if len(fields) not in (2, 6):
+                    raise ValueError('%s, line %d: expected "<zoom> <file> [<west> <south> <east> <north>]"' % (filename, lineno))
+                try:
+                    zoom = int(fields[0])
+                    bounds = tuple(float(v) for v in fields[2:]) or None
+                except ValueError:
+                    raise ValueError('%s, line %d: invalid zoom level or bounds' % (filename, lineno))
+                if self.entries and zoom <= self.entries[-1].zoom:
+                    raise ValueError('%s, line %d: zoom levels must increase from line to line' % (filename, lineno))
+                self.entries.append(PyramidEntry(zoom, os.path.join(folder, fields[1]), bounds))
+        if not self.entries:
+            raise ValueError(filename + ': no datasets listed')
+        self.zooms = [entry.zoom for entry in self.entries]
+
+    # -------------------------------------------------------------------------
+    def dataset_for_tile(self, tz, bounds=None):
+        """
+        The path of the dataset to use for a tile at zoom level tz (with bounds (west, south,
+        east, north) in degrees, if the entries have bounds), or None if no dataset covers it
+        """
+        # The first entry whose zoom level is at least tz (or else the last one)
+        i = min(bisect_left(self.zooms, tz), len(self.entries) - 1)
+        for entry in self.entries[i:]:
+            if bounds is None or entry.covers(*bounds):
+                return entry.path
+        return None
+
+    # -------------------------------------------------------------------------
+    def paths(self):
+        """The paths of all of the datasets"""
+
+        return [entry.path for entry in self.entries]
+
+###############################################################################
+
+_pyramids = FileCache(PyramidFile)
+
+def get_pyramid(filename):
+    """The PyramidFile of a .pyr file"""
+
+    return _pyramids.get(filename)
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#
+# Process-wide cache of opened GDAL source datasets (the local rasters that are
+# displayed by the dynamic tile generator script), so that they are not reopened
+# for every tile when the scripts are run by a long-lived server (tile_server.py).
+# The extents of the sources (for the root KML) are also computed once per source.
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from osgeo import gdal, osr
+from gdalconst import *
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import math
+import os
+
+# Number of source rasters kept open (least recently used sources are closed first)
+MAX_SOURCES = 32
+# Number of idle handles kept open for each source (gdal datasets can't be shared
+# between threads, so concurrent tiles from the same source each borrow a handle)
+MAX_IDLE_HANDLES = 4
+# Number of points along each edge of a raster that are transformed to find its extent (as gdalwarp does)
+EXTENT_EDGE_POINTS = 21
+
+###############################################################################
+
+class SourceDataset(object):
+    """
+    An opened source raster, along with the metadata that its extents are computed from
+    (read once, when the source is first opened)
+    """
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.lock = threading.Lock()
+        self.idle = []
+        self.extents = {}
+
+        ds = self.open()
+        self.cols = ds.RasterXSize
+        self.rows = ds.RasterYSize
+        self.bands = ds.RasterCount
+        self.geotransform = ds.GetGeoTransform()
+        self.srs = ds.GetProjection()
+        self.gcp_count = ds.GetGCPCount()
+        self.idle.append(ds)
+
+    # -------------------------------------------------------------------------
+    def open(self):
+        """Open a new handle to the source raster"""
+
+        ds = gdal.Open(self.path, GA_ReadOnly)
+        if ds is None:
+            raise IOError('Could not open raster ' + self.path)
+        return ds
+
+    # -------------------------------------------------------------------------
+    @contextmanager
+    def dataset(self):
+        """Borrow an open handle to the source raster for the duration of a with block"""
+
+        with self.lock:
+            if self.idle:
+                ds = self.idle.pop()
+            else:
+                ds = None
+        if ds is None:
+            ds = self.open()
+        try:
+            yield ds
+        finally:
+            with self.lock:
+                if len(self.idle) < MAX_IDLE_HANDLES:
+                    self.idle.append(ds)
+
+    # -------------------------------------------------------------------------
+    def extent(self, dst_srs):
+        """
+        The extent (ulx, uly, lrx, lry) and size in pixels (cols, rows) that the raster would have
+        if it was warped to dst_srs by gdalwarp (without -te, -tr or -ts), computed once
+        """
+        with self.lock:
+            extent = self.extents.get(dst_srs)
+        if extent is None:
+            if self.srs and self.gcp_count == 0:
+                extent = self.transform_extent(dst_srs)
+            else:
+                extent = self.warped_extent(dst_srs)
+            with self.lock:
+                self.extents[dst_srs] = extent
+        return extent
+
+    # -------------------------------------------------------------------------
+    def transform_extent(self, dst_srs):
+        """
+        Transform points along the edges of the raster to dst_srs, and take the pixel size
+        from its diagonal (the same as GDALSuggestedWarpOutput)
+        """
+        src = osr.SpatialReference()
+        src.ImportFromWkt(self.srs)
+        dst = osr.SpatialReference()
+        dst.SetFromUserInput(dst_srs)
+        for srs in (src, dst):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, dst)
+
+        gt = self.geotransform
+        steps = EXTENT_EDGE_POINTS - 1
+        pixels = [(0, 0), (self.cols, self.rows)]
+        for i in range(steps + 1):
+            f = i / float(steps)
+            pixels += [(f * self.cols, 0), (f * self.cols, self.rows), (0, f * self.rows), (self.cols, f * self.rows)]
+        points = transform.TransformPoints([(gt[0] + px*gt[1] + py*gt[2], gt[3] + px*gt[4] + py*gt[5]) for px, py in pixels])
+        points = [(x, y) for x, y, z in points if not (math.isinf(x) or math.isinf(y) or math.isnan(x) or math.isnan(y))]
+        if len(points) < 2:
+            raise IOError('Could not transform the extent of raster ' + self.path)
+
+        minx = min(x for x, y in points)
+        maxx = max(x for x, y in points)
+        miny = min(y for x, y in points)
+        maxy = max(y for x, y in points)
+        (ulx, uly), (lrx, lry) = points[0], points[1]
+        pixel_size = math.hypot(lrx - ulx, lry - uly) / math.hypot(self.cols, self.rows)
+        cols = max(1, int((maxx - minx) / pixel_size + 0.5))
+        rows = max(1, int((maxy - miny) / pixel_size + 0.5))
+        return minx, maxy, maxx, miny, cols, rows
+
+    # -------------------------------------------------------------------------
+    def warped_extent(self, dst_srs):
+        """The extent of a raster without a projection (e.g. georeferenced with GCPs), from an in-memory warped VRT"""
+
+        with self.dataset() as ds:
+            vrt = gdal.Warp('', ds, options=gdal.WarpOptions(format='VRT', dstSRS=dst_srs))
+        if vrt is None:
+            raise IOError('Could not warp raster ' + self.path)
+        gt = vrt.GetGeoTransform()
+        cols, rows = vrt.RasterXSize, vrt.RasterYSize
+        return gt[0], gt[3], gt[0] + cols * gt[1], gt[3] + rows * gt[5], cols, rows
+
+###############################################################################
+
+_sources = OrderedDict()
+_sources_lock = threading.Lock()
+
+def get_source(path):
+    """
+    Return the (cached) SourceDataset for a raster, keyed by its path and modification
+    time (so that a source is reopened when the file changes)
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        # Not a regular file (e.g. a /vsi path or a connection string)
+        mtime = None
+
+    with _sources_lock:
+        source = _sources.pop(path, None)
+        if source is not None and source.mtime == mtime:
+            _sources[path] = source
+            return source
+
+    # Open outside of the lock, so a slow source doesn't hold up the others
+    source = SourceDataset(path, mtime)
+    with _sources_lock:
+        _sources[path] = source
+        while len(_sources) > MAX_SOURCES:
+            _sources.popitem(last=False)
+    return source
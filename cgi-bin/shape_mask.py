@@ -0,0 +1,193 @@
+#!/usr/bin/python
+#
+# Shapefile masks for the dynamic tile generator script (the shpfile option).
+# The shapefile is loaded once and indexed on a grid of cells, so that each tile
+# only rasterizes the (pre-clipped) polygon pieces that overlap it, and tiles that
+# are entirely inside or outside of the polygons are not rasterized at all.
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from osgeo import gdal, ogr, osr
+from gdalconst import *
+import threading
+import math
+import os
+from file_cache import FileCache
+
+# Size of the grid cells used to index the polygons (in degrees)
+CELL_SIZE = 1.0
+# Tiles that span more grid cells than this are rasterized from the whole polygons
+# (instead of the clipped pieces of each cell), which is faster at low zoom levels
+MAX_TILE_CELLS = 64
+
+###############################################################################
+
+class ShapeMask(object):
+    """Polygons of a shapefile layer (in the tile projection), indexed by grid cell"""
+
+    def __init__(self, filename, layername, srs_wkt):
+        self.lock = threading.Lock()
+        # Polygons (single parts of each feature) and their envelopes
+        self.parts = []
+        self.envelopes = []
+        # Indices of the parts whose envelope overlaps each cell
+        self.cells = {}
+        # Clipped pieces of the parts for each cell (computed when first needed), and
+        # whether a cell is completely covered by the polygons, as (pieces, full)
+        self.cell_pieces = {}
+
+        shp = ogr.Open(filename)
+        if shp is None:
+            raise IOError('Could not open shapefile ' + filename)
+        layer = shp.GetLayerByName(layername)
+        if layer is None:
+            layer = shp.GetLayer(0)
+
+        transform = None
+        layer_srs = layer.GetSpatialRef()
+        if layer_srs is not None:
+            tile_srs = osr.SpatialReference()
+            tile_srs.ImportFromWkt(srs_wkt)
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                tile_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            if not layer_srs.IsSame(tile_srs):
+                transform = osr.CoordinateTransformation(layer_srs, tile_srs)
+
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            geom = geom.Clone()
+            if transform is not None:
+                geom.Transform(transform)
+            if geom.GetGeometryType() in (ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D):
+                parts = [geom.GetGeometryRef(i).Clone() for i in range(geom.GetGeometryCount())]
+            else:
+                parts = [geom]
+            for part in parts:
+                minx, maxx, miny, maxy = part.GetEnvelope()
+                index = len(self.parts)
+                self.parts.append(part)
+                self.envelopes.append((minx, maxx, miny, maxy))
+                for cell in self.cells_for_bounds(minx, miny, maxx, maxy):
+                    self.cells.setdefault(cell, []).append(index)
+
+    # -------------------------------------------------------------------------
+    def cells_for_bounds(self, west, south, east, north):
+        """Grid cells that overlap a bounding box"""
+
+        xs = range(int(math.floor(west / CELL_SIZE)), int(math.ceil(east / CELL_SIZE)))
+        ys = range(int(math.floor(south / CELL_SIZE)), int(math.ceil(north / CELL_SIZE)))
+        return [(x, y) for x in xs for y in ys]
+
+    # -------------------------------------------------------------------------
+    def box(self, west, south, east, north):
+        """Polygon geometry of a bounding box"""
+
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ((west, south), (east, south), (east, north), (west, north), (west, south)):
+            ring.AddPoint_2D(x, y)
+        box = ogr.Geometry(ogr.wkbPolygon)
+        box.AddGeometry(ring)
+        return box
+
+    # -------------------------------------------------------------------------
+    def pieces(self, cell):
+        """Pieces of the polygons clipped to a grid cell (clipped on first use, then reused)"""
+
+        with self.lock:
+            cached = self.cell_pieces.get(cell)
+        if cached is not None:
+            return cached
+
+        # The polygons are clipped without holding the lock (clipping large polygons, e.g. the oceans, takes
+        # long, and the tiles of other cells shouldn't wait for it)
+        x, y = cell
+        cell_box = self.box(x * CELL_SIZE, y * CELL_SIZE, (x+1) * CELL_SIZE, (y+1) * CELL_SIZE)
+        pieces = []
+        full = False
+        for index in self.cells.get(cell, []):
+            piece = self.parts[index].Intersection(cell_box)
+            if piece is None or piece.IsEmpty():
+                continue
+            pieces.append(piece)
+            if piece.Contains(cell_box) or piece.Equals(cell_box):
+                full = True
+        with self.lock:
+            # (if another request clipped the same cell in the meantime, its pieces are kept)
+            return self.cell_pieces.setdefault(cell, (pieces, full))
+
+    # -------------------------------------------------------------------------
+    def tile_mask(self, west, south, east, north, xsize, ysize):
+        """
+        Mask of the pixels of a tile that are inside the polygons (the pixels that
+        gdal_rasterize would burn).  Returns None if no polygon overlaps the tile,
+        True if the whole tile is inside the polygons, or else a boolean array
+        """
+        tile_box = self.box(west, south, east, north)
+        cells = self.cells_for_bounds(west, south, east, north)
+
+        geoms = []
+        if len(cells) <= MAX_TILE_CELLS:
+            all_full = True
+            for cell in cells:
+                pieces, full = self.pieces(cell)
+                all_full = all_full and full
+                geoms.extend(p for p in pieces if p.Intersects(tile_box))
+            if all_full and cells:
+                return True
+        else:
+            for index, (minx, maxx, miny, maxy) in enumerate(self.envelopes):
+                if minx < east and maxx > west and miny < north and maxy > south:
+                    geoms.append(self.parts[index])
+        if not geoms:
+            return None
+        for geom in geoms:
+            if geom.Contains(tile_box):
+                return True
+
+        # Rasterize the overlapping polygons only
+        ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, GDT_Byte)
+        ds.SetGeoTransform((west, (east - west) / xsize, 0, north, 0, (south - north) / ysize))
+        source = ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer = source.CreateLayer('mask')
+        for geom in geoms:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(geom)
+            layer.CreateFeature(feature)
+        gdal.RasterizeLayer(ds, [1], layer, burn_values=[1])
+        return ds.GetRasterBand(1).ReadAsArray() != 0
+
+###############################################################################
+
+def load_shape_mask(filename, srs_wkt):
+    layername = os.path.basename(filename).replace('.shp', '')
+    return ShapeMask(filename, layername, srs_wkt)
+
+_shape_masks = FileCache(load_shape_mask)
+
+def get_shape_mask(filename, srs_wkt):
+    """The ShapeMask of a shapefile, in the projection srs_wkt"""
+
+    return _shape_masks.get(filename, srs_wkt)
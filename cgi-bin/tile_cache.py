@@ -0,0 +1,692 @@
+#!/usr/bin/python
+#
+# Caches for the tiles made by the dynamic tile generator script (the cachedir
+# option).  Tiles can be stored one PNG file per tile (the original layout,
+# dynamic_tiles/<cachedir>/z/x/y.png) or in an MBTiles (SQLite) file, and in a
+# long-lived server (tile_server.py), recently used tiles are also kept in memory,
+# and concurrent requests for the same tile wait for a single render (SingleFlight).
+#
+# Each cachedir holds one cache per layer, where a layer is identified by a hash
+# of its rendering parameters and of the modification times and sizes of its
+# source files (dynamic_tiles/<cachedir>/<layer>/z/x/y.png, or <layer>.mbtiles),
+# so layers that share a cachedir don't serve each other's tiles, and a layer
+# is rendered again when its source files change.  Cached tiles can be purged
+# by layer, zoom range and bounding box (see purge, or run this script with -h).
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from collections import OrderedDict
+from optparse import OptionParser
+import threading
+import sqlite3
+import hashlib
+import tempfile
+import atexit
+import errno
+import json
+import time
+import os, sys
+from global_mercator import GlobalMercator
+
+# Directory that the caches are stored in
+CACHE_ROOT = 'dynamic_tiles'
+# Memory used by the in-memory tier (shared by all caches)
+MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+# Number of layer caches kept open (the least recently used are closed first, which also stops the writer
+# thread of an MBTiles cache)
+MAX_OPEN_CACHES = 32
+# Number of tiles (or seconds) after which tiles written to an MBTiles cache are committed
+MBTILES_BATCH_SIZE = 64
+MBTILES_BATCH_SECONDS = 2.0
+# Folder (in the folder of a layer) of the files that many tiles of a directory cache are links to
+SHARED_DIR = 'shared'
+# Size of the blocks of tiles that seed_tiles.py records as done in <layer>.seed (for the block names without an @size)
+SEED_BLOCK_SIZE = 8
+
+###############################################################################
+
+class CachedTile(object):
+    """A tile in a cache, with the validators used for conditional requests (ETag and modification time)"""
+
+    def __init__(self, etag, mtime, data=None, path=None):
+        self.etag = etag
+        self.mtime = mtime
+        self.data = data
+        self.path = path
+
+    def read(self):
+        """The (PNG) data of the tile (read from disk only when needed)"""
+
+        if self.data is None:
+            with open(self.path, 'rb') as tilefile:
+                return tilefile.read()
+        return self.data
+
+def content_etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+###############################################################################
+
+class TileCache(object):
+    """Base class of the caches, counts hits and misses"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tz, tx, ty):
+        """Returns a CachedTile, or None if the tile isn't cached"""
+
+        return self.count(self.lookup(tz, tx, ty))
+
+    def count(self, tile):
+        """Count a lookup as a hit or a miss (under the lock, as the lookups come from many threads)"""
+
+        with self.lock:
+            if tile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tile
+
+    def put(self, tz, tx, ty, data):
+        """Store a tile and return it as a CachedTile"""
+        raise NotImplementedError
+
+    def put_shared(self, tz, tx, ty, data, key):
+        """
+        Store a tile whose data is the same for many tiles (e.g. a tile of a single color), identified
+        by key.  Caches that can store it once and refer to it from each tile do so
+        """
+        return self.put(tz, tx, ty, data)
+
+    def lookup(self, tz, tx, ty):
+        raise NotImplementedError
+
+    def purge(self, tiles):
+        """Remove the tiles in the given zoom -> (tminx, tminy, tmaxx, tmaxy) ranges, returns how many were removed"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Write out the tiles that have been put but not stored yet"""
+        pass
+
+    def close(self):
+        """Write out the remaining tiles, and release what the cache holds open"""
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+###############################################################################
+
+class DirectoryCache(TileCache):
+    """One PNG file per tile, in <root>/z/x/y.png"""
+
+    def __init__(self, root, tileext='png'):
+        TileCache.__init__(self)
+        self.root = root
+        self.tileext = tileext
+        # The shared file that new links are made to, for each key (see put_shared)
+        self.shared_generations = {}
+
+    def filename(self, tz, tx, ty):
+        return os.path.join(self.root, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
+
+    def shared_filename(self, key, generation):
+        if generation == 0:
+            return os.path.join(self.root, SHARED_DIR, "%s.%s" % (key, self.tileext))
+        return os.path.join(self.root, SHARED_DIR, "%s.%d.%s" % (key, generation, self.tileext))
+
+    def lookup(self, tz, tx, ty):
+        tilefilename = self.filename(tz, tx, ty)
+        try:
+            st = os.stat(tilefilename)
+        except OSError:
+            return None
+        # Validators from the modification time and size, so the tile isn't read for a 304
+        etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        return CachedTile(etag, int(st.st_mtime), path=tilefilename)
+
+    def put(self, tz, tx, ty, data):
+        self.write_file(self.filename(tz, tx, ty), data)
+        return self.lookup(tz, tx, ty)
+
+    def put_shared(self, tz, tx, ty, data, key):
+        # The tiles are hard links to one file, rather than copies of it (where the file system supports it)
+        if not hasattr(os, 'link'):
+            return self.put(tz, tx, ty, data)
+        tilefilename = self.filename(tz, tx, ty)
+        self.make_folder(os.path.dirname(tilefilename))
+        linkfilename = '%s.%d.%d.link' % (tilefilename, os.getpid(), threading.current_thread().ident)
+        generation = self.shared_generations.get(key, 0)
+        try:
+            while True:
+                sharedfilename = self.shared_filename(key, generation)
+                if not os.path.exists(sharedfilename):
+                    self.write_file(sharedfilename, data)
+                try:
+                    os.link(sharedfilename, linkfilename)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EMLINK:
+                        raise
+                    # The file has as many links as the file system allows (e.g. 65000 on ext4), so the
+                    # next tiles are links to a new one
+                    generation += 1
+                    self.shared_generations[key] = generation
+            os.rename(linkfilename, tilefilename)
+            # The link has the modification time of the shared file, which may be long before this tile was
+            # rendered (so a client could be told that its older copy of the tile is still current)
+            os.utime(tilefilename, None)
+        except OSError:
+            if os.path.exists(linkfilename):
+                os.unlink(linkfilename)
+            return self.put(tz, tx, ty, data)
+        return self.lookup(tz, tx, ty)
+
+    def make_folder(self, folder):
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass  # created by another request in the meantime
+
+    def write_file(self, filename, data):
+        self.make_folder(os.path.dirname(filename))
+        # Write to a temporary file and rename it, so that a partly written tile is never served
+        fd, tempfilename = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as tilefile:
+            tilefile.write(data)
+        os.chmod(tempfilename, 0644)
+        try:
+            os.rename(tempfilename, filename)
+        except OSError:
+            # On Windows, rename doesn't replace an existing file
+            try:
+                os.unlink(filename)
+                os.rename(tempfilename, filename)
+            except OSError:
+                os.unlink(tempfilename)
+                raise
+
+    def purge(self, tiles):
+        removed = 0
+        for tz, (tminx, tminy, tmaxx, tmaxy) in tiles.items():
+            zdir = os.path.join(self.root, str(tz))
+            if not os.path.isdir(zdir):
+                continue
+            for xname in os.listdir(zdir):
+                if not xname.isdigit() or not tminx <= int(xname) <= tmaxx:
+                    continue
+                for yname in os.listdir(os.path.join(zdir, xname)):
+                    ty = os.path.splitext(yname)[0]
+                    if ty.isdigit() and tminy <= int(ty) <= tmaxy:
+                        os.unlink(os.path.join(zdir, xname, yname))
+                        removed += 1
+        return removed
+
+###############################################################################
+
+class MBTilesCache(TileCache):
+    """
+    Tiles stored in an MBTiles (SQLite) file.  Each thread reads through its own connection
+    (the database is in WAL mode, so reads don't wait for writes), and new tiles are
+    committed in batches by a writer thread (until then, they are served from memory)
+    """
+
+    def __init__(self, filename, name=''):
+        TileCache.__init__(self)
+        self.filename = filename
+        self.local = threading.local()
+        self.pending = OrderedDict()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        db = self.connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, updated INTEGER)')
+        db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        if db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] == 0:
+            db.executemany('INSERT INTO metadata VALUES (?, ?)', [('name', name), ('format', 'png'), ('type', 'overlay'), ('version', '1.0')])
+        db.commit()
+
+        self.writer = threading.Thread(target=self.write_batches)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.filename, timeout=30)
+        return db
+
+    def lookup(self, tz, tx, ty):
+        with self.lock:
+            pending = self.pending.get((tz, tx, ty))
+        if pending is not None:
+            data, mtime = pending
+        else:
+            # tile_row is in TMS order (as ty is)
+            row = self.connection().execute('SELECT tile_data, updated FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?', (tz, tx, ty)).fetchone()
+            if row is None:
+                return None
+            data, mtime = str(row[0]), row[1] or 0
+        return CachedTile(content_etag(data), mtime, data=data)
+
+    def put(self, tz, tx, ty, data):
+        mtime = int(time.time())
+        with self.lock:
+            self.pending[(tz, tx, ty)] = (data, mtime)
+            if len(self.pending) >= MBTILES_BATCH_SIZE:
+                self.wakeup.notify()
+            closed = self.closed
+        if closed:
+            # (e.g. a tile rendered by a request that had the cache when it was closed)
+            self.flush()
+        return CachedTile(content_etag(data), mtime, data=data)
+
+    def write_batches(self):
+        while not self.closed:
+            with self.lock:
+                self.wakeup.wait(MBTILES_BATCH_SECONDS)
+            self.flush()
+
+    def close(self):
+        """Stop the writer thread (before the interpreter shuts down) and commit the remaining tiles"""
+
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.writer.join()
+        self.flush()
+
+    def flush(self):
+        """Commit the tiles that have been put since the last batch"""
+
+        with self.lock:
+            batch = self.pending.items()
+        if not batch:
+            return
+        db = self.connection()
+        db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)',
+                       [(tz, tx, ty, sqlite3.Binary(data), mtime) for (tz, tx, ty), (data, mtime) in batch])
+        db.commit()
+        with self.lock:
+            for key, value in batch:
+                if self.pending.get(key) is value:
+                    del self.pending[key]
+
+    def purge(self, tiles):
+        self.flush()
+        db = self.connection()
+        removed = 0
+        for tz, (tminx, tminy, tmaxx, tmaxy) in tiles.items():
+            cursor = db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?',
+                                (tz, tminx, tmaxx, tminy, tmaxy))
+            removed += cursor.rowcount
+        db.commit()
+        return removed
+
+###############################################################################
+
+class MemoryCache(TileCache):
+    """Least recently used tiles, up to a total size in bytes"""
+
+    def __init__(self, max_bytes):
+        TileCache.__init__(self)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.tiles = OrderedDict()
+
+    def lookup(self, key):
+        with self.lock:
+            tile = self.tiles.pop(key, None)
+            if tile is not None:
+                self.tiles[key] = tile
+            return tile
+
+    def get(self, key):
+        """Returns a CachedTile (keyed by the cache name and tile coordinates), or None"""
+
+        return self.count(self.lookup(key))
+
+    def put(self, key, tile):
+        if len(tile.data) > self.max_bytes:
+            return tile
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old.data)
+            self.tiles[key] = tile
+            self.nbytes += len(tile.data)
+            while self.nbytes > self.max_bytes:
+                old_key, old = self.tiles.popitem(last=False)
+                self.nbytes -= len(old.data)
+        return tile
+
+    def purge_layer(self, name, tiles):
+        """Remove the tiles of a cache (by name) in the given zoom ranges"""
+
+        with self.lock:
+            for key in list(self.tiles.keys()):
+                if key[0] != name or key[1] not in tiles:
+                    continue
+                tminx, tminy, tmaxx, tmaxy = tiles[key[1]]
+                if tminx <= key[2] <= tmaxx and tminy <= key[3] <= tmaxy:
+                    self.nbytes -= len(self.tiles.pop(key).data)
+
+    def stats(self):
+        stats = TileCache.stats(self)
+        with self.lock:
+            stats['bytes'] = self.nbytes
+            stats['tiles'] = len(self.tiles)
+        return stats
+
+###############################################################################
+
+class TieredCache(TileCache):
+    """A cache with the shared in-memory cache in front of it"""
+
+    def __init__(self, name, store, memory):
+        TileCache.__init__(self)
+        self.name = name
+        self.store = store
+        self.memory = memory
+
+    def lookup(self, tz, tx, ty):
+        key = (self.name, tz, tx, ty)
+        tile = self.memory.get(key)
+        if tile is None:
+            tile = self.store.get(tz, tx, ty)
+            if tile is not None:
+                tile = self.memory.put(key, CachedTile(tile.etag, tile.mtime, data=tile.read()))
+        return tile
+
+    def put(self, tz, tx, ty, data):
+        tile = self.store.put(tz, tx, ty, data)
+        return self.memory.put((self.name, tz, tx, ty), CachedTile(tile.etag, tile.mtime, data=data))
+
+    def put_shared(self, tz, tx, ty, data, key):
+        # (the tiles in memory all refer to the same data)
+        tile = self.store.put_shared(tz, tx, ty, data, key)
+        return self.memory.put((self.name, tz, tx, ty), CachedTile(tile.etag, tile.mtime, data=data))
+
+    def purge(self, tiles):
+        self.memory.purge_layer(self.name, tiles)
+        return self.store.purge(tiles)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+    def stats(self):
+        stats = TileCache.stats(self)
+        stats['store'] = self.store.stats()
+        return stats
+
+###############################################################################
+
+class SingleFlight(object):
+    """
+    Runs a function once for concurrent callers with the same key: the first caller runs it,
+    and the others wait for it to finish and share its result (or its exception)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.coalesced = 0
+
+    def do(self, key, function, *args):
+        """Returns (result, shared), where shared is True if another caller computed the result"""
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error'][0], flight['error'][1], flight['error'][2]
+            return flight['result'], True
+
+        try:
+            flight['result'] = function(*args)
+        except Exception:
+            flight['error'] = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight['done'].set()
+        return flight['result'], False
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.flights), 'coalesced': self.coalesced}
+
+memory_cache = MemoryCache(MEMORY_CACHE_BYTES)
+# Renders of the dynamic tiles (keyed by layer and tile)
+renders = SingleFlight()
+_caches = OrderedDict()
+_caches_lock = threading.Lock()
+
+def layer_key(params):
+    """Hash identifying a layer, from a list of (name, value) rendering parameters"""
+
+    return hashlib.sha1(json.dumps(sorted(params))).hexdigest()[:16]
+
+def get_cache(cachedir, cachetype='dir', layer='', params=None):
+    """
+    Return the cache for a layer of a cachedir (shared by all requests in the process).  cachetype is
+    'dir' (dynamic_tiles/<cachedir>/<layer>/z/x/y.png) or 'mbtiles' (dynamic_tiles/<cachedir>/<layer>.mbtiles).
+    The rendering parameters of the layer are saved next to it (<layer>.json) when it is created.
+    Up to MAX_OPEN_CACHES caches are kept open, the least recently used are closed
+    """
+    name = os.path.join(cachedir, layer)
+    evicted = []
+    with _caches_lock:
+        key = (name, cachetype)
+        cache = _caches.pop(key, None)
+        if cache is None:
+            path = os.path.join(CACHE_ROOT, name)
+            if cachetype == 'mbtiles':
+                store = MBTilesCache(path + '.mbtiles', name)
+            elif cachetype == 'dir':
+                store = DirectoryCache(path)
+            else:
+                raise ValueError('Unknown cache type ' + cachetype)
+            if layer and params is not None and not os.path.exists(path + '.json'):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + '.json', 'w') as manifest:
+                    json.dump(sorted(params), manifest, indent=2)
+            cache = TieredCache('%s:%s' % key, store, memory_cache)
+        _caches[key] = cache
+        while len(_caches) > MAX_OPEN_CACHES:
+            evicted.append(_caches.popitem(last=False)[1])
+    # (closing an MBTiles cache waits for its writer thread, so other requests aren't held up by it)
+    for old in evicted:
+        old.close()
+    return cache
+
+# -------------------------------------------------------------------------
+def cached_layers(cachedir):
+    """
+    The layers in a cachedir, as a list of (layer, cachetype).  The folder of a layer is told apart
+    from the other folders (e.g. zoom levels) by the manifest next to it (<layer>.json)
+    """
+
+    layers = []
+    root = os.path.join(CACHE_ROOT, cachedir)
+    if not os.path.isdir(root):
+        return layers
+    for entry in sorted(os.listdir(root)):
+        if entry.endswith('.mbtiles'):
+            layers.append((entry[:-len('.mbtiles')], 'mbtiles'))
+        elif os.path.isdir(os.path.join(root, entry)) and os.path.exists(os.path.join(root, entry + '.json')):
+            layers.append((entry, 'dir'))
+    return layers
+
+# -------------------------------------------------------------------------
+def check_name(name, what):
+    """Raise a ValueError unless name is the name of a single folder in the cache (not a path out of it)"""
+
+    if (not name or os.path.isabs(name) or '..' in name or os.sep in name
+            or (os.altsep is not None and os.altsep in name)):
+        raise ValueError('Invalid %s %r, it must be a folder name' % (what, name))
+
+# -------------------------------------------------------------------------
+def purge(cachedir, layer=None, zooms=(0, 31), bounds=None):
+    """
+    Remove cached tiles of a cachedir: of one layer (or of all of them), between two zoom
+    levels (inclusive), and within a bounding box (west, south, east, north) in degrees
+    (or everywhere).  Returns the number of tiles removed
+    """
+    check_name(cachedir, 'cachedir')
+    if layer is not None:
+        check_name(layer, 'layer')
+    mercator = GlobalMercator()
+    tiles = {}
+    for tz in range(zooms[0], zooms[1] + 1):
+        if bounds is None:
+            tiles[tz] = (0, 0, 2**tz - 1, 2**tz - 1)
+        else:
+            west, south, east, north = bounds
+            minx, miny = mercator.LatLonToMeters(max(south, -85.05112878), west)
+            maxx, maxy = mercator.LatLonToMeters(min(north, 85.05112878), east)
+            tminx, tminy = mercator.MetersToTile(minx, miny, tz)
+            tmaxx, tmaxy = mercator.MetersToTile(maxx, maxy, tz)
+            tiles[tz] = (max(0, tminx), max(0, tminy), min(2**tz - 1, tmaxx), min(2**tz - 1, tmaxy))
+
+    removed = 0
+    for name, cachetype in cached_layers(cachedir):
+        if layer is None or name == layer:
+            removed += get_cache(cachedir, cachetype, name).purge(tiles)
+            trim_seed_progress(cachedir, name, tiles)
+    return removed
+
+# -------------------------------------------------------------------------
+def trim_seed_progress(cachedir, layer, tiles):
+    """
+    Forget the blocks of seed_tiles.py's progress file for a layer (<layer>.seed) that have tiles
+    in the given zoom -> (tminx, tminy, tmaxx, tmaxy) ranges, so that seeding renders them again
+    """
+    filename = os.path.join(CACHE_ROOT, cachedir, layer + '.seed')
+    if not os.path.exists(filename):
+        return
+    kept = []
+    for line in open(filename):
+        block = line.strip()
+        # z/bx/by or z/bx/by@size (see seed_tiles.tile_blocks)
+        name, _, size = block.partition('@')
+        try:
+            tz, bx, by = [int(v) for v in name.split('/')]
+            size = int(size) if size else SEED_BLOCK_SIZE
+        except ValueError:
+            continue
+        if tz in tiles:
+            tminx, tminy, tmaxx, tmaxy = tiles[tz]
+            if bx*size <= tmaxx and tminx < (bx+1)*size and by*size <= tmaxy and tminy < (by+1)*size:
+                continue
+        kept.append(block + '\n')
+    tempfilename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tempfilename, 'w') as f:
+        f.writelines(kept)
+    os.rename(tempfilename, filename)
+
+# -------------------------------------------------------------------------
+def flush():
+    """
+    Write out the pending tiles of all of the caches (needed before a process exits without
+    running its exit handlers, e.g. a multiprocessing worker)
+    """
+    with _caches_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.flush()
+
+# -------------------------------------------------------------------------
+def close():
+    """Close all of the caches (before the interpreter shuts down, so the pending tiles are committed)"""
+
+    with _caches_lock:
+        caches = list(_caches.values())
+        _caches.clear()
+    for cache in caches:
+        cache.close()
+
+atexit.register(close)
+
+# -------------------------------------------------------------------------
+def stats():
+    """Hit and miss counts of all of the caches"""
+
+    with _caches_lock:
+        caches = dict(('%s:%s' % key, cache.stats()) for key, cache in _caches.items())
+    return {'caches': caches, 'memory': memory_cache.stats(), 'renders': renders.stats()}
+
+###############################################################################
+
+if __name__=='__main__':
+
+    parser = OptionParser(usage="usage: %prog [options] cachedir",
+        description="Remove tiles from a dynamic tile cache (run from the folder that contains dynamic_tiles). "
+                    "Note that a running tile_server.py keeps recently used tiles in memory, POST to its "
+                    "/cache_purge address (with the same options) to purge those as well")
+    parser.add_option("-l", "--layer", dest="layer", help="only purge this layer (default: all of the layers of the cachedir)")
+    parser.add_option("-z", "--zoom", dest="zoom", default="0-31", help="zoom levels to purge, e.g. 10-16 (default: all)")
+    parser.add_option("-b", "--ullr", dest="ullr", help="only purge tiles within ulx_uly_lrx_lry (in degrees, as in the ullr option of generate_kml.py)")
+    parser.add_option("--list", dest="list", action="store_true", help="list the layers of the cachedir (and their rendering parameters)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("A cachedir is required")
+
+    if options.list:
+        for name, cachetype in cached_layers(args[0]):
+            manifest = os.path.join(CACHE_ROOT, args[0], name + '.json')
+            params = json.load(open(manifest)) if os.path.exists(manifest) else []
+            print name, cachetype, ' '.join('%s=%s' % tuple(p[:2]) for p in params)
+    else:
+        zmin, zmax = [int(z) for z in options.zoom.split('-')]
+        bounds = None
+        if options.ullr:
+            ulx, uly, lrx, lry = [float(v) for v in options.ullr.split('_')]
+            bounds = (ulx, lry, lrx, uly)
+        try:
+            removed = purge(args[0], options.layer, (zmin, zmax), bounds)
+        except ValueError, e:
+            parser.error(str(e))
+        print "Removed %d tiles" % removed
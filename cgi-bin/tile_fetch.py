@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#
+# Shared HTTP client for fetching web tiles (used by the KML generator and the
+# dynamic tile generator scripts).  Connections to each tile server are kept
+# alive and reused, the number of concurrent requests to each host is limited,
+# and failed requests are retried with an exponential backoff.
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import httplib
+import socket
+import threading
+import time
+import urllib
+from urlparse import urlparse, urljoin
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+###############################################################################
+
+class FetchError(IOError):
+    """Raised when a tile can't be fetched (after retrying), or the server returns an error"""
+
+    def __init__(self, url, status=None, msg=''):
+        IOError.__init__(self, '%s: %s %s' % (url, status, msg))
+        self.url = url
+        self.status = status
+
+###############################################################################
+
+class HostPool(object):
+    """Idle keep-alive connections to one host, and a limit on concurrent requests to it"""
+
+    def __init__(self, scheme, netloc, max_connections, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def get_connection(self):
+        """Returns an idle connection (if any) or a new one, and whether it is reused"""
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout), False
+
+    def release_connection(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+###############################################################################
+
+class TileFetcher(object):
+    """Connection-pooled HTTP client (thread safe, one instance is shared by the whole process)"""
+
+    # Responses worth retrying (the server is busy or temporarily unavailable)
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_per_host=8, timeout=10, retries=3, backoff=0.25, max_redirects=5,
+                 exists_ttl=3600, missing_ttl=600, max_statuses=100000, probe_threads=16):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        self.pools = {}
+        self.lock = threading.Lock()
+
+        # Cached results of tile existence checks (url -> (exists, expiry time)), how long
+        # they are kept for, and the checks that are in progress
+        self.exists_ttl = exists_ttl
+        self.missing_ttl = missing_ttl
+        self.max_statuses = max_statuses
+        self.statuses = OrderedDict()
+        self.probes = {}
+        self.probe_threads = probe_threads
+        self.probe_pool = None
+
+    # -------------------------------------------------------------------------
+    def pool(self, scheme, netloc):
+        with self.lock:
+            key = (scheme, netloc)
+            if key not in self.pools:
+                self.pools[key] = HostPool(scheme, netloc, self.max_per_host, self.timeout)
+            return self.pools[key]
+
+    # -------------------------------------------------------------------------
+    def request(self, url, method='GET', headers=None):
+        """
+        Make a request, following redirects and retrying on connection errors and busy
+        servers.  Returns (status, response headers (dict, lower case names), body)
+        """
+        for redirect in range(self.max_redirects + 1):
+            status, resp_headers, body = self.request_once(url, method, headers)
+            if status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+                url = urljoin(url, resp_headers['location'])
+                if status == 303:
+                    method = 'GET'
+                continue
+            return status, resp_headers, body
+        raise FetchError(url, status, 'too many redirects')
+
+    # -------------------------------------------------------------------------
+    def request_once(self, url, method, headers):
+        parts = urlparse(url)
+        if parts.scheme not in ('http', 'https'):
+            # Local files (and other schemes) are read as before
+            return 200, {}, urllib.urlopen(url).read()
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = self.pool(parts.scheme, parts.netloc)
+
+        attempt = 0
+        while True:
+            pool.slots.acquire()
+            conn, reused = None, False
+            try:
+                # (inside the try, so that the slot is released if the connection can't even be made, e.g. an invalid port)
+                conn, reused = pool.get_connection()
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+                body = resp.read()
+                status = resp.status
+                resp_headers = dict((k.lower(), v) for k, v in resp.getheaders())
+                if resp.will_close:
+                    conn.close()
+                else:
+                    pool.release_connection(conn)
+                error = None
+            except (socket.error, httplib.HTTPException), e:
+                if conn is not None:
+                    conn.close()
+                status = None
+                error = e
+            finally:
+                pool.slots.release()
+
+            if error is None and status not in self.retry_statuses:
+                return status, resp_headers, body
+            if error is not None and reused:
+                # The server closed an idle keep-alive connection, just try again with a new one
+                continue
+            if attempt >= self.retries:
+                if error is not None:
+                    raise FetchError(url, status, str(error))
+                return status, resp_headers, body
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    # -------------------------------------------------------------------------
+    def get(self, url, headers=None):
+        """Fetch the body of a url, raising FetchError if the server returns an error"""
+
+        status, resp_headers, body = self.request(url, 'GET', headers)
+        if status >= 400:
+            raise FetchError(url, status)
+        return body
+
+    # -------------------------------------------------------------------------
+    def probe(self, url):
+        """
+        Check whether a tile exists with a HEAD request (or a one byte range request
+        if the server doesn't support HEAD).  Returns True, False, or None if the
+        server couldn't be reached (which isn't cached)
+        """
+        try:
+            status, resp_headers, body = self.request(url, 'HEAD')
+            if status in (405, 501):
+                status, resp_headers, body = self.request(url, 'GET', {'Range': 'bytes=0-0'})
+        except IOError:
+            return None
+        if status in self.retry_statuses:
+            return None
+        return status < 400
+
+    # -------------------------------------------------------------------------
+    def probe_and_cache(self, url):
+        exists = None
+        try:
+            exists = self.probe(url)
+        finally:
+            # (the check is no longer in progress, even if it failed)
+            with self.lock:
+                if exists is not None:
+                    ttl = self.exists_ttl if exists else self.missing_ttl
+                    self.statuses.pop(url, None)
+                    self.statuses[url] = (exists, time.time() + ttl)
+                    while len(self.statuses) > self.max_statuses:
+                        self.statuses.popitem(last=False)
+                del self.probes[url]
+        return bool(exists)
+
+    # -------------------------------------------------------------------------
+    def tiles_exist(self, urls):
+        """
+        Check whether each of the tiles exists, returns a dict of url -> True/False.
+        Cached results are used when they haven't expired, and the remaining tiles are
+        checked concurrently (a tile that is already being checked is not checked twice)
+        """
+        results = {}
+        pending = {}
+        now = time.time()
+        with self.lock:
+            for url in urls:
+                cached = self.statuses.get(url)
+                if cached is not None and cached[1] > now:
+                    results[url] = cached[0]
+                elif url in self.probes:
+                    pending[url] = self.probes[url]
+                elif url not in pending:
+                    if self.probe_pool is None:
+                        self.probe_pool = ThreadPool(self.probe_threads)
+                    pending[url] = self.probes[url] = self.probe_pool.apply_async(self.probe_and_cache, (url,))
+        for url, result in pending.items():
+            results[url] = result.get()
+        return results
+
+###############################################################################
+
+# The fetcher shared by the scripts
+fetcher = TileFetcher()
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+#
+# Pre-render the dynamic tiles of a layer into its cache (instead of waiting for
+# Google Earth to request them), for a region (ullr) and a range of zoom levels.
+# The layer is described with the same options as the network link of the
+# dynamic tile generator script, and the tiles end up in the same cache
+# (dynamic_tiles/<cachedir>/<layer>), so the script serves them from there.
+#
+# Tiles are rendered in blocks by a pool of processes.  Finished blocks are
+# recorded in dynamic_tiles/<cachedir>/<layer>.seed, so an interrupted run picks
+# up where it stopped when it is started again with the same options.
+#
+# Usage: python seed_tiles.py --url <url> --cachedir <cachedir> [options]  (-h for the options)
+# (run from the folder that the tile server runs from, which contains dynamic_tiles)
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from optparse import OptionParser
+from multiprocessing import Pool, cpu_count
+import cgi
+import math
+import os, sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cgi-bin'))
+
+import kml_for_tiles
+import tile_cache
+import coverage_index
+from generate_dynamic_tiles import GenerateDynamicTiles
+
+# Blocks of BLOCK_SIZE x BLOCK_SIZE tiles are given to the processes (and recorded as done) at a time
+# (or of a whole number of metatiles, see block_size)
+BLOCK_SIZE = tile_cache.SEED_BLOCK_SIZE
+
+###############################################################################
+
+def layer_querystring(options):
+    """
+    Query string of the dynamic tile generator script for the layer, as it would be in a network link
+    (url comes first, as the other options that end in url would otherwise be found instead)
+    """
+    querystring = 'url=' + options.url + ';'
+    for key in ('clrfile', 'bgurl', 'shpfile'):
+        if getattr(options, key):
+            querystring += '&%s=%s;' % (key, getattr(options, key))
+    for key in ('clrmode', 'resample', 'blend', 'metatile', 'downsample', 'cachedir', 'cachetype'):
+        if getattr(options, key):
+            querystring += '&%s=%s' % (key, urllib.quote(getattr(options, key)))
+    if options.outsideMask:
+        querystring += '&outsideMask'
+    return querystring
+
+def dynamic_tiles(querystring, zxy):
+    """A GenerateDynamicTiles for one tile of the layer"""
+
+    querystring += '&zxy=' + zxy
+    fs = cgi.FieldStorage(environ={'REQUEST_METHOD': 'GET', 'QUERY_STRING': querystring})
+    return GenerateDynamicTiles(querystring, fs, {})
+
+# -------------------------------------------------------------------------
+def seed_block(args):
+    """Render the tiles of a block (in a worker process), returns the block and the numbers of tiles rendered and skipped"""
+
+    querystring, skip_existing, block, tiles = args
+    layer = dynamic_tiles(querystring, block)
+    params = layer.layer_params()
+    cache = tile_cache.get_cache(layer.cachedir, layer.cachetype, tile_cache.layer_key(params), params)
+    rendered = skipped = 0
+    rendered_metatiles = set()
+    for tz, tx, ty in tiles:
+        if skip_existing and cache.lookup(tz, tx, ty) is not None:
+            skipped += 1
+            continue
+        # With metatiles, a render makes all of the tiles of the metatile
+        metatile = layer.metatile_block(tz, tx, ty)
+        if metatile not in rendered_metatiles:
+            layer.render_block(tz, metatile, cache, refresh=True)
+            rendered_metatiles.add(metatile)
+        rendered += 1
+    # Worker processes exit without running the exit handlers, so the tiles are written out before the block is recorded as done
+    tile_cache.flush()
+    return block, rendered, skipped
+
+# -------------------------------------------------------------------------
+def block_coverage(args):
+    """The tiles of a block (in the cache) that have any data (tiles that are not in the cache are counted as having data)"""
+
+    querystring, block, tiles = args
+    layer = dynamic_tiles(querystring, block)
+    params = layer.layer_params()
+    cache = tile_cache.get_cache(layer.cachedir, layer.cachetype, tile_cache.layer_key(params), params)
+    covered = []
+    for tz, tx, ty in tiles:
+        tile = cache.lookup(tz, tx, ty)
+        if tile is None or coverage_index.tile_has_data(tile.read()):
+            covered.append((tx, ty))
+    return covered
+
+# -------------------------------------------------------------------------
+def block_size(layer):
+    """
+    Size of the blocks of tiles of a layer: BLOCK_SIZE, or with metatiles, the smallest whole number of
+    metatiles that is at least as large, so that each metatile is rendered once, by one process
+    """
+    metatile = layer.metatile_block(31, 0, 0)[2]
+    return metatile * int(math.ceil(float(BLOCK_SIZE) / metatile))
+
+# -------------------------------------------------------------------------
+def tile_blocks(tminmax, tz, size=BLOCK_SIZE):
+    """The blocks of size x size tiles to render at a zoom level (as (z/bx/by, [(tz, tx, ty), ...]))"""
+
+    tminx, tminy, tmaxx, tmaxy = tminmax[tz].bounds
+    for bx in range(tminx // size, tmaxx // size + 1):
+        for by in range(tminy // size, tmaxy // size + 1):
+            tiles = [(tz, tx, ty) for tx in range(max(tminx, bx*size), min(tmaxx, bx*size+size-1)+1)
+                                  for ty in range(max(tminy, by*size), min(tmaxy, by*size+size-1)+1)]
+            # (blocks of another size are recorded under other names, as the metatile size isn't part of the layer)
+            if size == BLOCK_SIZE:
+                yield '%d/%d/%d' % (tz, bx, by), tiles
+            else:
+                yield '%d/%d/%d@%d' % (tz, bx, by, size), tiles
+
+###############################################################################
+
+if __name__=='__main__':
+
+    parser = OptionParser(usage="usage: %prog --url URL --cachedir CACHEDIR [options]",
+        description="Render the dynamic tiles of a layer into its cache.  The layer options are the same as those of the "
+                    "network link of generate_dynamic_tiles.py (see README.md)")
+    parser.add_option("--url", dest="url", help="web tile url or local gdal-supported dataset (or .pyr file)")
+    parser.add_option("--clrfile", dest="clrfile", help="color file (for color relief maps)")
+    parser.add_option("--clrmode", dest="clrmode", help="interpolate (default), exact or nearest")
+    parser.add_option("--bgurl", dest="bgurl", help="background web tile url or dataset, to blend with")
+    parser.add_option("--blend", dest="blend", help="blending ratio of the background (default 0.5)")
+    parser.add_option("--shpfile", dest="shpfile", help="shapefile to mask the tiles with")
+    parser.add_option("--outsideMask", dest="outsideMask", action="store_true", help="mask the outside of the shapefile polygons instead")
+    parser.add_option("--resample", dest="resample", help="resampling method (default near)")
+    parser.add_option("--metatile", dest="metatile", help="render local data sources in blocks of N x N tiles (e.g. 4 or 8)")
+    parser.add_option("--downsample", dest="downsample", help="make tiles from their cached child tiles, with this resampling method (e.g. average)")
+    parser.add_option("--bottom-up", dest="bottom_up", action="store_true", help="render the highest zoom level first (with --downsample, "
+                      "the tiles of the other zoom levels are then made from their children)")
+    parser.add_option("--cachedir", dest="cachedir", help="cache directory name (as in the network link)")
+    parser.add_option("--cachetype", dest="cachetype", help="dir (default) or mbtiles")
+    parser.add_option("--ullr", dest="ullr", default="-180_90_180_-89.9", help="region to render, ulx_uly_lrx_lry in degrees")
+    parser.add_option("--zoom", dest="zoom", default="1-10", help="zoom levels to render, e.g. 5-12 (default 1-10)")
+    parser.add_option("-p", "--processes", dest="processes", type="int", default=cpu_count(), help="number of processes (default: the number of CPUs)")
+    parser.add_option("--skip-existing", dest="skip_existing", action="store_true", help="don't render tiles that are already in the cache")
+    parser.add_option("--restart", dest="restart", action="store_true", help="ignore the progress of an earlier (interrupted) run")
+    parser.add_option("--coverage", dest="coverage", help="afterwards, make a coverage index of the tiles with data (at the highest zoom level) "
+                      "in this file (see coverage_index.py)")
+    (options, args) = parser.parse_args()
+    if not options.url or not options.cachedir:
+        parser.error("--url and --cachedir are required")
+
+    querystring = layer_querystring(options)
+    tminz, tmaxz = [int(z) for z in options.zoom.split('-')]
+    tminmax = kml_for_tiles.region_tiles(options.ullr)
+
+    # The progress is kept per layer (so it is not reused when the options or the source files change)
+    layer = dynamic_tiles(querystring, '0/0/0')
+    params = layer.layer_params()
+    size = block_size(layer)
+    progressfilename = os.path.join(tile_cache.CACHE_ROOT, layer.cachedir, tile_cache.layer_key(params) + '.seed')
+    # (the caches themselves are only opened by the worker processes, so no database connection is shared with them)
+    if not os.path.isdir(os.path.dirname(progressfilename)):
+        os.makedirs(os.path.dirname(progressfilename))
+    done = set()
+    if os.path.exists(progressfilename) and not options.restart:
+        done = set(line.strip() for line in open(progressfilename))
+
+    zooms = range(tminz, tmaxz+1)
+    if options.bottom_up:
+        zooms.reverse()
+    blocks = {}
+    for tz in zooms:
+        blocks[tz] = [(querystring, options.skip_existing, block, tiles) for block, tiles in tile_blocks(tminmax, tz, size)
+                      if block not in done]
+    total = sum(len(b[3]) for tz in zooms for b in blocks[tz])
+    print "Layer %s: %d tiles to render (%d blocks done by earlier runs)" % (tile_cache.layer_key(params), total, len(done))
+
+    pool = Pool(options.processes)
+    start = time.time()
+    rendered = skipped = 0
+    progressfile = open(progressfilename, 'w' if options.restart else 'a')
+    try:
+        # One zoom level at a time (so that, bottom-up, the children of the tiles are all there)
+        for tz in zooms:
+            for block, block_rendered, block_skipped in pool.imap_unordered(seed_block, blocks[tz]):
+                progressfile.write(block + '\n')
+                progressfile.flush()
+                rendered += block_rendered
+                skipped += block_skipped
+                elapsed = time.time() - start
+                sys.stdout.write("\r%d/%d tiles (%.1f tiles/sec)" % (rendered + skipped, total, rendered / max(elapsed, 1e-6)))
+                sys.stdout.flush()
+        if options.coverage:
+            sys.stdout.write("\nMaking the coverage index")
+            sys.stdout.flush()
+            covered = []
+            for block_covered in pool.imap_unordered(block_coverage, [(querystring, block, tiles) for block, tiles in tile_blocks(tminmax, tmaxz, size)]):
+                covered.extend(block_covered)
+            coverage_index.CoverageIndex.from_tiles(tmaxz, covered).write(options.coverage)
+            sys.stdout.write(" (%d of %d tiles at zoom level %d have data)" % (len(covered), len(tminmax[tmaxz]), tmaxz))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print "\nInterrupted, run again with the same options to continue"
+    pool.join()
+    progressfile.close()
+
+    elapsed = time.time() - start
+    print "\nRendered %d tiles, skipped %d existing tiles in %.1f s (%.1f tiles/sec)" % (
+        rendered, skipped, elapsed, rendered / max(elapsed, 1e-6))
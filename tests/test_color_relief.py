@@ -0,0 +1,231 @@
+#
+# Tests of the color relief (cgi-bin/color_relief.py): the colors must be the same as those of
+# gdaldem color-relief -alpha, which is checked against a scalar port of gdaldem's color lookup
+# (GDALColorReliefGetRGBA), and against gdaldem itself when GDAL is installed.  Run from the
+# top folder with:
+#
+#   python -m unittest discover tests
+#
+###############################################################################
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cgi-bin'))
+
+import color_relief
+from color_relief import ColorRelief, INTERPOLATE, EXACT_ENTRY, NEAREST_ENTRY
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+MODES = (INTERPOLATE, EXACT_ENTRY, NEAREST_ENTRY)
+
+# Color tables (value, R, G, B, A), not in order
+ELEVATION = [
+    ('3500', (255, 255, 255, 255)),
+    ('2500', (235, 220, 175, 255)),
+    ('1500', (190, 185, 135, 200)),
+    ('700', (240, 250, 150, 255)),
+    ('0', (50, 180, 50, 255)),
+    ('nv', (0, 0, 0, 0)),
+    ('-32768', (200, 230, 255, 255)),
+]
+PERCENT = [
+    ('0%', (0, 0, 255, 255)),
+    ('50%', (0, 255, 0, 255)),
+    ('100%', (255, 0, 0, 128)),
+    ('nv', (255, 255, 255, 0)),
+]
+
+###############################################################################
+
+def write_clr(folder, entries):
+    filename = os.path.join(folder, 'test.clr')
+    with open(filename, 'w') as clr:
+        clr.write('# test colors\n')
+        for value, color in entries:
+            clr.write('%s %s\n' % (value, ' '.join(str(c) for c in color)))
+    return filename
+
+def reference_table(entries, nodata, minmax):
+    """
+    The color entries, resolved and sorted as gdaldem does (nv entries are 0 if there is no nodata value,
+    and a transparent entry is added for the nodata value if there is no nv entry)
+    """
+    if nodata is not None and 'nv' not in [value for value, color in entries]:
+        entries = entries + [('nv', (0, 0, 0, 0))]
+    table = []
+    for value, color in entries:
+        if value == 'nv':
+            value = nodata if nodata is not None else 0.0
+        elif value.endswith('%'):
+            value = minmax[0] + float(value[:-1]) / 100.0 * (minmax[1] - minmax[0])
+        else:
+            value = float(value)
+        table.append((value, color))
+    # A nan entry first
+    table.sort(key=lambda entry: (not numpy.isnan(entry[0]), entry[0] if not numpy.isnan(entry[0]) else 0))
+    return table
+
+def c_int(value):
+    """A double cast to an int in C (a nan gives INT_MIN on x86)"""
+
+    if numpy.isnan(value):
+        return -2**31
+    return int(value)
+
+def reference_rgba(table, value, mode):
+    """The color of a value, as GDALColorReliefGetRGBA (gdaldem_lib.cpp) computes it"""
+
+    n = len(table)
+    lower = 0
+    if numpy.isnan(table[0][0]):
+        if numpy.isnan(value):
+            return table[0][1]
+        lower = 1
+
+    # Index of the first entry that is not smaller than the value
+    upper = n - 1
+    while True:
+        mid = (lower + upper) // 2
+        if upper - lower <= 1:
+            if value <= table[lower][0]:
+                i = lower
+            elif value <= table[upper][0]:
+                i = upper
+            else:
+                i = upper + 1
+            break
+        elif table[mid][0] >= value:
+            upper = mid
+        else:
+            lower = mid
+
+    if i == 0:
+        if mode == EXACT_ENTRY and table[0][0] != value:
+            return (0, 0, 0, 0)
+        return table[0][1]
+    elif i == n:
+        if mode == EXACT_ENTRY and table[n-1][0] != value:
+            return (0, 0, 0, 0)
+        return table[n-1][1]
+    if table[i-1][0] == value:
+        return table[i-1][1]
+    if table[i][0] == value:
+        return table[i][1]
+    if mode == EXACT_ENTRY:
+        return (0, 0, 0, 0)
+    if mode == NEAREST_ENTRY:
+        if value - table[i-1][0] < table[i][0] - value:
+            return table[i-1][1]
+        return table[i][1]
+    ratio = (value - table[i-1][0]) / (table[i][0] - table[i-1][0])
+    return tuple(min(255, max(0, c_int(0.45 + lc + ratio * (uc - lc)))) for lc, uc in zip(table[i-1][1], table[i][1]))
+
+def reference_colorize(entries, data, nodata, mode):
+    values = data.astype(numpy.float32).astype(numpy.float64)
+    if nodata is not None:
+        nodata = float(numpy.float32(nodata))
+    valid = values[~numpy.isnan(values)]
+    if nodata is not None:
+        valid = valid[valid != nodata]
+    table = reference_table(entries, nodata, (valid.min(), valid.max()))
+    rgba = numpy.array([reference_rgba(table, value, mode) for value in values.ravel()], dtype=numpy.uint8)
+    return rgba.reshape(data.shape + (4,))
+
+def sample_data(nodata):
+    """Elevations within and beyond the range of the entries, some on the entries, and some nodata"""
+
+    data = numpy.random.RandomState(0).uniform(-40000, 5000, (32, 32)).astype(numpy.float32)
+    data[0, :8] = [-32768, 0, 700, 1500, 2500, 3500, 3600, -40000]
+    data[1, :4] = [1100, 1100.5, 699.9, 0.001]
+    if nodata is not None:
+        data[2, :8] = nodata
+    return data
+
+###############################################################################
+
+class ColorReliefTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check(self, entries, nodata):
+        data = sample_data(nodata)
+        clrfile = write_clr(self.folder, entries)
+        for mode in MODES:
+            rgba = numpy.dstack(ColorRelief(clrfile, mode).colorize(data, nodata))
+            expected = reference_colorize(entries, data, nodata, mode)
+            self.assertTrue((rgba == expected).all(), '%s mode, nodata %s: %s' % (
+                mode, nodata, zip(*numpy.nonzero((rgba != expected).any(axis=-1)))[:5]))
+
+    def test_elevation(self):
+        self.check(ELEVATION, None)
+
+    def test_nodata(self):
+        self.check(ELEVATION, -9999)
+
+    def test_nan_nodata(self):
+        self.check(ELEVATION, float('nan'))
+
+    def test_nodata_without_entry(self):
+        # Without an nv entry, nodata is transparent (gdaldem adds an entry for it)
+        entries = [entry for entry in ELEVATION if entry[0] != 'nv']
+        clrfile = write_clr(self.folder, entries)
+        for nodata in (-9999, float('nan')):
+            self.check(entries, nodata)
+            data = numpy.array([[nodata, 100]], dtype=numpy.float32)
+            for mode in MODES:
+                rgba = numpy.dstack(ColorRelief(clrfile, mode).colorize(data, nodata))
+                self.assertEqual(rgba[0, 0].tolist(), [0, 0, 0, 0])
+
+    def test_percent(self):
+        self.check(PERCENT, None)
+        self.check(PERCENT, -9999)
+
+    def test_named_colors(self):
+        clrfile = os.path.join(self.folder, 'named.clr')
+        with open(clrfile, 'w') as clr:
+            clr.write('0 black\n100:white\n50,255,0,0,128\n')
+        data = numpy.array([[-10, 0, 25, 50, 75, 100, 110]], dtype=numpy.float32)
+        rgba = numpy.dstack(ColorRelief(clrfile).colorize(data))
+        expected = reference_colorize([('0', (0, 0, 0, 255)), ('100', (255, 255, 255, 255)), ('50', (255, 0, 0, 128))],
+                                      data, None, INTERPOLATE)
+        self.assertTrue((rgba == expected).all())
+
+    def test_cached(self):
+        clrfile = write_clr(self.folder, ELEVATION)
+        relief = color_relief.get_color_relief(clrfile)
+        self.assertTrue(color_relief.get_color_relief(clrfile) is relief)
+        self.assertFalse(color_relief.get_color_relief(clrfile, EXACT_ENTRY) is relief)
+
+    @unittest.skipIf(gdal is None, 'GDAL is not installed')
+    def test_gdaldem(self):
+        flags = {INTERPOLATE: [], EXACT_ENTRY: ['-exact_color_entry'], NEAREST_ENTRY: ['-nearest_color_entry']}
+        for entries in (ELEVATION, PERCENT):
+            clrfile = write_clr(self.folder, entries)
+            for nodata in (None, -9999, float('nan')):
+                data = sample_data(nodata)
+                ds = gdal.GetDriverByName('MEM').Create('', data.shape[1], data.shape[0], 1, gdal.GDT_Float32)
+                ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+                ds.GetRasterBand(1).WriteArray(data)
+                if nodata is not None:
+                    ds.GetRasterBand(1).SetNoDataValue(nodata)
+                for mode in MODES:
+                    relief = gdal.DEMProcessing('', ds, 'color-relief', format='MEM', colorFilename=clrfile,
+                                                addAlpha=True, options=flags[mode])
+                    expected = numpy.dstack([relief.GetRasterBand(b).ReadAsArray() for b in range(1, 5)])
+                    rgba = numpy.dstack(ColorRelief(clrfile, mode).colorize(data, nodata))
+                    self.assertTrue((rgba == expected).all(), '%s mode, nodata %s' % (mode, nodata))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#
+# Tests of the coverage indexes (cgi-bin/coverage_index.py).  Run from the top folder with:
+#
+#   python -m unittest discover tests
+#
+# (the tests that need GDAL are skipped when it isn't installed)
+#
+###############################################################################
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cgi-bin'))
+
+import coverage_index
+from coverage_index import CoverageIndex
+
+try:
+    from osgeo import gdal, ogr, osr
+except ImportError:
+    gdal = None
+
+# Tiles at zoom level 4: inside the test polygon (-30..30 degrees), partly inside it, and far outside of it
+INSIDE = (7, 8)
+PARTLY = (6, 9)
+OUTSIDE = (0, 0)
+
+###############################################################################
+
+class FakeMask(object):
+    """A shapefile mask with a result (True, None or an array) for the bounds of each tile"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def tile_mask(self, west, south, east, north, xsize, ysize):
+        return self.results[(round(west, 6), round(south, 6))]
+
+def fake_mask(tz, results):
+    from global_mercator import GlobalMercator
+    mercator = GlobalMercator()
+    keyed = {}
+    for (tx, ty), inside in results.items():
+        south, west, north, east = mercator.TileLatLonBounds(tx, ty, tz)
+        keyed[(round(west, 6), round(south, 6))] = inside
+    return FakeMask(keyed)
+
+def write_polygon_shapefile(folder, west, south, east, north):
+    """A shapefile (in degrees) with a single rectangular polygon"""
+
+    filename = os.path.join(folder, 'polygon.shp')
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    source = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(filename)
+    layer = source.CreateLayer('polygon', srs, ogr.wkbPolygon)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((%f %f, %f %f, %f %f, %f %f, %f %f))' % (
+        west, south, east, south, east, north, west, north, west, south)))
+    layer.CreateFeature(feature)
+    source = None
+    return filename
+
+def write_raster(folder, west, south, east, north):
+    """A raster (in degrees, one pixel per degree) that has data everywhere"""
+
+    filename = os.path.join(folder, 'raster.tif')
+    cols, rows = int(east - west), int(north - south)
+    ds = gdal.GetDriverByName('GTiff').Create(filename, cols, rows, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((west, 1, 0, north, 0, -1))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).Fill(1)
+    ds = None
+    return filename
+
+###############################################################################
+
+class CoverageIndexTest(unittest.TestCase):
+
+    def test_covers(self):
+        index = CoverageIndex.from_tiles(4, [(5, 6), (9, 9)])
+        self.assertTrue(index.covers(5, 6, 4))
+        self.assertFalse(index.covers(5, 7, 4))
+        # The ancestors of the tiles, and their descendants
+        self.assertTrue(index.covers(2, 3, 3))
+        self.assertTrue(index.covers(0, 0, 0))
+        self.assertTrue(index.covers(19, 18, 5))
+        self.assertFalse(index.covers(20, 18, 5))
+
+    def test_read_write(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'index.cov')
+            CoverageIndex.from_tiles(6, [(1, 2), (40, 33), (41, 33)]).write(filename)
+            index = coverage_index.get_index(filename)
+            self.assertEqual(index.maxzoom, 6)
+            self.assertEqual([index.covers(tx, ty, 6) for tx, ty in [(1, 2), (40, 33), (41, 33), (42, 33)]],
+                             [True, True, True, False])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_mask_tiles(self):
+        # Tiles inside the polygons are transparent (or with outsideMask, the tiles outside of them),
+        # partly covered tiles have data either way
+        mask = fake_mask(4, {INSIDE: True, PARTLY: object(), OUTSIDE: None})
+        tiles = [INSIDE, PARTLY, OUTSIDE]
+        self.assertEqual(coverage_index.mask_tiles(tiles, 4, mask), set([PARTLY, OUTSIDE]))
+        self.assertEqual(coverage_index.mask_tiles(tiles, 4, mask, outsideMask=True), set([INSIDE, PARTLY]))
+
+    @unittest.skipIf(gdal is None, 'GDAL is not installed')
+    def test_mask_tiles_polygon(self):
+        import shape_mask
+        folder = tempfile.mkdtemp()
+        try:
+            shpfile = write_polygon_shapefile(folder, -30, -30, 30, 30)
+            srs = osr.SpatialReference()
+            srs.ImportFromProj4('+proj=latlong +datum=wgs84 +nodefs')
+            mask = shape_mask.get_shape_mask(shpfile, srs.ExportToWkt())
+            tiles = [INSIDE, PARTLY, OUTSIDE]
+            self.assertEqual(coverage_index.mask_tiles(tiles, 4, mask), set([PARTLY, OUTSIDE]))
+            self.assertEqual(coverage_index.mask_tiles(tiles, 4, mask, outsideMask=True), set([INSIDE, PARTLY]))
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipIf(gdal is None, 'GDAL is not installed')
+    def test_footprint_tiles(self):
+        folder = tempfile.mkdtemp()
+        try:
+            raster = write_raster(folder, -60, -60, 60, 60)
+            shpfile = write_polygon_shapefile(folder, -30, -30, 30, 30)
+            tiles = coverage_index.footprint_tiles(raster, 4)
+            self.assertTrue(INSIDE in tiles and PARTLY in tiles)
+            self.assertFalse(OUTSIDE in tiles)
+            # The tiles inside the polygon are masked away, the ones around it are kept
+            masked = coverage_index.footprint_tiles(raster, 4, shpfile)
+            self.assertEqual(masked, tiles - set([(7, 7), (7, 8), (8, 7), (8, 8)]))
+            # and with outsideMask, only the tiles that overlap the polygon are kept
+            inside = coverage_index.footprint_tiles(raster, 4, shpfile, outsideMask=True)
+            self.assertTrue(INSIDE in inside and PARTLY in inside)
+            self.assertEqual(inside, set(t for t in tiles if 6 <= t[0] <= 9 and 6 <= t[1] <= 9))
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    unittest.main()
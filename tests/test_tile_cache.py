@@ -0,0 +1,273 @@
+#
+# Tests of the dynamic tile caches (cgi-bin/tile_cache.py).  Run from the top folder with:
+#
+#   python -m unittest discover tests
+#
+###############################################################################
+
+import os, sys
+import errno
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import email.utils
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cgi-bin'))
+
+import tile_cache
+from tile_cache import DirectoryCache, MBTilesCache, MemoryCache, TieredCache, SingleFlight
+
+real_link = getattr(os, 'link', None)
+
+###############################################################################
+
+class DirectoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = DirectoryCache(os.path.join(self.folder, 'layer'))
+
+    def tearDown(self):
+        if real_link is not None:
+            os.link = real_link
+        shutil.rmtree(self.folder)
+
+    @unittest.skipIf(not hasattr(os, 'link'), 'no hard links')
+    def test_put_shared(self):
+        tiles = [self.cache.put_shared(3, tx, 2, 'empty', 'rgba-00000000') for tx in range(4)]
+        self.assertEqual([tile.read() for tile in tiles], ['empty'] * 4)
+        shared = self.cache.shared_filename('rgba-00000000', 0)
+        self.assertEqual(os.stat(shared).st_nlink, 5)
+        # A tile that is rendered again replaces its link
+        self.cache.put(3, 0, 2, 'data')
+        self.assertEqual(self.cache.lookup(3, 0, 2).read(), 'data')
+        self.assertEqual(os.stat(shared).st_nlink, 4)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.cache.filename(3, 0, 2)))), ['2.png'])
+
+    @unittest.skipIf(not hasattr(os, 'link'), 'no hard links')
+    def test_put_shared_modified(self):
+        # A tile rendered again (as a link to a shared file made long before) is modified when it is rendered,
+        # so a conditional request with the time of the copy the client has doesn't get a 304
+        self.cache.put(3, 0, 2, 'data')
+        since = email.utils.formatdate(time.time() - 60, usegmt=True)
+        self.cache.put_shared(3, 1, 2, 'empty', 'rgba-00000000')
+        old = time.time() - 3600
+        os.utime(self.cache.shared_filename('rgba-00000000', 0), (old, old))
+        rendered = int(time.time())
+        tile = self.cache.put_shared(3, 0, 2, 'empty', 'rgba-00000000')
+        self.assertTrue(tile.mtime >= rendered)
+        self.assertEqual(self.cache.lookup(3, 0, 2).mtime, tile.mtime)
+        self.assertTrue(tile.mtime > email.utils.mktime_tz(email.utils.parsedate_tz(since)))
+
+    @unittest.skipIf(not hasattr(os, 'link'), 'no hard links')
+    def test_put_shared_max_links(self):
+        # A file system that allows 3 links per file: the tiles are linked to a new shared file
+        # when a file has all of its links, rather than copied
+        def link(source, name):
+            if os.stat(source).st_nlink >= 3:
+                raise OSError(errno.EMLINK, 'Too many links')
+            real_link(source, name)
+        os.link = link
+        for ty in range(5):
+            self.assertEqual(self.cache.put_shared(4, 1, ty, 'empty', 'rgba-00000000').read(), 'empty')
+        self.assertEqual(os.stat(self.cache.shared_filename('rgba-00000000', 0)).st_nlink, 3)
+        self.assertEqual(os.stat(self.cache.shared_filename('rgba-00000000', 1)).st_nlink, 3)
+        self.assertEqual(os.stat(self.cache.shared_filename('rgba-00000000', 2)).st_nlink, 2)
+        self.assertEqual(os.stat(self.cache.filename(4, 1, 4)).st_nlink, 2)
+
+class MBTilesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = MBTilesCache(os.path.join(self.folder, 'layer.mbtiles'), 'layer')
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.folder)
+
+    def stored(self):
+        db = self.cache.connection()
+        return db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY tile_column').fetchall()
+
+    def test_pending(self):
+        # A tile that isn't committed yet is served from memory, then from the database
+        tile = self.cache.put(3, 1, 2, 'data')
+        self.assertTrue((3, 1, 2) in self.cache.pending)
+        self.assertEqual(self.stored(), [])
+        self.assertEqual(self.cache.get(3, 1, 2).read(), 'data')
+        self.assertEqual(self.cache.get(3, 1, 2).etag, tile.etag)
+        self.cache.flush()
+        self.assertEqual(self.cache.pending, {})
+        self.assertEqual([tuple(row[:3]) + (str(row[3]),) for row in self.stored()], [(3, 1, 2, 'data')])
+        self.assertEqual(self.cache.get(3, 1, 2).read(), 'data')
+        self.assertEqual(self.cache.get(3, 1, 3), None)
+        self.assertEqual(self.cache.stats(), {'hits': 3, 'misses': 1})
+
+    def test_purge(self):
+        # (tiles that are still pending are purged too)
+        for tx in range(4):
+            self.cache.put(3, tx, 2, 'data')
+        self.cache.flush()
+        self.cache.put(3, 4, 2, 'data')
+        self.assertEqual(self.cache.purge({3: (1, 0, 4, 7)}), 4)
+        self.assertEqual([tuple(row[:3]) for row in self.stored()], [(3, 0, 2)])
+        self.assertEqual(self.cache.get(3, 4, 2), None)
+
+    def test_close(self):
+        # The remaining tiles are committed when the cache is closed, and after that as they are put
+        self.cache.put(3, 1, 2, 'data')
+        self.cache.close()
+        self.assertFalse(self.cache.writer.is_alive())
+        self.assertEqual(len(self.stored()), 1)
+        self.cache.put(3, 2, 2, 'data')
+        self.assertEqual(len(self.stored()), 2)
+
+class TieredCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = DirectoryCache(os.path.join(self.folder, 'layer'))
+        self.memory = MemoryCache(1024)
+        self.cache = TieredCache('cache:dir', self.store, self.memory)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_memory(self):
+        # Tiles are served from memory once they are put, or read from the store
+        self.cache.put(3, 1, 2, 'data')
+        self.assertEqual(self.cache.get(3, 1, 2).read(), 'data')
+        self.assertEqual(self.store.stats(), {'hits': 0, 'misses': 0})
+        self.store.put(3, 2, 2, 'stored')
+        self.assertEqual(self.cache.get(3, 2, 2).read(), 'stored')
+        self.assertEqual(self.cache.get(3, 2, 2).read(), 'stored')
+        self.assertEqual(self.store.stats(), {'hits': 1, 'misses': 0})
+        self.assertEqual(self.cache.get(3, 3, 2), None)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+        self.assertEqual(self.memory.stats()['tiles'], 2)
+
+    def test_purge(self):
+        self.cache.put(3, 1, 2, 'data')
+        self.cache.put(3, 5, 2, 'data')
+        self.assertEqual(self.cache.purge({3: (0, 0, 3, 7)}), 1)
+        self.assertEqual(self.cache.get(3, 1, 2), None)
+        self.assertEqual(self.memory.lookup(('cache:dir', 3, 1, 2)), None)
+        self.assertEqual(self.cache.get(3, 5, 2).read(), 'data')
+
+    def test_counts(self):
+        # The counts of lookups from many threads add up
+        self.cache.put(3, 1, 2, 'data')
+        def lookups():
+            for i in range(1000):
+                self.cache.get(3, 1, 2)
+                self.cache.get(3, 1, 3)
+        threads = [threading.Thread(target=lookups) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4000, 4000))
+        self.assertEqual(self.memory.stats()['hits'] + self.memory.stats()['misses'], 8000)
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_concurrently(self, flights, key, function, count):
+        """Call flights.do from count threads (the function waits until all of them have called it)"""
+
+        results = []
+        def call():
+            try:
+                results.append(flights.do(key, function))
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        while flights.stats()['coalesced'] < count - 1:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def render(self):
+        self.calls += 1
+        self.release.wait()
+        return 'tile'
+
+    def fail(self):
+        self.calls += 1
+        self.release.wait()
+        raise IOError('failed')
+
+    def test_coalesced(self):
+        flights = SingleFlight()
+        results = self.run_concurrently(flights, 'layer/3/1/2', self.render, 4)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(results), [('tile', False)] + [('tile', True)] * 3)
+        self.assertEqual(flights.stats(), {'in_flight': 0, 'coalesced': 3})
+        # The next call runs the function again
+        self.assertEqual(flights.do('layer/3/1/2', self.render), ('tile', False))
+        self.assertEqual(self.calls, 2)
+
+    def test_error(self):
+        # An exception is raised by all of the callers
+        flights = SingleFlight()
+        results = self.run_concurrently(flights, 'layer/3/1/2', self.fail, 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([type(result) for result in results], [IOError] * 3)
+        self.assertEqual(flights.stats()['in_flight'], 0)
+
+class LayerCachesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tile_cache.CACHE_ROOT
+        tile_cache.CACHE_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(tile_cache.CACHE_ROOT)
+        tile_cache.CACHE_ROOT = self.root
+
+    def test_purge_seed_progress(self):
+        # The blocks that purged tiles are in are no longer recorded as seeded
+        cache = tile_cache.get_cache('purge', 'dir', 'layer', {})
+        cache.put(4, 3, 3, 'data')
+        cache.put(4, 12, 12, 'data')
+        progressfilename = os.path.join(tile_cache.CACHE_ROOT, 'purge', 'layer.seed')
+        with open(progressfilename, 'w') as f:
+            f.write('4/0/0\n4/1/1\n3/0/0@4\n3/1/1@4\n5/0/0\n')
+        self.assertEqual(tile_cache.purge('purge', 'layer', (3, 4), (-180, -85, -1, -1)), 1)
+        self.assertEqual(cache.lookup(4, 3, 3), None)
+        self.assertNotEqual(cache.lookup(4, 12, 12), None)
+        self.assertEqual(open(progressfilename).read().split(), ['4/1/1', '3/1/1@4', '5/0/0'])
+
+    def test_open_caches(self):
+        # The least recently used caches are closed (and their tiles committed) when there are too many
+        max_open = tile_cache.MAX_OPEN_CACHES
+        tile_cache.MAX_OPEN_CACHES = 2
+        try:
+            first = tile_cache.get_cache('open', 'mbtiles', 'first', {})
+            first.put(3, 1, 2, 'data')
+            second = tile_cache.get_cache('open', 'mbtiles', 'second', {})
+            self.assertTrue(tile_cache.get_cache('open', 'mbtiles', 'first') is first)
+            third = tile_cache.get_cache('open', 'mbtiles', 'third', {})
+            self.assertTrue(second.store.closed and not second.store.writer.is_alive())
+            self.assertFalse(first.store.closed)
+            self.assertFalse(tile_cache.get_cache('open', 'mbtiles', 'second') is second)
+            self.assertTrue(first.store.closed)
+            self.assertEqual(first.store.pending, {})
+            self.assertEqual(tile_cache.get_cache('open', 'mbtiles', 'first').store.get(3, 1, 2).read(), 'data')
+        finally:
+            tile_cache.MAX_OPEN_CACHES = max_open
+            tile_cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#
+# Tests of the shared HTTP client (cgi-bin/tile_fetch.py), against a local stand-in
+# tile server.  Run from the top folder with:
+#
+#   python -m unittest discover tests
+#
+###############################################################################
+
+import os, sys
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cgi-bin'))
+
+from tile_fetch import TileFetcher, FetchError
+
+###############################################################################
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in tile server: /tile is a tile, /redirect redirects to it, /missing is a 404, /busy
+    is a 503 until it has been requested server.busy_count times, /slow takes a second, and
+    /nohead is a tile that only a GET (not a HEAD request) can be made for
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body='', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, self.headers.get('Range')))
+        if self.path == '/tile':
+            self.send(200, 'tile')
+        elif self.path == '/redirect':
+            self.send(302, headers=[('Location', '/tile')])
+        elif self.path == '/missing':
+            self.send(404, 'not found')
+        elif self.path == '/busy':
+            with server.lock:
+                server.busy_count -= 1
+                busy = server.busy_count >= 0
+            if busy:
+                self.send(503, 'busy')
+            else:
+                self.send(200, 'tile')
+        elif self.path == '/nohead':
+            if self.command == 'HEAD':
+                self.send(405)
+            elif self.headers.get('Range') == 'bytes=0-0':
+                self.send(206, 't', headers=[('Content-Range', 'bytes 0-0/4')])
+            else:
+                self.send(200, 'tile')
+        elif self.path == '/slow':
+            time.sleep(1)
+            self.send(200, 'tile')
+        else:
+            self.send(404)
+
+    do_HEAD = do_GET
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TileHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.busy_count = 0
+
+    def handle_error(self, request, client_address):
+        # (e.g. a client that timed out and closed the connection)
+        pass
+
+###############################################################################
+
+class TileFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TileServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.fetcher = TileFetcher(timeout=0.5, retries=2, backoff=0.05)
+
+    def tearDown(self):
+        for pool in self.fetcher.pools.values():
+            for conn in pool.idle:
+                conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        for i in range(5):
+            self.assertEqual(self.fetcher.get(self.base + '/tile'), 'tile')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect(self):
+        self.assertEqual(self.fetcher.get(self.base + '/redirect'), 'tile')
+        self.assertEqual([path for method, path, range in self.server.requests], ['/redirect', '/tile'])
+
+    def test_missing(self):
+        with self.assertRaises(FetchError) as raised:
+            self.fetcher.get(self.base + '/missing')
+        self.assertEqual(raised.exception.status, 404)
+        # (an error isn't retried)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retry_busy(self):
+        self.server.busy_count = 2
+        start = time.time()
+        self.assertEqual(self.fetcher.get(self.base + '/busy'), 'tile')
+        self.assertEqual(len(self.server.requests), 3)
+        # Waited for the backoff, twice as long the second time
+        self.assertTrue(time.time() - start >= 0.05 + 0.1)
+
+    def test_retry_gives_up(self):
+        self.server.busy_count = 10
+        with self.assertRaises(FetchError) as raised:
+            self.fetcher.get(self.base + '/busy')
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_timeout(self):
+        fetcher = TileFetcher(timeout=0.2, retries=0)
+        start = time.time()
+        self.assertRaises(FetchError, fetcher.get, self.base + '/slow')
+        self.assertTrue(time.time() - start < 0.9)
+
+    def test_invalid_url_releases_slot(self):
+        fetcher = TileFetcher(max_per_host=1, retries=0)
+        done = []
+        def fetch_all():
+            for i in range(3):
+                self.assertRaises(FetchError, fetcher.get, 'http://127.0.0.1:abc/tile')
+            done.append(True)
+        thread = threading.Thread(target=fetch_all)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEqual(done, [True])
+
+    # -------------------------------------------------------------------------
+    def test_exists_head(self):
+        urls = [self.base + '/tile', self.base + '/missing']
+        self.assertEqual(self.fetcher.tiles_exist(urls), {urls[0]: True, urls[1]: False})
+        self.assertEqual(sorted(self.server.requests), [('HEAD', '/missing', None), ('HEAD', '/tile', None)])
+
+    def test_exists_range(self):
+        url = self.base + '/nohead'
+        self.assertEqual(self.fetcher.tiles_exist([url]), {url: True})
+        self.assertEqual(self.server.requests, [('HEAD', '/nohead', None), ('GET', '/nohead', 'bytes=0-0')])
+
+    def test_exists_ttl(self):
+        fetcher = self.fetcher = TileFetcher(exists_ttl=0.2, missing_ttl=0.2)
+        urls = [self.base + '/tile', self.base + '/missing']
+        fetcher.tiles_exist(urls)
+        # Cached until the results expire
+        self.assertEqual(fetcher.tiles_exist(urls), {urls[0]: True, urls[1]: False})
+        self.assertEqual(len(self.server.requests), 2)
+        time.sleep(0.3)
+        self.assertEqual(fetcher.tiles_exist(urls), {urls[0]: True, urls[1]: False})
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_exists_failed_probe(self):
+        # A check that fails (rather than finding that the tile is missing) isn't left in progress
+        url = self.base + '/tile'
+        def probe(url):
+            raise ValueError(url)
+        self.fetcher.probe = probe
+        self.assertRaises(ValueError, self.fetcher.tiles_exist, [url])
+        self.assertEqual(self.fetcher.probes, {})
+        del self.fetcher.probe
+        self.assertEqual(self.fetcher.tiles_exist([url]), {url: True})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+#
+# Long-lived web server that runs the KML generator script and the dynamic tile
+# generator script in-process (instead of forking a new python interpreter for
+# every request, like threading_server8080.py and threading_server8090.py do).
+# The URLs of the scripts stay the same, so existing network links keep working.
+#
+# Usage: python tile_server.py [port]  (default port = 8090)
+#
+###############################################################################
+# Copyright (c) 2015, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import SocketServer
+import BaseHTTPServer
+import CGIHTTPServer
+import cgi
+import json
+import os, sys
+import traceback
+
+# The scripts live in the cgi-bin folder, import them from there so that their
+# module level state (gdal, PIL, caches, ...) stays warm between requests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cgi-bin'))
+
+###############################################################################
+
+class CGIResponseWriter(object):
+    """
+    File-like object that turns CGI style script output (header lines, a blank line,
+    then the body) into an HTTP response on the request handler.  A "Status:" header
+    is used as the HTTP status code, as it would be by a CGI server
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.headbuf = ''
+        self.headers_sent = False
+        self.softspace = 0
+
+    def write(self, data):
+        if self.headers_sent:
+            self.handler.wfile.write(data)
+            return
+        self.headbuf += data
+        for sep in ('\r\n\r\n', '\n\n'):
+            if sep in self.headbuf:
+                head, body = self.headbuf.split(sep, 1)
+                self.send_headers(head)
+                if body:
+                    self.handler.wfile.write(body)
+                break
+
+    def send_headers(self, head):
+        status = 200
+        headers = []
+        for line in head.splitlines():
+            if ':' not in line:
+                continue
+            name, value = line.split(':', 1)
+            if name.strip().lower() == 'status':
+                status = int(value.split()[0])
+            else:
+                headers.append((name.strip(), value.strip()))
+        self.handler.send_response(status)
+        for name, value in headers:
+            self.handler.send_header(name, value)
+        self.handler.end_headers()
+        self.headers_sent = True
+        self.headbuf = ''
+
+    def flush(self):
+        if self.headers_sent:
+            self.handler.wfile.flush()
+
+###############################################################################
+
+# The scripts are only imported when first requested (so that the KML generator
+# can be served on machines without gdal), and then stay loaded
+def run_generate_kml(querystring, fs, out, environ):
+    import generate_kml
+    generate_kml.generate_kml(querystring, fs, out, environ)
+
+def run_generate_dynamic_tiles(querystring, fs, out, environ):
+    import generate_dynamic_tiles
+    dynamic_tiles = generate_dynamic_tiles.GenerateDynamicTiles(querystring, fs, environ)
+    dynamic_tiles.generate_tiles(out)
+
+def is_loopback(host):
+    """Whether a client address is the computer itself (IPv4, IPv6 or IPv4-mapped IPv6)"""
+
+    if host.startswith('::ffff:'):
+        host = host[len('::ffff:'):]
+    return host.startswith('127.') or host == '::1'
+
+###############################################################################
+
+class InProcessRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
+    """
+    Request handler that serves generate_kml.py and generate_dynamic_tiles.py
+    in-process.  Other cgi-bin scripts are still run as CGI and everything else
+    (e.g. static/transparent.png) is served as a regular file
+    """
+
+    server_version = 'TileServer/1.0'
+
+    # -------------------------------------------------------------------------
+    def do_GET(self):
+        path, _, querystring = self.path.partition('?')
+        script = path.rstrip('/').split('/')[-1]
+        if path.startswith('/cgi-bin/') and script in self.scripts:
+            self.run_in_process(self.scripts[script], querystring)
+        elif path == '/cache_stats':
+            self.send_cache_stats()
+        elif path == '/cache_purge':
+            # (tiles are only removed by a POST request, so that a crawler or a prefetching browser can't remove them)
+            self.send_response(405)
+            self.send_header('Allow', 'POST')
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            CGIHTTPServer.CGIHTTPRequestHandler.do_GET(self)
+
+    # -------------------------------------------------------------------------
+    def do_POST(self):
+        path, _, querystring = self.path.partition('?')
+        if path == '/cache_purge':
+            # Tiles can only be removed from the computer that the server runs on
+            if not is_loopback(self.client_address[0]):
+                self.send_error(403, 'The cache can only be purged from localhost')
+                return
+            # The options can be in the query string or in the (form encoded) body
+            length = int(self.headers.getheader('Content-Length') or 0)
+            if length > 0:
+                querystring += '&' + self.rfile.read(length)
+            self.purge_cache(querystring)
+        else:
+            CGIHTTPServer.CGIHTTPRequestHandler.do_POST(self)
+
+    # -------------------------------------------------------------------------
+    def run_in_process(self, run, querystring):
+        """Run one of the scripts with a CGI-like query string, field storage and environment"""
+
+        environ = {'REQUEST_METHOD': 'GET', 'QUERY_STRING': querystring,
+                   'SERVER_SOFTWARE': self.version_string()}
+        # Request headers, named as in CGI (e.g. If-None-Match -> HTTP_IF_NONE_MATCH)
+        for name in self.headers.keys():
+            environ['HTTP_' + name.upper().replace('-', '_')] = self.headers.getheader(name)
+        fs = cgi.FieldStorage(environ=environ)
+        out = CGIResponseWriter(self)
+        try:
+            run(querystring, fs, out, environ)
+            if not out.headers_sent:
+                out.write('\n\n')
+        except Exception:
+            self.log_error('%s', traceback.format_exc())
+            if not out.headers_sent:
+                self.send_error(500, 'Script error')
+
+    # -------------------------------------------------------------------------
+    def send_cache_stats(self):
+        """Hit and miss counts of the dynamic tile caches (as JSON)"""
+
+        import tile_cache
+        body = json.dumps(tile_cache.stats(), indent=2, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # -------------------------------------------------------------------------
+    def purge_cache(self, querystring):
+        """
+        Remove tiles from a dynamic tile cache (on disk and in memory), with a POST request, e.g. to
+        /cache_purge?cachedir=dem&layer=<layer>&zoom=10-16&ullr=<ulx>_<uly>_<lrx>_<lry>
+        (only cachedir is required, see tile_cache.py -h)
+        """
+        import tile_cache
+        fs = cgi.FieldStorage(environ={'REQUEST_METHOD': 'GET', 'QUERY_STRING': querystring})
+        if 'cachedir' not in fs:
+            self.send_error(400, 'A cachedir is required')
+            return
+        try:
+            zmin, zmax = [int(z) for z in fs.getfirst('zoom', '0-31').split('-')]
+        except ValueError:
+            self.send_error(400, 'zoom must be zmin-zmax, e.g. 10-16')
+            return
+        bounds = None
+        if 'ullr' in fs:
+            try:
+                ulx, uly, lrx, lry = [float(v) for v in fs.getfirst('ullr').split('_')]
+            except ValueError:
+                self.send_error(400, 'ullr must be ulx_uly_lrx_lry, in degrees')
+                return
+            bounds = (ulx, lry, lrx, uly)
+        try:
+            removed = tile_cache.purge(fs.getfirst('cachedir'), fs.getfirst('layer'), (zmin, zmax), bounds)
+        except ValueError, e:
+            # (a cachedir or layer that isn't a folder name, e.g. ../..)
+            self.send_error(400, str(e))
+            return
+        body = json.dumps({'removed': removed})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    scripts = {'generate_kml.py': run_generate_kml,
+               'generate_dynamic_tiles.py': run_generate_dynamic_tiles}
+
+###############################################################################
+
+class ThreadingTileServer(SocketServer.ThreadingMixIn,
+                   BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+if __name__=='__main__':
+
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    else:
+        port = 8090
+
+    server = ThreadingTileServer(('', port), InProcessRequestHandler)
+    #
+    try:
+        while 1:
+            sys.stdout.flush()
+            server.handle_request()
+    except KeyboardInterrupt:
+        print "Finished"